@@ -0,0 +1,285 @@
+"""
+Admission control for LLM calls: global and per-user token buckets and concurrency limits,
+with a bounded wait queue and deadlines
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncContextManager, AsyncIterator, Deque, Dict, Optional, Tuple
+
+from llm_clients import stream_reply
+
+
+class AdmissionRejected(Exception):
+    """The call can't be admitted in time; retry after retry_after seconds (answered with 429)"""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"LLM capacity exceeded ({reason}), retry in {math.ceil(retry_after)}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class TokenBucket:
+    """rate tokens per second up to burst; a rate of 0 means unlimited"""
+
+    def __init__(self, rate: float = 0.0, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is free (for the next caller, given earlier reservations)"""
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def reserve(self, now: float):
+        """Take a token, going into debt if it isn't there yet (the caller waits wait_time first)"""
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens -= 1
+
+    def refund(self, now: float):
+        """Give back a reserved token whose call never ran"""
+        if self.rate > 0:
+            self._refill(now)
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.rate <= 0 or self.tokens >= self.burst
+
+
+class _UserState:
+    def __init__(self, concurrency: int, rate: float, burst: Optional[float]):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.active = 0
+        self.waiting = 0
+
+    def idle(self, now: float) -> bool:
+        return not self.active and not self.waiting and self.bucket.full(now)
+
+
+class AdmissionController:
+    """Gate every LLM call through slot(user_id).
+
+    A call first needs a token from the global bucket and from the user's bucket, then a
+    place under the user's and the global concurrency limits. Calls wait in a bounded
+    queue (max_queue overall, max_user_queue per user) for at most max_wait seconds;
+    when the queue is full, or the wait would run past the deadline, AdmissionRejected
+    is raised straight away with a Retry-After hint. One busy camera therefore uses its
+    own share and can't hold up every other user. A call that is rejected or cancelled
+    before it is admitted gives its rate tokens back.
+    """
+
+    def __init__(self, global_concurrency: int = 32, global_rate: float = 0.0, global_burst: Optional[float] = None,
+                 user_concurrency: int = 4, user_rate: float = 0.0, user_burst: Optional[float] = None,
+                 max_queue: int = 200, max_user_queue: int = 20, max_wait: float = 10.0, max_users: int = 10000):
+        self.global_concurrency = global_concurrency
+        self.user_concurrency = user_concurrency
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_queue = max_queue
+        self.max_user_queue = max_user_queue
+        self.max_wait = max_wait
+        self.max_users = max_users
+        self._global = asyncio.Semaphore(global_concurrency)
+        self._bucket = TokenBucket(global_rate, global_burst)
+        self._users: Dict[str, _UserState] = {}
+        self.queued = 0
+        self.active = 0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+        self._recent_waits: Deque[float] = deque(maxlen=500)
+        self._recent_holds: Deque[float] = deque(maxlen=100)
+
+    def _user(self, user_id: str) -> _UserState:
+        state = self._users.get(user_id)
+        if state is None:
+            if len(self._users) >= self.max_users:
+                now = time.monotonic()
+                for idle_user in [u for u, s in self._users.items() if s.idle(now)]:
+                    del self._users[idle_user]
+            state = self._users[user_id] = _UserState(self.user_concurrency, self.user_rate, self.user_burst)
+        return state
+
+    def _retry_hint(self) -> float:
+        """How long a queued call tends to wait for a slot: the typical call duration"""
+        if not self._recent_holds:
+            return 1.0
+        return sum(self._recent_holds) / len(self._recent_holds)
+
+    def _reject(self, reason: str, retry_after: float):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        raise AdmissionRejected(reason, retry_after)
+
+    def _rate_wait(self, user: Optional[_UserState], now: float) -> Tuple[float, str]:
+        global_wait = self._bucket.wait_time(now)
+        user_wait = user.bucket.wait_time(now) if user else 0.0
+        return (user_wait, "user_rate") if user_wait > global_wait else (global_wait, "global_rate")
+
+    def _admissible(self, user: Optional[_UserState], now: float) -> float:
+        """Seconds the caller must wait for rate tokens; rejects if that or the queue is too long"""
+        wait, reason = self._rate_wait(user, now)
+        if wait > self.max_wait:
+            self._reject(reason, wait)
+        if self.queued >= self.max_queue:
+            self._reject("queue_full", self._retry_hint())
+        if user and user.waiting >= self.max_user_queue:
+            self._reject("user_queue_full", self._retry_hint())
+        return wait
+
+    def check(self, user_id: Optional[str] = None):
+        """Raise AdmissionRejected if a call for user_id would be refused right now, without
+        taking anything; lets a request fail fast before it does any other work"""
+        self._admissible(self._users.get(user_id) if user_id else None, time.monotonic())
+
+    async def _acquire(self, semaphore: asyncio.Semaphore, deadline: float, reason: str):
+        if not semaphore.locked():
+            await semaphore.acquire()
+            return
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._reject(reason, self._retry_hint())
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=remaining)
+        except asyncio.TimeoutError:
+            self._reject(reason, self._retry_hint())
+
+    @asynccontextmanager
+    async def slot(self, user_id: Optional[str] = None,
+                   inner: Optional[AsyncContextManager[Any]] = None) -> AsyncIterator[None]:
+        """Hold one admitted LLM call for user_id (None: background work, global limits only).
+
+        inner (e.g. a PriorityScheduler lane slot) is entered once the user's rate and
+        concurrency limits let the call through, and before the global concurrency limit
+        is taken, so a call waiting for its lane holds no global slot.
+        """
+        started = time.monotonic()
+        deadline = started + self.max_wait
+        user = self._user(user_id) if user_id else None
+        wait = self._admissible(user, started)
+
+        self._bucket.reserve(started)
+        if user:
+            user.bucket.reserve(started)
+            user.waiting += 1
+        self.queued += 1
+        acquired = []
+        inner_stack = AsyncExitStack()
+        try:
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if user:
+                await self._acquire(user.semaphore, deadline, "user_timeout")
+                acquired.append(user.semaphore)
+            if inner is not None:
+                await inner_stack.enter_async_context(inner)
+            await self._acquire(self._global, deadline, "global_timeout")
+            acquired.append(self._global)
+        except BaseException:
+            for semaphore in acquired:
+                semaphore.release()
+            await inner_stack.aclose()
+            now = time.monotonic()
+            self._bucket.refund(now)
+            if user:
+                user.bucket.refund(now)
+            raise
+        finally:
+            self.queued -= 1
+            if user:
+                user.waiting -= 1
+
+        admitted_at = time.monotonic()
+        self._recent_waits.append(admitted_at - started)
+        self.admitted += 1
+        self.active += 1
+        if user:
+            user.active += 1
+        try:
+            yield
+        finally:
+            self.active -= 1
+            if user:
+                user.active -= 1
+            for semaphore in acquired:
+                semaphore.release()
+            await inner_stack.aclose()
+            self._recent_holds.append(time.monotonic() - admitted_at)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._recent_waits)
+
+        def pct(p: float) -> Optional[float]:
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 2) if waits else None
+
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "rejected_total": sum(self.rejected.values()),
+            "users_tracked": len(self._users),
+            "users_active": sum(1 for state in self._users.values() if state.active),
+            "limits": {
+                "global_concurrency": self.global_concurrency,
+                "global_rate_per_sec": self._bucket.rate or None,
+                "user_concurrency": self.user_concurrency,
+                "user_rate_per_sec": self.user_rate or None,
+                "max_queue": self.max_queue,
+                "max_user_queue": self.max_user_queue,
+                "max_wait_seconds": self.max_wait
+            },
+            "wait_ms": {
+                "avg": round(sum(waits) / len(waits) * 1000, 2) if waits else None,
+                "p95": pct(0.95),
+                "max": round(waits[-1] * 1000, 2) if waits else None
+            },
+            "avg_call_ms": round(self._retry_hint() * 1000, 2) if self._recent_holds else None
+        }
+
+
+class AdmittedLlmChat:
+    """LlmChat wrapper whose send_message / stream_message run inside an admission slot.
+    With a scheduler (a scheduling.PriorityScheduler) the call also waits for a slot in
+    its lane, between the per-user and the global limits (see AdmissionController.slot).
+    Everything else (with_model, ...) goes to the wrapped client."""
+
+    def __init__(self, chat: Any, admission: AdmissionController, user_id: Optional[str] = None,
+                 scheduler: Any = None, lane: Optional[str] = None):
+        self._chat = chat
+        self._admission = admission
+        self._user_id = user_id
+        self._scheduler = scheduler
+        self._lane = lane
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._chat, name)
+
+    def _slot(self) -> AsyncContextManager[None]:
+        lane_slot = self._scheduler.slot(self._lane) if self._scheduler is not None else None
+        return self._admission.slot(self._user_id, lane_slot)
+
+    async def send_message(self, user_message: Any) -> str:
+        async with self._slot():
+            return await self._chat.send_message(user_message)
+
+    async def stream_message(self, user_message: Any) -> AsyncIterator[str]:
+        async with self._slot():
+            async for delta in stream_reply(self._chat, user_message):
+                yield delta
@@ -7,6 +7,8 @@ from typing import Dict, List, Optional, Any
 from datetime import datetime
 from openai import AsyncOpenAI
 
+from admission import AdmissionController, AdmissionRejected
+
 client = AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
 
 # System prompts for different stages
@@ -60,8 +62,16 @@ class ChatState:
     COMPLETED = "completed"
 
 class AIChatAgent:
-    def __init__(self):
+    def __init__(self, admission: Optional[AdmissionController] = None):
         self.conversations = {}  # Store conversation states
+        self.admission = admission  # LLM admission control, set by the server
+    
+    async def _complete(self, conv: Dict, **kwargs):
+        """chat.completions.create, admitted against the conversation's user"""
+        if self.admission is None:
+            return await client.chat.completions.create(**kwargs)
+        async with self.admission.slot(conv.get("user_id")):
+            return await client.chat.completions.create(**kwargs)
         
     async def process_message(
         self,
@@ -92,6 +102,7 @@ class AIChatAgent:
         # Get or create conversation state
         if conversation_id not in self.conversations:
             self.conversations[conversation_id] = {
+                "user_id": user_id,
                 "state": ChatState.INTENT_UNDERSTANDING,
                 "history": [],
                 "data": {}
@@ -101,23 +112,28 @@ class AIChatAgent:
         conv["history"].append({"role": "user", "content": message})
         
         # Route to appropriate handler based on state
-        if image_url and "feedback" in message.lower():
-            # Feedback learning mode
-            result = await self._handle_feedback_learning(
-                conv, message, image_url, context
-            )
-        elif conv["state"] == ChatState.INTENT_UNDERSTANDING:
-            result = await self._handle_intent_understanding(
-                conv, message, context
-            )
-        elif conv["state"] == ChatState.ALERT_LEVEL_SELECTION:
-            result = await self._handle_alert_level(
-                conv, message
-            )
-        else:
-            result = await self._handle_general_chat(
-                conv, message
-            )
+        try:
+            if image_url and "feedback" in message.lower():
+                # Feedback learning mode
+                result = await self._handle_feedback_learning(
+                    conv, message, image_url, context
+                )
+            elif conv["state"] == ChatState.INTENT_UNDERSTANDING:
+                result = await self._handle_intent_understanding(
+                    conv, message, context
+                )
+            elif conv["state"] == ChatState.ALERT_LEVEL_SELECTION:
+                result = await self._handle_alert_level(
+                    conv, message
+                )
+            else:
+                result = await self._handle_general_chat(
+                    conv, message
+                )
+        except AdmissionRejected:
+            # Not processed; the client retries the same message later
+            conv["history"].pop()
+            raise
         
         conv["history"].append({"role": "assistant", "content": result["message"]})
         
@@ -153,7 +169,8 @@ class AIChatAgent:
             *conv["history"]
         ]
         
-        response = await client.chat.completions.create(
+        response = await self._complete(
+            conv,
             model="gpt-4o",
             messages=messages,
             temperature=0.7
@@ -225,7 +242,8 @@ class AIChatAgent:
             }
         ]
         
-        response = await client.chat.completions.create(
+        response = await self._complete(
+            conv,
             model="gpt-4o",
             messages=messages,
             temperature=0.7
@@ -258,7 +276,8 @@ class AIChatAgent:
             *conv["history"]
         ]
         
-        response = await client.chat.completions.create(
+        response = await self._complete(
+            conv,
             model="gpt-4o",
             messages=messages,
             temperature=0.7
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Chat intent classification micro-benchmark
+
+Times intents.IntentMatcher.classify against the per-message scans it replaced
+(about 20 regex searches plus keyword any() scans on every /api/chat/send) over a
+corpus of ordinary chat messages and commands. Reports per-message cost and how
+often each version would have entered the LLM backed prompt-fix path, and saves the
+results as JSON so runs can be compared across versions.
+
+    python bench_intents.py --iterations 20000 --output intents.json
+"""
+import argparse
+import json
+import platform
+import re
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+ROOT_DIR = Path(__file__).parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from intents import IntentMatcher  # noqa: E402
+
+# Mostly everyday messages, like real traffic, with a few commands mixed in
+CORPUS = [
+    "hi, how are you today?",
+    "is anyone at the front door",
+    "what happened in the living room this morning",
+    "show me the last clip from the garage",
+    "thanks, that's great",
+    "how long was the dog outside?",
+    "can you summarize today's events for me",
+    "It was a quiet night, right?",
+    "What's wrong with the fridge? It is making noise",
+    "I should have checked the backyard camera earlier",
+    "the kids come home at 4pm, let me know when they arrive",
+    "ok",
+    "please monitor the driveway for cars after midnight",
+    "watch for packages left at the door",
+    "that alert was wrong, it was just the cat",
+    "false alarm again, the motion was a tree branch",
+    "act as a security guard",
+    "your new instructions are to only report people",
+    "go back to default",
+    "מה קורה בבית?",
+]
+
+_LEGACY_FEEDBACK = ["wrong", "mistake", "incorrect", "should have", "shouldn't", "misclassified",
+                    "false positive", "false alarm", "it was"]
+_LEGACY_CAMERA = [r"monitor for\s+(.+)$", r"update camera prompt to\s+(.+)$", r"update prompt to\s+(.+)$",
+                  r"please monitor\s+(.+)$", r"look for\s+(.+)$", r"watch for\s+(.+)$"]
+_LEGACY_ROLE = [r"change your role to (.+)", r"act as (.+)", r"you are now (.+)", r"become (.+)",
+                r"your new role is (.+)", r"switch to (.+) mode", r"be a (.+)"]
+_LEGACY_INSTRUCTIONS = [r"change your instructions to (.+)", r"your new instructions are (.+)",
+                        r"follow these instructions: (.+)", r"new instructions: (.+)",
+                        r"update your instructions to (.+)"]
+_LEGACY_RESET = [r"reset your role", r"go back to default", r"reset to original", r"default mode",
+                 r"reset instructions"]
+
+
+def legacy_classify(message: str) -> Dict[str, Any]:
+    """The scans parse_camera_prompt_text and parse_role_change_command used to run per message"""
+    text = (message or '').strip()
+    lowered = text.lower()
+
+    instructions = None
+    for pattern in _LEGACY_CAMERA:
+        match = re.search(pattern, lowered)
+        if match:
+            instructions = match.group(1).strip()
+            break
+    if not instructions and any(kw in lowered for kw in ["prompt", "monitor", "watch for", "look for"]):
+        instructions = text
+
+    prompt_fix = any(k in lowered for k in _LEGACY_FEEDBACK) and len(lowered.split()) > 3
+    command = None
+    for kind, patterns in (("role_change", _LEGACY_ROLE), ("instruction_change", _LEGACY_INSTRUCTIONS)):
+        for pattern in patterns:
+            match = re.search(pattern, lowered)
+            if match:
+                command = (kind, match.group(1).strip())
+                break
+        if command:
+            break
+    if not command and any(re.search(pattern, lowered) for pattern in _LEGACY_RESET):
+        command = ("reset", None)
+    return {"camera_prompt": instructions, "prompt_fix": prompt_fix, "command": command}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def time_per_message(classify: Callable[[str], Any], messages: List[str], iterations: int, repeats: int) -> float:
+    """Best-of-repeats mean cost of one classification, in microseconds"""
+    best = float('inf')
+    for _ in range(repeats):
+        started = time.perf_counter()
+        for i in range(iterations):
+            classify(messages[i % len(messages)])
+        best = min(best, time.perf_counter() - started)
+    return best / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat intent classification micro-benchmark")
+    parser.add_argument('--iterations', type=int, default=20000, help="messages classified per timing run")
+    parser.add_argument('--repeats', type=int, default=5, help="timing runs (the fastest is reported)")
+    parser.add_argument('--output', help="write the results JSON here")
+    args = parser.parse_args()
+
+    matcher = IntentMatcher()
+    plain = [m for m in CORPUS if not matcher.classify(m).families]
+
+    legacy_all = time_per_message(legacy_classify, CORPUS, args.iterations, args.repeats)
+    matcher_all = time_per_message(matcher.classify, CORPUS, args.iterations, args.repeats)
+    legacy_plain = time_per_message(legacy_classify, plain, args.iterations, args.repeats)
+    matcher_plain = time_per_message(matcher.classify, plain, args.iterations, args.repeats)
+
+    results = {
+        "corpus_messages": len(CORPUS),
+        "plain_messages": len(plain),
+        "us_per_message": {
+            "legacy_all": round(legacy_all, 3),
+            "matcher_all": round(matcher_all, 3),
+            "legacy_plain": round(legacy_plain, 3),
+            "matcher_plain": round(matcher_plain, 3)
+        },
+        "speedup": {
+            "all": round(legacy_all / matcher_all, 2) if matcher_all else None,
+            "plain": round(legacy_plain / matcher_plain, 2) if matcher_plain else None
+        },
+        "prompt_fix_triggers": {
+            "legacy": [m for m in CORPUS if legacy_classify(m)["prompt_fix"]],
+            "matcher": [m for m in CORPUS if matcher.classify(m).prompt_fix]
+        }
+    }
+    report = {
+        "benchmark": "intents",
+        "timestamp": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "results": results
+    }
+
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
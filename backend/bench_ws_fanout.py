@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+WebSocket fan-out load benchmark
+
+Starts the app in-process (uvicorn on a background thread) against an in-memory
+Mongo stand-in (mongomock-motor) and the stub LLM, opens N concurrent sockets and
+drives events through /api/simulate/device-notification. Reports p50/p99 delivery
+latency, throughput and process RSS, and saves the results as JSON so runs can be
+compared across versions.
+
+    pip install mongomock-motor websockets
+    python bench_ws_fanout.py --sockets 2000 --sockets-per-user 2 --events 5000 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+ROOT_DIR = Path(__file__).parent
+
+# The app reads its settings at import time, so these must be in place before `import server`
+os.environ.setdefault('MONGO_URL', 'mongodb://localhost:27017')
+os.environ.setdefault('DB_NAME', 'ws_bench')
+os.environ.setdefault('OPENAI_API_KEY', 'sk-bench')
+os.environ['LLM_PROVIDER'] = 'stub'
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def current_rss_mb() -> float:
+    """Resident set size of this process (server and clients share it)"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        # Not Linux: fall back to the peak, which ru_maxrss reports in KB (bytes on macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def raise_fd_limit():
+    """Every socket costs two file descriptors in-process (client and server end)"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class InProcessServer:
+    """Runs the FastAPI app under uvicorn on its own thread and event loop"""
+
+    def __init__(self, port: int):
+        import uvicorn
+        import mongomock_motor
+
+        sys.path.insert(0, str(ROOT_DIR))
+        import server
+
+        # Per-event INFO logging would dominate the measurement
+        logging.getLogger().setLevel(logging.WARNING)
+        # Swap the real Mongo client for an in-memory one before startup hooks run
+        server.client = mongomock_motor.AsyncMongoMockClient()
+        server.db = server.client[os.environ['DB_NAME']]
+
+        config = uvicorn.Config(server.app, host='127.0.0.1', port=port, log_level='warning',
+                                ws_max_size=16 * 1024 * 1024, backlog=4096)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self, timeout: float = 30.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("Server did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+class BenchClient:
+    """One WebSocket, recording the delivery latency of every bench event it receives"""
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.latencies: List[float] = []
+        self.received = 0
+        self.ws = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def connect(self, url: str):
+        import websockets
+
+        self.ws = await websockets.connect(f"{url}/ws/{self.user_id}", max_size=None, ping_interval=None)
+        self.task = asyncio.create_task(self._read())
+
+    def _record(self, event: Dict[str, Any]):
+        content = event.get('content') or ''
+        if event.get('device_id') != 'bench-device' or not content.startswith('bench '):
+            return
+        sent_at = float(content.split(' ')[2])
+        self.latencies.append(time.perf_counter() - sent_at)
+        self.received += 1
+
+    async def _read(self):
+        try:
+            async for raw in self.ws:
+                message = json.loads(raw)
+                if message.get('type') == 'batch':
+                    for event in message.get('events', []):
+                        self._record(event)
+                else:
+                    self._record(message)
+        except Exception:
+            pass
+
+    async def close(self):
+        if self.ws is not None:
+            await self.ws.close()
+        if self.task:
+            self.task.cancel()
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    import httpx
+
+    port = free_port()
+    app_server = InProcessServer(port)
+    app_server.start()
+    http_url = f"http://127.0.0.1:{port}"
+    ws_url = f"ws://127.0.0.1:{port}"
+
+    users = [f"bench-user-{i}" for i in range(max(1, args.sockets // args.sockets_per_user))]
+    clients = [BenchClient(users[i % len(users)]) for i in range(args.sockets)]
+
+    rss_before = current_rss_mb()
+    connect_started = time.perf_counter()
+    connect_gate = asyncio.Semaphore(args.connect_concurrency)
+
+    async def open_socket(client: BenchClient):
+        async with connect_gate:
+            await client.connect(ws_url)
+
+    results = await asyncio.gather(*(open_socket(c) for c in clients), return_exceptions=True)
+    connect_seconds = time.perf_counter() - connect_started
+    connect_errors = [str(r) for r in results if isinstance(r, Exception)]
+    connected = len(clients) - len(connect_errors)
+    rss_connected = current_rss_mb()
+    print(f"Connected {connected}/{len(clients)} sockets in {connect_seconds:.2f}s")
+
+    # Each event goes to one user and fans out to all of that user's sockets
+    sockets_by_user: Dict[str, int] = {}
+    for client, result in zip(clients, results):
+        if not isinstance(result, Exception):
+            sockets_by_user[client.user_id] = sockets_by_user.get(client.user_id, 0) + 1
+    expected = sum(sockets_by_user.get(users[i % len(users)], 0) for i in range(args.events))
+
+    post_latencies: List[float] = []
+    post_errors = 0
+    send_gate = asyncio.Semaphore(args.concurrency)
+    interval = 1.0 / args.rate if args.rate else 0.0
+
+    async with httpx.AsyncClient(base_url=http_url, timeout=30.0,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as http:
+        async def send_event(i: int):
+            nonlocal post_errors
+            async with send_gate:
+                started = time.perf_counter()
+                try:
+                    response = await http.post('/api/simulate/device-notification', params={
+                        'user_id': users[i % len(users)],
+                        'device_id': 'bench-device',
+                        'message': f"bench {i} {started!r}",
+                        'notification_type': args.notification_type
+                    })
+                    response.raise_for_status()
+                except Exception:
+                    post_errors += 1
+                post_latencies.append(time.perf_counter() - started)
+
+        drive_started = time.perf_counter()
+        tasks = []
+        for i in range(args.events):
+            tasks.append(asyncio.create_task(send_event(i)))
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+        drive_seconds = time.perf_counter() - drive_started
+
+        # Let queued frames drain before counting
+        deadline = time.perf_counter() + args.drain_timeout
+        while sum(c.received for c in clients) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        total_seconds = time.perf_counter() - drive_started
+
+        ws_stats = (await http.get('/api/ws/stats')).json()
+
+    rss_peak = peak_rss_mb()
+    latencies = [latency for c in clients for latency in c.latencies]
+    delivered = len(latencies)
+
+    await asyncio.gather(*(c.close() for c in clients), return_exceptions=True)
+    app_server.stop()
+
+    def ms(value: Optional[float]) -> Optional[float]:
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        "sockets": {
+            "requested": len(clients),
+            "connected": connected,
+            "users": len(sockets_by_user),
+            "connect_seconds": round(connect_seconds, 3),
+            "connect_errors": connect_errors[:10]
+        },
+        "events": {
+            "sent": args.events,
+            "post_errors": post_errors,
+            "expected_deliveries": expected,
+            "delivered": delivered,
+            "lost": expected - delivered,
+            "drive_seconds": round(drive_seconds, 3),
+            "total_seconds": round(total_seconds, 3)
+        },
+        "throughput": {
+            "events_per_sec": round(args.events / drive_seconds, 1) if drive_seconds else None,
+            "deliveries_per_sec": round(delivered / total_seconds, 1) if total_seconds else None
+        },
+        "delivery_latency_ms": {
+            "p50": ms(percentile(latencies, 50)),
+            "p90": ms(percentile(latencies, 90)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(max(latencies) if latencies else None)
+        },
+        "post_latency_ms": {
+            "p50": ms(percentile(post_latencies, 50)),
+            "p99": ms(percentile(post_latencies, 99))
+        },
+        "rss_mb": {
+            "before_connect": round(rss_before, 1),
+            "connected": round(rss_connected, 1),
+            "peak": round(rss_peak, 1),
+            "per_socket_kb": round((rss_connected - rss_before) * 1024 / connected, 2) if connected else None
+        },
+        "server_ws_stats": ws_stats
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket fan-out load benchmark")
+    parser.add_argument('--sockets', type=int, default=1000, help="concurrent WebSocket clients")
+    parser.add_argument('--sockets-per-user', type=int, default=1, help="sockets sharing one user_id")
+    parser.add_argument('--events', type=int, default=2000, help="notifications to drive")
+    parser.add_argument('--concurrency', type=int, default=50, help="in-flight notification requests")
+    parser.add_argument('--rate', type=float, default=0.0, help="events per second (0 = as fast as possible)")
+    parser.add_argument('--connect-concurrency', type=int, default=200, help="sockets opened at once")
+    parser.add_argument('--notification-type', default='message',
+                        help="'message' also stores a chat message, other types only notify")
+    parser.add_argument('--drain-timeout', type=float, default=30.0, help="seconds to wait for deliveries")
+    parser.add_argument('--output', help="write the results JSON here")
+    args = parser.parse_args()
+
+    fd_limit = raise_fd_limit()
+    if args.sockets * 2 + 100 > fd_limit:
+        print(f"Warning: file descriptor limit {fd_limit} is too low for {args.sockets} sockets")
+
+    results = asyncio.run(run_benchmark(args))
+    report = {
+        "benchmark": "ws_fanout",
+        "timestamp": datetime.utcnow().isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "settings": {key: os.environ.get(key) for key in (
+            'WS_BROKER', 'WS_SEND_QUEUE_SIZE', 'WS_SLOW_CONSUMER_POLICY',
+            'WS_BATCH_WINDOW_MS', 'NOTIFICATION_BATCH_WINDOW_MS'
+        )},
+        "results": results
+    }
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
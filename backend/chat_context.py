@@ -0,0 +1,166 @@
+"""
+Token-budgeted conversation context for device chats, with a rolling summary of older turns
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+_encoding = None
+_encoding_loaded = False
+
+
+def count_tokens(text: str) -> int:
+    """Token count with tiktoken when its encoding is available, otherwise ~4 chars per token"""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # Not installed, or the encoding can't be downloaded (offline)
+            _encoding = None
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Character cut sized from the estimate, then trimmed until it fits
+    cut = text[:max_tokens * 4]
+    while cut and count_tokens(cut) > max_tokens:
+        cut = cut[:int(len(cut) * 0.9)]
+    return cut + " …"
+
+
+def format_turn(entry: Dict[str, Any]) -> str:
+    return f"[{entry.get('sender', 'user')}]: {entry.get('message', '')}"
+
+
+class ChatContextBuilder:
+    """Fits a device conversation into a fixed prompt budget.
+
+    The prompt gets the device's rolling summary plus as many of the newest turns
+    (not yet covered by the summary) as fit in budget_tokens. Turns older than the
+    last keep_recent entries are folded into the summary in the background, once
+    summary_batch of them have piled up, so the summary is refreshed incrementally
+    and the prompt stays the same size however long the conversation runs.
+    """
+
+    def __init__(self, collection: Callable[[], Any], load_history: Callable[..., Any],
+                 summarizer: Callable[[str, List[Dict[str, Any]], int], Any],
+                 budget_tokens: int = 1500, summary_tokens: int = 300, keep_recent: int = 12,
+                 summary_batch: int = 10, history_window: int = 200):
+        self._collection = collection
+        self.load_history = load_history
+        self.summarizer = summarizer
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.keep_recent = keep_recent
+        self.summary_batch = summary_batch
+        self.history_window = history_window
+        self.refreshes = 0
+        self.refresh_failures = 0
+        self._refreshing: Set[Tuple[str, str]] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def collection(self):
+        return self._collection()
+
+    async def get_summary(self, user_id: str, device_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"user_id": user_id, "device_id": device_id}, {"_id": 0})
+
+    async def build(self, user_id: str, device_id: str) -> str:
+        """Context block to put in front of the current message ("" for a new conversation)"""
+        summary_doc, history = await asyncio.gather(
+            self.get_summary(user_id, device_id),
+            self.load_history(user_id, device_id, self.history_window)
+        )
+        summarized_until = (summary_doc or {}).get("summarized_until") or ""
+
+        parts = []
+        remaining = self.budget_tokens
+        if summary_doc and summary_doc.get("summary"):
+            summary = truncate_to_tokens(summary_doc["summary"], self.summary_tokens)
+            parts.append(f"Summary of the earlier conversation:\n{summary}")
+            remaining -= count_tokens(summary)
+
+        # Newest first until the budget runs out; a single long turn gets at most a quarter of it
+        per_turn = max(50, self.budget_tokens // 4)
+        turns: List[str] = []
+        for entry in reversed(history):
+            if summarized_until and str(entry.get("timestamp", "")) <= summarized_until:
+                break
+            line = format_turn({**entry, "message": truncate_to_tokens(str(entry.get("message", "")), per_turn)})
+            cost = count_tokens(line)
+            if cost > remaining:
+                break
+            turns.append(line)
+            remaining -= cost
+        if turns:
+            parts.append("Recent conversation:\n" + "\n".join(reversed(turns)))
+        return "\n\n".join(parts)
+
+    def schedule_refresh(self, user_id: str, device_id: str):
+        """Fold older turns into the summary in the background (at most one refresh per device)"""
+        key = (user_id, device_id)
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        task = asyncio.create_task(self._refresh(user_id, device_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, user_id: str, device_id: str):
+        try:
+            summary_doc = await self.get_summary(user_id, device_id) or {}
+            summarized_until = summary_doc.get("summarized_until") or ""
+            history = await self.load_history(user_id, device_id, self.history_window)
+            older = history[:-self.keep_recent] if self.keep_recent else history
+            pending = [e for e in older if str(e.get("timestamp", "")) > summarized_until]
+            if len(pending) < self.summary_batch:
+                return
+
+            summary = await self.summarizer(summary_doc.get("summary") or "", pending, self.summary_tokens)
+            await self.collection.update_one(
+                {"user_id": user_id, "device_id": device_id},
+                {
+                    "$set": {
+                        "summary": summary,
+                        "summarized_until": str(pending[-1].get("timestamp", "")),
+                        "updated_at": datetime.utcnow()
+                    },
+                    "$inc": {"summarized_turns": len(pending)},
+                    "$setOnInsert": {"created_at": datetime.utcnow()}
+                },
+                upsert=True
+            )
+            self.refreshes += 1
+        except Exception as e:
+            self.refresh_failures += 1
+            logging.error(f"Failed to refresh chat summary for {user_id}/{device_id}: {e}")
+        finally:
+            self._refreshing.discard((user_id, device_id))
+
+    async def clear(self, user_id: str, device_id: str):
+        await self.collection.delete_one({"user_id": user_id, "device_id": device_id})
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def build_summary_prompt(previous_summary: str, turns: List[Dict[str, Any]], max_tokens: int) -> str:
+    transcript = "\n".join(format_turn(entry) for entry in turns)
+    return (
+        f"Update the running summary of a conversation between a user and the AI assistant of one of their devices.\n"
+        f"Keep facts, instructions, decisions and open questions; drop small talk. "
+        f"Answer with the new summary only, at most {max_tokens * 3 // 4} words.\n\n"
+        f"Current summary:\n{previous_summary or '(none yet)'}\n\n"
+        f"New messages:\n{transcript}"
+    )
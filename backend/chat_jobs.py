@@ -0,0 +1,166 @@
+"""
+Asynchronous chat jobs: AI replies produced by a bounded in-process worker pool, with job
+state kept in Mongo so any worker can answer a poll
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+
+class ChatJobQueue:
+    """Runs chat jobs on `workers` background tasks, queuing at most `max_pending` of them.
+
+    Callers reserve() a place before doing any work for a job, so a full queue is refused
+    up front instead of after the user message has been stored. Job documents (status,
+    result, timings) live in the collection until retention_hours after they finish.
+    """
+
+    def __init__(self, collection: Callable[[], Any], workers: int = 8, max_pending: int = 200,
+                 retention_hours: float = 24.0):
+        self._collection = collection
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retention = timedelta(hours=retention_hours)
+        self._queue: "asyncio.Queue[Tuple[str, Callable[[], Awaitable[Any]], float]]" = asyncio.Queue()
+        self._reserved = 0
+        self._tasks: List[asyncio.Task] = []
+        self._started_at: Optional[float] = None
+        self._busy: Set[str] = set()
+        self._busy_seconds = 0.0
+        self._recent_waits: Deque[float] = deque(maxlen=500)
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    @property
+    def collection(self):
+        return self._collection()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    async def ensure_indexes(self):
+        await self.collection.create_index("id", unique=True)
+        await self.collection.create_index("expire_at", expireAfterSeconds=0)
+
+    def start(self):
+        if self._tasks:
+            return
+        self._started_at = time.monotonic()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Jobs still queued will never run on this worker; say so rather than leave them "queued"
+        abandoned = []
+        while not self._queue.empty():
+            abandoned.append(self._queue.get_nowait()[0])
+        if abandoned:
+            await self._finish_many(abandoned, "failed", error="Server shut down before the job ran")
+
+    def reserve(self) -> bool:
+        """Claim a queue place for a job about to be submitted. False when the queue is full."""
+        if self.depth + self._reserved >= self.max_pending:
+            self.rejected += 1
+            return False
+        self._reserved += 1
+        return True
+
+    def release(self):
+        """Give back a reservation that won't be submitted"""
+        self._reserved = max(0, self._reserved - 1)
+
+    async def submit(self, job_id: str, run: Callable[[], Awaitable[Any]], **fields) -> Dict[str, Any]:
+        """Record the job and queue run() on a reserved place; run()'s return value becomes the result"""
+        now = datetime.utcnow()
+        job = {
+            "id": job_id,
+            "status": "queued",
+            "result": None,
+            "error": None,
+            "created_at": now,
+            "started_at": None,
+            "completed_at": None,
+            "expire_at": now + self.retention + timedelta(hours=1),
+            **fields
+        }
+        try:
+            await self.collection.insert_one(dict(job))
+        finally:
+            self.release()
+        self._queue.put_nowait((job_id, run, time.monotonic()))
+        self.submitted += 1
+        return job
+
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return await self.collection.find_one({"id": job_id}, {"_id": 0})
+
+    async def _worker(self, index: int):
+        while True:
+            job_id, run, queued_at = await self._queue.get()
+            started = time.monotonic()
+            self._recent_waits.append(started - queued_at)
+            self._busy.add(job_id)
+            try:
+                await self.collection.update_one(
+                    {"id": job_id},
+                    {"$set": {"status": "running", "started_at": datetime.utcnow(), "queue_wait_ms": round((started - queued_at) * 1000, 2)}}
+                )
+                result = await run()
+                await self._finish_many([job_id], "done", result=result)
+                self.completed += 1
+            except asyncio.CancelledError:
+                await asyncio.shield(self._finish_many([job_id], "failed", error="Server shut down while the job was running"))
+                raise
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Chat job {job_id} failed: {e}")
+                try:
+                    await self._finish_many([job_id], "failed", error=getattr(e, "detail", None) or str(e))
+                except Exception as store_error:
+                    logging.error(f"Failed to record chat job {job_id} failure: {store_error}")
+            finally:
+                self._busy.discard(job_id)
+                self._busy_seconds += time.monotonic() - started
+                self._queue.task_done()
+
+    async def _finish_many(self, job_ids: List[str], status: str, result: Any = None, error: Optional[str] = None):
+        now = datetime.utcnow()
+        await self.collection.update_many(
+            {"id": {"$in": job_ids}},
+            {"$set": {"status": status, "result": result, "error": error, "completed_at": now, "expire_at": now + self.retention}}
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._recent_waits)
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+
+        def pct(p: float) -> Optional[float]:
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000, 2) if waits else None
+
+        return {
+            "workers": self.workers,
+            "busy_workers": len(self._busy),
+            "utilization": round(len(self._busy) / self.workers, 3) if self.workers else None,
+            "avg_utilization": round(self._busy_seconds / (self.workers * uptime), 3) if uptime and self.workers else None,
+            "queue_depth": self.depth,
+            "reserved": self._reserved,
+            "max_pending": self.max_pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "wait_ms": {
+                "avg": round(sum(waits) / len(waits) * 1000, 2) if waits else None,
+                "p95": pct(0.95),
+                "max": round(waits[-1] * 1000, 2) if waits else None
+            }
+        }
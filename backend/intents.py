@@ -0,0 +1,164 @@
+"""
+Chat command intents (camera prompt updates, role / instruction changes, resets and
+corrective feedback) classified with precompiled patterns in a single pass
+"""
+import re
+from typing import List, Optional, Pattern, Set, Tuple
+
+# One alternation over the trigger words of every intent family. A message that hits
+# none of them (most chat messages) is classified by this single scan; only the
+# families that were hit run their argument-extracting patterns. Every trigger starts
+# a word, so the shared \b is tested once per position rather than once per branch.
+_TRIGGERS: List[Tuple[str, str]] = [
+    ("camera", r"monitor|prompt|look for\b|watch for\b"),
+    ("role", r"role\b|act as\b|you are now\b|become\b|switch to\b|be a\b"),
+    ("instructions", r"instructions\b"),
+    ("reset", r"reset\b|default\b"),
+    ("feedback", r"wrong|mistake|incorrect|misclassified\b|false (?:positive|alarm)|should(?: have|n't|nt)\b|it was\b"),
+]
+_SCAN = re.compile(r"\b(?:" + "|".join(f"(?P<{family}>{pattern})" for family, pattern in _TRIGGERS) + ")")
+
+# Checked in this order; the first match wins (as in the original per-pattern scans)
+_CAMERA_PATTERNS = [re.compile(p) for p in (
+    r"monitor for\s+(.+)$",
+    r"update camera prompt to\s+(.+)$",
+    r"update prompt to\s+(.+)$",
+    r"please monitor\s+(.+)$",
+    r"look for\s+(.+)$",
+    r"watch for\s+(.+)$",
+)]
+_CAMERA_KEYWORDS = re.compile(r"prompt|monitor|watch for|look for")
+
+_ROLE_PATTERNS = [re.compile(p) for p in (
+    r"\bchange your role to (.+)",
+    r"\bact as (.+)",
+    r"\byou are now (.+)",
+    r"\bbecome (.+)",
+    r"\byour new role is (.+)",
+    r"\bswitch to (.+) mode",
+    r"\bbe a (.+)",
+)]
+_INSTRUCTION_PATTERNS = [re.compile(p) for p in (
+    r"change your instructions to (.+)",
+    r"your new instructions are (.+)",
+    r"follow these instructions: (.+)",
+    r"new instructions: (.+)",
+    r"update your instructions to (.+)",
+)]
+_RESET_PATTERN = re.compile(r"reset your role|go back to default|reset to original|default mode|reset instructions")
+
+# Corrective feedback. Each cue carries a weight; words that point at an alert or the
+# AI's analysis raise it and a question lowers it, so "what's wrong with the fridge?"
+# stays a normal chat message while "that alert was wrong, it was just the cat" does not.
+_FEEDBACK_CUES: List[Tuple[Pattern, float]] = [
+    (re.compile(r"\b(?:wrong|mistaken?|incorrect|misclassified|false (?:positive|alarm))"), 0.8),
+    (re.compile(r"\bit was(?:n't| not| just| only| actually| really)\b"), 0.7),
+    (re.compile(r"\bshould(?: have|n't|nt)\b"), 0.5),
+    (re.compile(r"\bit was\b"), 0.3),
+]
+_FEEDBACK_CONTEXT = re.compile(
+    r"\b(?:alert|alarm|detect|notif|flag|report|analy[sz]|classif|"
+    r"you (?:said|thought|saw|called|marked|sent))"
+)
+
+
+class IntentMatch:
+    """One detected command: its kind, the extracted argument and how sure the matcher is"""
+
+    def __init__(self, kind: str, argument: Optional[str] = None, confidence: float = 1.0):
+        self.kind = kind
+        self.argument = argument
+        self.confidence = confidence
+
+    def __repr__(self) -> str:
+        return f"IntentMatch({self.kind!r}, {self.argument!r}, {self.confidence})"
+
+
+class ChatIntents:
+    """Everything a chat message asks for besides a normal reply"""
+
+    def __init__(self, families: Optional[Set[str]] = None, camera_prompt: Optional[str] = None,
+                 prompt_fix: Optional[IntentMatch] = None, settings_command: Optional[IntentMatch] = None):
+        self.families = families or set()
+        self.camera_prompt = camera_prompt        # new camera monitoring instructions
+        self.prompt_fix = prompt_fix              # confident corrective feedback on the camera analysis
+        self.settings_command = settings_command  # role_change / instruction_change / reset
+
+    @property
+    def has_settings_intent(self) -> bool:
+        return self.prompt_fix is not None or self.settings_command is not None
+
+
+class IntentMatcher:
+    """Classifies chat messages into command intents with precompiled patterns.
+
+    prompt_fix_confidence is the score corrective feedback needs before the (LLM backed)
+    camera prompt fix is attempted.
+    """
+
+    def __init__(self, prompt_fix_confidence: float = 0.7):
+        self.prompt_fix_confidence = prompt_fix_confidence
+
+    @staticmethod
+    def scan(lowered: str) -> Set[str]:
+        """Intent families whose trigger words occur in the (lowercased) message"""
+        return {match.lastgroup for match in _SCAN.finditer(lowered)}
+
+    def classify(self, message: str) -> ChatIntents:
+        text = (message or "").strip()
+        lowered = text.lower()
+        families = self.scan(lowered)
+        if not families:
+            return ChatIntents()
+
+        return ChatIntents(
+            families=families,
+            camera_prompt=self.camera_prompt(text, lowered) if "camera" in families else None,
+            prompt_fix=self.prompt_fix(lowered) if "feedback" in families else None,
+            settings_command=self.settings_command(lowered, families)
+        )
+
+    @staticmethod
+    def camera_prompt(text: str, lowered: str) -> Optional[str]:
+        for pattern in _CAMERA_PATTERNS:
+            match = pattern.search(lowered)
+            if match:
+                return match.group(1).strip()
+        # Fallback: if intent words exist, use the whole message as instructions
+        if _CAMERA_KEYWORDS.search(lowered):
+            return text
+        return None
+
+    def feedback_confidence(self, lowered: str) -> float:
+        if len(lowered.split()) <= 3:
+            return 0.0
+        score = max((weight for pattern, weight in _FEEDBACK_CUES if pattern.search(lowered)), default=0.0)
+        if not score:
+            return 0.0
+        if _FEEDBACK_CONTEXT.search(lowered):
+            score += 0.4
+        if "?" in lowered:
+            score -= 0.3
+        return round(min(score, 1.0), 2)
+
+    def prompt_fix(self, lowered: str) -> Optional[IntentMatch]:
+        confidence = self.feedback_confidence(lowered)
+        if confidence < self.prompt_fix_confidence:
+            return None
+        return IntentMatch("prompt_fix", confidence=confidence)
+
+    @staticmethod
+    def settings_command(lowered: str, families: Set[str]) -> Optional[IntentMatch]:
+        if "role" in families:
+            for pattern in _ROLE_PATTERNS:
+                match = pattern.search(lowered)
+                if match:
+                    return IntentMatch("role_change", match.group(1).strip())
+        if "instructions" in families:
+            for pattern in _INSTRUCTION_PATTERNS:
+                match = pattern.search(lowered)
+                if match:
+                    return IntentMatch("instruction_change", match.group(1).strip())
+        if "reset" in families and _RESET_PATTERN.search(lowered):
+            return IntentMatch("reset")
+        return None
@@ -0,0 +1,240 @@
+"""
+LLM response cache: in-memory LRU with an optional Mongo second tier
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from llm_clients import stream_reply
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(text: str) -> str:
+    return _WHITESPACE.sub(" ", text or "").strip()
+
+
+def content_hashes(file_contents: Optional[List[Any]]) -> List[str]:
+    """SHA-256 of each attachment's bytes (decoded images), so identical frames share a key"""
+    hashes = []
+    for content in file_contents or []:
+        image_base64 = getattr(content, "image_base64", None)
+        if image_base64:
+            try:
+                raw = base64.b64decode(image_base64)
+            except (ValueError, TypeError):
+                raw = image_base64.encode("utf-8")
+        else:
+            raw = repr(sorted(vars(content).items()) if hasattr(content, "__dict__") else content).encode("utf-8")
+        hashes.append(hashlib.sha256(raw).hexdigest())
+    return hashes
+
+
+class LlmResponseCache:
+    """Replies keyed by scope (the device) + model + system message + normalized prompt + attachment hashes.
+
+    The LRU answers repeats within this worker; with a collection configured, misses
+    fall through to Mongo so workers share replies and they survive restarts. Entries
+    expire after ttl seconds in both tiers. Concurrent identical requests wait for the
+    first one's reply instead of each calling the model.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0,
+                 collection: Optional[Callable[[], Any]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._collection = collection
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    @staticmethod
+    def key(model: str, system_message: str, prompt: str, file_contents: Optional[List[Any]] = None,
+            scope: str = "") -> str:
+        digest = hashlib.sha256()
+        for part in (scope or "", model or "", system_message or "", normalize_prompt(prompt),
+                     *content_hashes(file_contents)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    async def ensure_indexes(self):
+        if self._collection:
+            await self._collection().create_index("key", unique=True)
+            await self._collection().create_index("expires_at", expireAfterSeconds=0)
+
+    def _get_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _put_memory(self, key: str, value: str, ttl: Optional[float] = None):
+        self._entries[key] = (value, time.monotonic() + (ttl if ttl is not None else self.ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self._get_memory(key)
+        if value is not None:
+            self.memory_hits += 1
+            return value
+        if self._collection:
+            try:
+                doc = await self._collection().find_one({"key": key, "expires_at": {"$gt": datetime.utcnow()}})
+            except Exception as e:
+                logging.warning(f"LLM cache lookup failed: {e}")
+                doc = None
+            if doc:
+                self.mongo_hits += 1
+                remaining = (doc["expires_at"] - datetime.utcnow()).total_seconds()
+                self._put_memory(key, doc["response"], remaining)
+                return doc["response"]
+        return None
+
+    async def set(self, key: str, value: str):
+        self._put_memory(key, value)
+        if self._collection:
+            now = datetime.utcnow()
+            try:
+                await self._collection().update_one(
+                    {"key": key},
+                    {"$set": {"response": value, "created_at": now, "expires_at": now + timedelta(seconds=self.ttl)}},
+                    upsert=True
+                )
+            except Exception as e:
+                logging.warning(f"LLM cache store failed: {e}")
+
+    async def lookup(self, key: str, bypass: bool = False) -> Optional[str]:
+        """Cached reply for key, counting the lookup as a hit, miss or bypass"""
+        if not self.enabled or bypass:
+            self.bypassed += 1
+            return None
+        cached = await self.get(key)
+        if cached is None:
+            self.misses += 1
+        return cached
+
+    async def get_or_call(self, key: str, call: Callable[[], Awaitable[str]], bypass: bool = False) -> str:
+        """Cached reply for key, or the result of call() (which is then cached)"""
+        if not self.enabled or bypass:
+            self.bypassed += 1
+            return await call()
+
+        cached = await self.get(key)
+        if cached is not None:
+            return cached
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.memory_hits += 1
+            return await asyncio.shield(pending)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await call()
+            if isinstance(value, str) and value:
+                await self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Nobody may be waiting on it; don't log "exception never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.mongo_hits
+        lookups = hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "mongo_tier": self._collection is not None,
+            "memory_hits": self.memory_hits,
+            "mongo_hits": self.mongo_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "hit_rate": round(hits / lookups, 4) if lookups else None
+        }
+
+
+class CachedLlmChat:
+    """LlmChat wrapper whose send_message / stream_message answer repeats from the cache.
+    Everything else (with_model, ...) goes to the wrapped client.
+
+    context is the rolling conversation context the caller puts in front of the prompt. It
+    changes with every turn, so it is left out of the key: a repeated question to the same
+    scope (device) is answered from the cache whatever history precedes it.
+    """
+
+    def __init__(self, chat: Any, cache: LlmResponseCache, model: str, system_message: str, bypass: bool = False,
+                 scope: str = "", context: str = ""):
+        self._chat = chat
+        self._cache = cache
+        self._model = model
+        self._system_message = system_message
+        self._bypass = bypass
+        self._scope = scope
+        self._context = context
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._chat, name)
+
+    def _key(self, user_message: Any) -> str:
+        text = getattr(user_message, "text", "") or ""
+        if self._context and text.startswith(self._context):
+            text = text[len(self._context):]
+        return self._cache.key(
+            self._model,
+            self._system_message,
+            text,
+            getattr(user_message, "file_contents", None),
+            self._scope
+        )
+
+    async def send_message(self, user_message: Any) -> str:
+        return await self._cache.get_or_call(self._key(user_message), lambda: self._chat.send_message(user_message), self._bypass)
+
+    async def stream_message(self, user_message: Any) -> AsyncIterator[str]:
+        """A cached reply comes back as one chunk; otherwise the wrapped client's stream,
+        stored once it completes"""
+        key = self._key(user_message)
+        cached = await self._cache.lookup(key, self._bypass)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        async for delta in stream_reply(self._chat, user_message):
+            parts.append(delta)
+            yield delta
+        reply = "".join(parts)
+        if reply and self._cache.enabled and not self._bypass:
+            await self._cache.set(key, reply)
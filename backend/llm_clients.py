@@ -0,0 +1,218 @@
+"""
+LLM chat clients with token streaming: stateless OpenAI-backed clients and an offline stub,
+plus an LRU pool that reuses ready clients per chat session
+"""
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from openai import AsyncOpenAI
+
+_openai_client: Optional[AsyncOpenAI] = None
+
+
+def get_openai_client() -> AsyncOpenAI:
+    """Shared AsyncOpenAI client so every call reuses one HTTP connection pool"""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = AsyncOpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    return _openai_client
+
+
+def build_openai_content(user_message: Any) -> Any:
+    """Turn an emergentintegrations UserMessage into OpenAI chat content (text plus inline images)"""
+    text = getattr(user_message, 'text', None) or ''
+    images = [f for f in (getattr(user_message, 'file_contents', None) or []) if getattr(f, 'image_base64', None)]
+    if not images:
+        return text
+    content: List[Dict[str, Any]] = [{"type": "text", "text": text}]
+    for image in images:
+        content.append({
+            "type": "image_url",
+            "image_url": {"url": f"data:image/jpeg;base64,{image.image_base64}"}
+        })
+    return content
+
+
+class OpenAiLlmChat:
+    """Drop-in for LlmChat (with_model/send_message) on the shared AsyncOpenAI client"""
+
+    # Sends only the system message and the given prompt, so one instance can serve any
+    # number of calls (LlmChat instead keeps the conversation and resends it every turn)
+    stateless = True
+
+    def __init__(self, api_key: Optional[str] = None, session_id: Optional[str] = None, system_message: str = ""):
+        self.api_key = api_key
+        self.session_id = session_id
+        self.system_message = system_message
+        self.model = "gpt-4o-mini"
+
+    def with_model(self, provider: str, model: str) -> "OpenAiLlmChat":
+        self.model = model
+        return self
+
+    def _messages(self, user_message: Any) -> List[Dict[str, Any]]:
+        return [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": build_openai_content(user_message)}
+        ]
+
+    async def send_message(self, user_message: Any) -> str:
+        completion = await get_openai_client().chat.completions.create(
+            model=self.model,
+            messages=self._messages(user_message)
+        )
+        if not completion.choices:
+            return ""
+        return completion.choices[0].message.content or ""
+
+
+class StreamingLlmChat(OpenAiLlmChat):
+    """OpenAiLlmChat that can also stream the reply"""
+
+    async def stream_message(self, user_message: Any) -> AsyncIterator[str]:
+        stream = await get_openai_client().chat.completions.create(
+            model=self.model,
+            messages=self._messages(user_message),
+            stream=True
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class StubLlmChat:
+    """Offline stand-in used when LLM_PROVIDER=stub; yields a canned reply word by word"""
+
+    stateless = True
+
+    def __init__(self, api_key: Optional[str] = None, session_id: Optional[str] = None, system_message: str = "",
+                 chunk_delay: Optional[float] = None):
+        self.session_id = session_id
+        self.system_message = system_message
+        self.model = "stub"
+        self.chunk_delay = chunk_delay if chunk_delay is not None else float(os.environ.get('LLM_STUB_CHUNK_DELAY', '0.01'))
+
+    def with_model(self, provider: str, model: str) -> "StubLlmChat":
+        self.model = model
+        return self
+
+    async def stream_message(self, user_message: Any) -> AsyncIterator[str]:
+        text = (getattr(user_message, 'text', None) or '').strip().splitlines() or ['']
+        reply = f"[{self.model}] You said: {text[-1][:200]}"
+        for i, word in enumerate(reply.split(' ')):
+            await asyncio.sleep(self.chunk_delay)
+            yield word if i == 0 else ' ' + word
+
+    async def send_message(self, user_message: Any) -> str:
+        return "".join([delta async for delta in self.stream_message(user_message)])
+
+
+async def stream_reply(chat: Any, user_message: Any) -> AsyncIterator[str]:
+    """Yield the reply as it is generated; clients that can't stream yield it in one piece"""
+    if hasattr(chat, 'stream_message'):
+        async for delta in chat.stream_message(user_message):
+            yield delta
+    else:
+        yield await chat.send_message(user_message)
+
+
+class LlmSessionPool:
+    """Ready chat clients keyed by (session_id, client class, model, system message hash),
+    plus each device's chat_settings document, so a chat message doesn't rebuild its client
+    or re-read its settings.
+
+    Only clients that keep no conversation state (a `stateless` class attribute) are
+    pooled; reusing an LlmChat would resend its whole accumulated history on every call
+    and share it between concurrent requests, so those are built fresh each time.
+
+    Both are tagged with their (user_id, device_id) owner; invalidate(owner) drops them when
+    the device's chat settings change. Cached settings also expire after settings_ttl
+    seconds, which bounds how stale another worker's copy can be.
+    """
+
+    def __init__(self, max_clients: int = 1000, settings_ttl: float = 30.0):
+        self.max_clients = max_clients
+        self.settings_ttl = settings_ttl
+        self._clients: "OrderedDict[Tuple, Tuple[Any, Optional[Hashable]]]" = OrderedDict()
+        self._settings: "OrderedDict[Hashable, Tuple[Optional[Dict[str, Any]], float]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.unpooled = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.settings_hits = 0
+        self.settings_misses = 0
+
+    @staticmethod
+    def key(session_id: str, client_class: type, model: str, system_message: str) -> Tuple:
+        digest = hashlib.sha256((system_message or "").encode("utf-8")).hexdigest()
+        return (session_id, client_class.__name__, model, digest)
+
+    @staticmethod
+    def reusable(client_class: type) -> bool:
+        return bool(getattr(client_class, "stateless", False))
+
+    def client(self, key: Tuple, factory: Callable[[], Any], owner: Optional[Hashable] = None,
+               reuse: bool = True) -> Any:
+        """The pooled client for key, built with factory() on a miss. With reuse=False (stateful
+        client classes, see reusable) a fresh instance is built every call."""
+        if self.max_clients <= 0 or not reuse:
+            self.unpooled += 1
+            return factory()
+        entry = self._clients.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._clients.move_to_end(key)
+            return entry[0]
+        self.misses += 1
+        chat = factory()
+        self._clients[key] = (chat, owner)
+        while len(self._clients) > self.max_clients:
+            self._clients.popitem(last=False)
+            self.evictions += 1
+        return chat
+
+    async def settings(self, owner: Hashable, load: Callable[[], Awaitable[Optional[Dict[str, Any]]]]) -> Optional[Dict[str, Any]]:
+        """The owner's chat settings document (None when it has none), loaded on a miss"""
+        entry = self._settings.get(owner)
+        if entry is not None and entry[1] > time.monotonic():
+            self.settings_hits += 1
+            self._settings.move_to_end(owner)
+            return entry[0]
+        self.settings_misses += 1
+        value = await load()
+        self._settings[owner] = (value, time.monotonic() + self.settings_ttl)
+        self._settings.move_to_end(owner)
+        while len(self._settings) > max(self.max_clients, 1):
+            self._settings.popitem(last=False)
+        return value
+
+    def invalidate(self, owner: Hashable) -> int:
+        """Forget the owner's settings and pooled clients. Returns how many clients were dropped."""
+        self._settings.pop(owner, None)
+        stale = [key for key, (_, client_owner) in self._clients.items() if client_owner == owner]
+        for key in stale:
+            del self._clients[key]
+        self.invalidations += 1
+        return len(stale)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._clients),
+            "max_clients": self.max_clients,
+            "hits": self.hits,
+            "misses": self.misses,
+            "unpooled": self.unpooled,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "settings_entries": len(self._settings),
+            "settings_hits": self.settings_hits,
+            "settings_misses": self.settings_misses,
+            "settings_ttl_seconds": self.settings_ttl
+        }
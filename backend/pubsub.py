@@ -0,0 +1,283 @@
+"""
+Pub/sub backends that carry user events between uvicorn workers
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional, Set
+
+# handler(user_id, message) -> bool, delivers an event to the sockets held by this worker
+DeliveryHandler = Callable[[str, Dict[str, Any]], bool]
+
+
+def now_seq() -> int:
+    """Event sequence numbers are millisecond timestamps, bumped by one on collisions"""
+    return int(time.time() * 1000)
+
+
+class Broker:
+    """Base broker: every published user event is handed to the delivery handler of every worker"""
+
+    # True when other processes may hold the user's sockets, so a publish can't report local presence
+    distributed = False
+
+    def __init__(self):
+        self._handler: Optional[DeliveryHandler] = None
+        self._last_seq: Dict[str, int] = {}  # user_id -> last sequence stamped or seen
+
+    def bind(self, handler: DeliveryHandler):
+        self._handler = handler
+
+    def _stamp(self, user_id: str, message: Dict[str, Any]) -> Dict[str, Any]:
+        """Give the event the user's next sequence number.
+
+        Sequences are time based, so they keep increasing across restarts and hub
+        failover, and a client's last_seq also tells us how far back to query the DB.
+        """
+        seq = max(now_seq(), self._last_seq.get(user_id, 0) + 1)
+        self._remember_seq(user_id, seq)
+        return {**message, "seq": seq}
+
+    def _remember_seq(self, user_id: str, seq: int):
+        if len(self._last_seq) > 10000:
+            # Only same-millisecond collisions need the history, so old entries can go
+            horizon = now_seq() - 1000
+            self._last_seq = {u: s for u, s in self._last_seq.items() if s >= horizon}
+        if seq > self._last_seq.get(user_id, 0):
+            self._last_seq[user_id] = seq
+
+    def _deliver(self, user_id: str, message: Dict[str, Any]) -> bool:
+        if "seq" in message:
+            self._remember_seq(user_id, message["seq"])
+        if not self._handler:
+            return False
+        try:
+            return self._handler(user_id, message)
+        except Exception as e:
+            logging.error(f"Broker delivery to {user_id} failed: {e}")
+            return False
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, user_id: str, message: Dict[str, Any]) -> bool:
+        """Stamp the event with the user's next seq and deliver it on every worker"""
+        raise NotImplementedError
+
+
+class InMemoryBroker(Broker):
+    """Single-process broker, delivers straight to the local handler"""
+
+    async def publish(self, user_id: str, message: Dict[str, Any]) -> bool:
+        return self._deliver(user_id, self._stamp(user_id, message))
+
+
+class LocalSocketBroker(Broker):
+    """Hub-and-spoke broker over a Unix domain socket, for several workers on one host.
+
+    The first worker to take the lock file hosts the hub; the others connect to it.
+    The hub stamps every event with its seq and relays it to all workers, including
+    the publisher. If the hub goes away a spoke re-runs the election, so one of the
+    survivors takes over.
+    """
+
+    distributed = True
+
+    def __init__(self, path: str, max_client_buffer: int = 4 * 1024 * 1024, reconnect_delay: float = 0.5):
+        super().__init__()
+        self.path = path
+        self.max_client_buffer = max_client_buffer
+        self.reconnect_delay = reconnect_delay
+        self.is_hub = False
+        self._lock_file = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: Set[asyncio.StreamWriter] = set()
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    async def start(self):
+        self._stopping = False
+        await self._elect()
+        if not self.is_hub:
+            self._task = asyncio.create_task(self._spoke_loop())
+
+    async def stop(self):
+        self._stopping = True
+        self.is_hub = False
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+        for client in list(self._clients):
+            client.close()
+        self._clients.clear()
+        if self._server:
+            self._server.close()
+        if self._lock_file:
+            self._lock_file.close()
+            self._lock_file = None
+
+    async def _elect(self):
+        """Become the hub if nobody holds the lock, otherwise stay a spoke"""
+        if self._lock_file is None:
+            self._lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.is_hub = False
+            return
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve_spoke, path=self.path)
+        self.is_hub = True
+        logging.info(f"WebSocket broker hub listening on {self.path}")
+
+    @staticmethod
+    def _encode(user_id: str, message: Dict[str, Any]) -> bytes:
+        return json.dumps({"u": user_id, "m": message}).encode("utf-8") + b"\n"
+
+    def _relay(self, frame: bytes):
+        for client in list(self._clients):
+            if client.transport.get_write_buffer_size() > self.max_client_buffer:
+                logging.warning("Dropping slow broker spoke")
+                self._clients.discard(client)
+                client.close()
+                continue
+            client.write(frame)
+
+    async def _serve_spoke(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                envelope = json.loads(line)
+                user_id = envelope["u"]
+                message = self._stamp(user_id, envelope["m"])
+                self._relay(self._encode(user_id, message))
+                self._deliver(user_id, message)
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"Broker hub error: {e}")
+        finally:
+            self._clients.discard(writer)
+            writer.close()
+
+    async def _spoke_loop(self):
+        while not self._stopping:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path)
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    envelope = json.loads(line)
+                    self._deliver(envelope["u"], envelope["m"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning(f"Broker spoke lost hub connection: {e}")
+            self._writer = None
+            if self._stopping:
+                break
+            await asyncio.sleep(self.reconnect_delay)
+            await self._elect()
+            if self.is_hub:
+                break
+
+    async def publish(self, user_id: str, message: Dict[str, Any]) -> bool:
+        if self.is_hub:
+            message = self._stamp(user_id, message)
+            self._relay(self._encode(user_id, message))
+            return self._deliver(user_id, message) or bool(self._clients)
+        if self._writer is None:
+            # Hub is unreachable (e.g. during failover), at least reach this worker's sockets
+            return self._deliver(user_id, self._stamp(user_id, message))
+        self._writer.write(self._encode(user_id, message))
+        return True
+
+
+class RedisBroker(Broker):
+    """Broker on a Redis (or Redis-protocol compatible) PUBLISH/SUBSCRIBE channel"""
+
+    distributed = True
+
+    # Atomically advance the user's seq to max(now, last + 1) so all workers agree on ordering
+    NEXT_SEQ_SCRIPT = """
+local seq = tonumber(ARGV[1])
+local last = tonumber(redis.call('GET', KEYS[1]) or '0')
+if last >= seq then seq = last + 1 end
+redis.call('SET', KEYS[1], seq, 'EX', 86400)
+return seq
+"""
+
+    def __init__(self, url: str, channel: str = "ws_events"):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._redis = None
+        self._pubsub = None
+        self._next_seq = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        import redis.asyncio as aioredis
+
+        self._redis = aioredis.from_url(self.url)
+        self._next_seq = self._redis.register_script(self.NEXT_SEQ_SCRIPT)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+        if self._pubsub:
+            await self._pubsub.close()
+        if self._redis:
+            await self._redis.close()
+
+    async def _listen(self):
+        while True:
+            try:
+                async for item in self._pubsub.listen():
+                    if item.get("type") != "message":
+                        continue
+                    envelope = json.loads(item["data"])
+                    self._deliver(envelope["u"], envelope["m"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Redis broker listener error: {e}")
+                await asyncio.sleep(1)
+
+    async def publish(self, user_id: str, message: Dict[str, Any]) -> bool:
+        if self._redis is None:
+            return self._deliver(user_id, self._stamp(user_id, message))
+        try:
+            seq = await self._next_seq(keys=[f"{self.channel}:seq:{user_id}"], args=[now_seq()])
+            message = {**message, "seq": int(seq)}
+            await self._redis.publish(self.channel, json.dumps({"u": user_id, "m": message}))
+            return True
+        except Exception as e:
+            logging.error(f"Redis publish failed, delivering locally only: {e}")
+            return self._deliver(user_id, self._stamp(user_id, message))
+
+
+def create_broker(kind: str, url: Optional[str] = None) -> Broker:
+    """Build a broker from WS_BROKER / WS_BROKER_URL style settings"""
+    kind = (kind or "memory").lower()
+    if kind == "local":
+        return LocalSocketBroker(url or "/tmp/device-chat-ws.sock")
+    if kind == "redis":
+        return RedisBroker(url or "redis://localhost:6379/0")
+    return InMemoryBroker()
@@ -0,0 +1,482 @@
+"""
+Web Push delivery: concurrent dispatch of pywebpush calls on a bounded thread pool
+(with keep-alive sessions and cached VAPID headers per push service origin), and a
+Mongo-backed outbox drained by background workers with retry and backoff
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
+from pymongo import ReturnDocument
+from pywebpush import webpush, WebPushException
+
+from scheduling import LANES, PriorityScheduler
+
+
+class PushResult:
+    """Outcome of one push to one subscription"""
+
+    def __init__(self, subscription_id: Optional[str], ok: bool, status_code: Optional[int] = None,
+                 error: Optional[str] = None, retry_after: Optional[float] = None):
+        self.subscription_id = subscription_id
+        self.ok = ok
+        self.status_code = status_code
+        self.error = error
+        self.retry_after = retry_after  # seconds, from the push service's Retry-After header
+
+    @property
+    def gone(self) -> bool:
+        """The push service says the subscription no longer exists"""
+        return self.status_code in (404, 410)
+
+    @property
+    def retryable(self) -> bool:
+        """Network errors, throttling and push service outages are worth another attempt"""
+        return self.status_code is None or self.status_code in (408, 429) or self.status_code >= 500
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delta-seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at.replace(tzinfo=None) - datetime.utcnow()).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def push_origin(endpoint: str) -> str:
+    """scheme://host of a push endpoint, which is also the VAPID audience"""
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+class VapidHeaderCache:
+    """Signed VAPID Authorization headers per (key, subject, audience).
+
+    A VAPID JWT stays valid for up to 24 hours, so signing one per push is wasted
+    ECDSA work. Headers are signed with a 12 hour expiry and reused until
+    refresh_margin seconds before they run out.
+    """
+
+    def __init__(self, lifetime: int = 12 * 60 * 60, refresh_margin: int = 10 * 60):
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        self.hits = 0
+        self.misses = 0
+        self._keys: Dict[str, Vapid] = {}
+        self._headers: Dict[Tuple[str, str, str], Tuple[Dict[str, str], int]] = {}
+        self._lock = threading.Lock()
+
+    def _vapid(self, private_key: str) -> Vapid:
+        """VAPID_PRIVATE_KEY is the key itself or, as pywebpush also accepts, a path to a PEM/DER key file"""
+        vapid = self._keys.get(private_key)
+        if vapid is None:
+            if os.path.isfile(private_key):
+                vapid = Vapid.from_file(private_key_file=private_key)
+            else:
+                vapid = Vapid.from_string(private_key=private_key)
+            self._keys[private_key] = vapid
+        return vapid
+
+    def get(self, private_key: str, claims: Dict[str, Any], audience: str) -> Dict[str, str]:
+        key = (private_key, claims.get("sub", ""), audience)
+        now = int(time.time())
+        with self._lock:
+            cached = self._headers.get(key)
+            if cached and cached[1] - now > self.refresh_margin:
+                self.hits += 1
+                return dict(cached[0])
+            self.misses += 1
+            expires = now + self.lifetime
+            headers = self._vapid(private_key).sign({**claims, "aud": audience, "exp": expires})
+            self._headers[key] = (headers, expires)
+            return dict(headers)
+
+
+class PushDispatcher:
+    """Runs the blocking pywebpush calls on a thread pool so the event loop never waits on
+    a push service round-trip. max_workers bounds how many pushes are in flight at once.
+
+    Pushes go to a handful of origins (FCM, Mozilla, Apple), so each origin gets one
+    keep-alive requests.Session and the TLS connections are reused across pushes.
+    """
+
+    def __init__(self, max_workers: int = 16, timeout: float = 10.0):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.vapid_headers = VapidHeaderCache()
+        self.session_hits = 0
+        self.session_misses = 0
+        self._sessions: Dict[str, requests.Session] = {}
+        self._sessions_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="webpush")
+
+    def _session(self, origin: str) -> requests.Session:
+        with self._sessions_lock:
+            session = self._sessions.get(origin)
+            if session is not None:
+                self.session_hits += 1
+                return session
+            self.session_misses += 1
+            session = requests.Session()
+            # Every worker thread may talk to the same origin at once
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+            session.mount(origin, adapter)
+            self._sessions[origin] = session
+            return session
+
+    def _send_sync(self, subscription: Dict[str, Any], data: str, vapid_private_key: str,
+                   vapid_claims: Dict[str, Any]) -> PushResult:
+        try:
+            origin = push_origin(subscription["endpoint"])
+            webpush(
+                subscription_info={
+                    "endpoint": subscription["endpoint"],
+                    "keys": subscription["keys"]
+                },
+                data=data,
+                # Pre-signed VAPID header instead of vapid_private_key/vapid_claims, which re-sign every call
+                headers=self.vapid_headers.get(vapid_private_key, vapid_claims, origin),
+                timeout=self.timeout,
+                requests_session=self._session(origin)
+            )
+            return PushResult(subscription.get("id"), True)
+        except WebPushException as e:
+            status_code = e.response.status_code if e.response is not None else None
+            retry_after = parse_retry_after(e.response.headers.get("Retry-After")) if e.response is not None else None
+            logging.error(f"Failed to send push notification: {e}")
+            return PushResult(subscription.get("id"), False, status_code, str(e), retry_after)
+        except Exception as e:
+            logging.error(f"Unexpected error sending push notification: {e}")
+            return PushResult(subscription.get("id"), False, None, str(e))
+
+    async def send(self, subscription: Dict[str, Any], data: str, vapid_private_key: str,
+                   vapid_claims: Dict[str, Any]) -> PushResult:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, self._send_sync, subscription, data, vapid_private_key, vapid_claims
+        )
+
+    async def send_many(self, subscriptions: List[Dict[str, Any]], data: str, vapid_private_key: str,
+                        vapid_claims: Dict[str, Any]) -> List[PushResult]:
+        """Push the same payload to every subscription concurrently; results keep the input order"""
+        return await asyncio.gather(*(
+            self.send(subscription, data, vapid_private_key, vapid_claims) for subscription in subscriptions
+        ))
+
+    def stats(self) -> Dict[str, Any]:
+        def rate(hits: int, misses: int) -> Optional[float]:
+            return round(hits / (hits + misses), 4) if hits + misses else None
+
+        return {
+            "threads": self.max_workers,
+            "origins": sorted(self._sessions),
+            "session_hits": self.session_hits,
+            "session_misses": self.session_misses,
+            "session_hit_rate": rate(self.session_hits, self.session_misses),
+            "vapid_hits": self.vapid_headers.hits,
+            "vapid_misses": self.vapid_headers.misses,
+            "vapid_hit_rate": rate(self.vapid_headers.hits, self.vapid_headers.misses)
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for session in self._sessions.values():
+            session.close()
+
+
+class PushOutbox:
+    """Durable queue of pushes in a Mongo collection, one document per (push, subscription).
+
+    Requests only insert jobs; background workers claim them atomically (so several
+    uvicorn workers can share the outbox), deliver through the PushDispatcher, and
+    reschedule failures with exponential backoff or the push service's Retry-After.
+    A claim is a lease: jobs left "sending" by a crashed process are picked up again
+    once the lease runs out, so queued pushes survive restarts.
+
+    Jobs carry a priority lane. Workers claim the highest lane first, and only from
+    lanes the scheduler's rate limits currently admit, so rate-limited routine pushes
+    can't tie up the workers while HIGH alerts wait.
+    """
+
+    def __init__(self, collection: Callable[[], Any], dispatcher: PushDispatcher,
+                 vapid: Callable[[], Tuple[Optional[str], Dict[str, Any]]],
+                 on_gone: Optional[Callable[[Dict[str, Any]], Any]] = None,
+                 scheduler: Optional[PriorityScheduler] = None,
+                 workers: int = 4, max_attempts: int = 8, base_delay: float = 5.0, max_delay: float = 3600.0,
+                 lease: float = 60.0, poll_interval: float = 2.0, retention_hours: float = 24.0):
+        self._collection = collection
+        self.dispatcher = dispatcher
+        self.vapid = vapid
+        self.on_gone = on_gone
+        self.scheduler = scheduler or PriorityScheduler("push", concurrency=workers)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.retention = timedelta(hours=retention_hours)
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.pruned = 0
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def collection(self):
+        return self._collection()
+
+    async def ensure_indexes(self):
+        await self.collection.create_index([("status", 1), ("priority", 1), ("next_attempt_at", 1)])
+        # Finished jobs are kept for inspection, then expired by Mongo
+        await self.collection.create_index("expire_at", expireAfterSeconds=0)
+
+    async def enqueue(self, subscriptions: List[Dict[str, Any]], data: str,
+                      device_id: Optional[str] = None, lane: str = "MEDIUM") -> List[str]:
+        """Queue the payload for every subscription (which may belong to different users)"""
+        now = datetime.utcnow()
+        jobs = [{
+            "id": str(uuid.uuid4()),
+            "user_id": subscription.get("user_id"),
+            "device_id": device_id,
+            "subscription_id": subscription.get("id"),
+            "endpoint": subscription["endpoint"],
+            "keys": subscription["keys"],
+            "data": data,
+            "status": "pending",
+            "lane": lane,
+            "priority": LANES.index(lane),
+            "attempts": 0,
+            "next_attempt_at": now,
+            "created_at": now,
+            "updated_at": now
+        } for subscription in subscriptions]
+        if jobs:
+            await self.collection.insert_many(jobs, ordered=False)
+            self._wakeup.set()
+        return [job["id"] for job in jobs]
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _claim(self, lanes: List[str]) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {
+                "priority": {"$in": [LANES.index(lane) for lane in lanes]},
+                "$or": [
+                    {"status": "pending", "next_attempt_at": {"$lte": now}},
+                    {"status": "sending", "locked_until": {"$lt": now}}
+                ]
+            },
+            {"$set": {"status": "sending", "locked_until": now + timedelta(seconds=self.lease), "updated_at": now}},
+            sort=[("priority", 1), ("next_attempt_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _worker(self, index: int):
+        while True:
+            try:
+                lanes = self.scheduler.ready_lanes()
+                job = await self._claim(lanes) if lanes else None
+                if job is None:
+                    self._wakeup.clear()
+                    timeout = self.poll_interval
+                    held_back = [lane for lane in LANES if lane not in lanes]
+                    if held_back:
+                        timeout = min(timeout, max(self.scheduler.next_token_in(held_back), 0.01))
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                waited = max(0.0, (datetime.utcnow() - job["next_attempt_at"]).total_seconds())
+                async with self.scheduler.slot(job.get("lane", "MEDIUM"), waited=waited):
+                    await self._deliver(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Push outbox worker {index} error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    def backoff(self, attempts: int) -> float:
+        delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    async def _finish(self, job: Dict[str, Any], status: str, **fields):
+        now = datetime.utcnow()
+        await self.collection.update_one({"id": job["id"]}, {
+            "$set": {"status": status, "updated_at": now, "expire_at": now + self.retention, **fields},
+            "$unset": {"locked_until": ""}
+        })
+
+    async def _deliver(self, job: Dict[str, Any]):
+        vapid_private_key, vapid_claims = self.vapid()
+        if not vapid_private_key:
+            # Push isn't configured on this worker; leave the job for later instead of burning attempts
+            await self.collection.update_one({"id": job["id"]}, {"$set": {
+                "status": "pending", "next_attempt_at": datetime.utcnow() + timedelta(seconds=self.max_delay)
+            }})
+            return
+
+        result = await self.dispatcher.send(job, job["data"], vapid_private_key, vapid_claims)
+        attempts = job.get("attempts", 0) + 1
+
+        if result.ok:
+            self.sent += 1
+            await self._finish(job, "sent", attempts=attempts)
+        elif result.gone:
+            self.pruned += 1
+            await self._finish(job, "dead", attempts=attempts, last_error=result.error, status_code=result.status_code)
+            if self.on_gone:
+                await self.on_gone(job)
+        elif result.retryable and attempts < self.max_attempts:
+            self.retried += 1
+            delay = result.retry_after if result.retry_after is not None else self.backoff(attempts)
+            await self.collection.update_one({"id": job["id"]}, {
+                "$set": {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "next_attempt_at": datetime.utcnow() + timedelta(seconds=delay),
+                    "last_error": result.error,
+                    "status_code": result.status_code,
+                    "updated_at": datetime.utcnow()
+                },
+                "$unset": {"locked_until": ""}
+            })
+            if delay < self.poll_interval:
+                asyncio.get_running_loop().call_later(delay, self._wakeup.set)
+        else:
+            self.failed += 1
+            await self._finish(job, "failed", attempts=attempts, last_error=result.error, status_code=result.status_code)
+
+    async def stats(self) -> Dict[str, Any]:
+        pending_by_lane = {
+            lane: await self.collection.count_documents({"status": {"$in": ["pending", "sending"]}, "lane": lane})
+            for lane in LANES
+        }
+        return {
+            "pending": sum(pending_by_lane.values()),
+            "pending_by_lane": pending_by_lane,
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "pruned_subscriptions": self.pruned,
+            "workers": len(self._tasks),
+            "scheduler": self.scheduler.stats(),
+            "dispatcher": self.dispatcher.stats()
+        }
+
+
+class AlertCoalescer:
+    """Per-(user, device) suppression window for significant-activity pushes.
+
+    The first alert for a key goes out immediately and opens a window. Alerts that
+    arrive while it is open are only counted; when the window closes they are merged
+    into one "N more events" push (built by `summarize` from the latest alert) and a
+    new window opens, so a busy camera sends at most one push per window. A window
+    that closes with nothing suppressed is evicted, as is the oldest entry once
+    max_keys is reached; that one sends its summary early rather than losing it.
+    """
+
+    def __init__(self, send: Callable[[Any], Awaitable[Any]], summarize: Callable[[Any, int], Any],
+                 window: float = 60.0, max_keys: int = 10000):
+        self.send = send
+        self.summarize = summarize
+        self.window = window
+        self.max_keys = max_keys
+        self.sent = 0
+        self.suppressed = 0
+        self.summaries = 0
+        self.evicted = 0
+        # (user_id, device_id) -> {"latest": last suppressed alert, "count": suppressed since flush, "task": timer}
+        self._windows: "OrderedDict[Tuple[str, str], Dict[str, Any]]" = OrderedDict()
+
+    async def submit(self, alert: Any) -> bool:
+        """Send the alert or fold it into the open window. Returns True if it was sent now."""
+        if self.window <= 0:
+            await self.send(alert)
+            self.sent += 1
+            return True
+
+        key = (alert.user_id, alert.device_id)
+        entry = self._windows.get(key)
+        if entry is not None:
+            entry["latest"] = alert
+            entry["count"] += 1
+            self.suppressed += 1
+            return False
+
+        while len(self._windows) >= self.max_keys:
+            evicted_key, evicted = self._windows.popitem(last=False)
+            evicted["task"].cancel()
+            self.evicted += 1
+            if evicted["count"]:
+                await self._send_summary(evicted_key, evicted["latest"], evicted["count"])
+        self._windows[key] = {"latest": None, "count": 0, "task": asyncio.create_task(self._close_after(key))}
+        await self.send(alert)
+        self.sent += 1
+        return True
+
+    async def _close_after(self, key: Tuple[str, str]):
+        while True:
+            await asyncio.sleep(self.window)
+            entry = self._windows.get(key)
+            if entry is None:
+                return
+            if not entry["count"]:
+                del self._windows[key]
+                return
+            latest, count = entry["latest"], entry["count"]
+            entry["latest"], entry["count"] = None, 0
+            await self._send_summary(key, latest, count)
+
+    async def _send_summary(self, key: Tuple[str, str], latest: Any, count: int):
+        try:
+            await self.send(self.summarize(latest, count))
+            self.summaries += 1
+        except Exception as e:
+            logging.error(f"Failed to send coalesced alert for {key}: {e}")
+
+    def close(self):
+        for entry in self._windows.values():
+            entry["task"].cancel()
+        self._windows.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "window_seconds": self.window,
+            "open_windows": len(self._windows),
+            "sent": self.sent,
+            "suppressed": self.suppressed,
+            "summaries": self.summaries,
+            "evicted": self.evicted
+        }
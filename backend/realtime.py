@@ -0,0 +1,465 @@
+"""
+Realtime WebSocket connection registry with per-socket outbound queues
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set, Union
+
+from fastapi import WebSocket
+
+try:
+    import msgpack
+except ImportError:  # MessagePack is optional, clients then stay on JSON
+    msgpack = None
+
+
+class SlowConsumerPolicy:
+    """What to do when a socket's outbound queue is full"""
+    DROP_OLDEST = "drop_oldest"  # discard the oldest queued frame to make room
+    COALESCE = "coalesce"  # replace a queued superseded frame (see COALESCABLE_TYPES), else drop oldest
+    DISCONNECT = "disconnect"  # close the socket, the client is expected to reconnect
+
+    ALL = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+
+class FrameCodec:
+    """Wire encoding negotiated per socket.
+
+    json: text frames, as before (transport compression is left to permessage-deflate).
+    msgpack: binary frames whose first byte says how the rest is packed, 0 for plain
+    MessagePack and 1 for zlib-deflated MessagePack, used once a frame exceeds
+    compress_threshold bytes (long AI answers, batches).
+    """
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+    RAW = 0
+    DEFLATE = 1
+
+    def __init__(self, encoding: str = JSON, compress: bool = True, compress_threshold: int = 1024):
+        if encoding == self.MSGPACK and msgpack is None:
+            logging.warning("msgpack is not installed, falling back to JSON frames")
+            encoding = self.JSON
+        self.encoding = encoding if encoding in (self.JSON, self.MSGPACK) else self.JSON
+        self.compress = compress
+        self.compress_threshold = compress_threshold
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "encoding": self.encoding,
+            "compression": "deflate" if self.encoding == self.MSGPACK and self.compress else None,
+            "compress_threshold": self.compress_threshold
+        }
+
+    def encode(self, message: Dict[str, Any]) -> Union[str, bytes]:
+        if self.encoding == self.JSON:
+            return json.dumps(message)
+        packed = msgpack.packb(message, use_bin_type=True, default=str)
+        if self.compress and len(packed) > self.compress_threshold:
+            return bytes([self.DEFLATE]) + zlib.compress(packed, 6)
+        return bytes([self.RAW]) + packed
+
+    @classmethod
+    def decode(cls, data: Union[str, bytes]) -> Dict[str, Any]:
+        """Inbound frames may be JSON text, or binary in the msgpack layout above"""
+        if isinstance(data, str):
+            return json.loads(data)
+        if msgpack is None:
+            raise ValueError("Binary frames need msgpack installed")
+        body = data[1:]
+        if data[:1] == bytes([cls.DEFLATE]):
+            body = zlib.decompress(body)
+        return msgpack.unpackb(body, raw=False)
+
+
+# Frame types where a newer frame makes a queued one of the same key obsolete. Anything
+# else (ai_response_delta chunks, notifications, chat messages) carries its own content
+# and is never replaced; under COALESCE those fall back to dropping the oldest frame.
+COALESCABLE_TYPES = frozenset({"ping", "pong", "hello", "subscriptions", "chat_job"})
+
+
+def coalesce_key(message: Dict[str, Any]) -> Optional[tuple]:
+    """Frames with the same key supersede each other under the COALESCE policy (None: never)"""
+    if message.get("type") not in COALESCABLE_TYPES:
+        return None
+    return (message.get("type"), message.get("device_id"), message.get("job_id"))
+
+
+class ClientConnection:
+    """A single accepted WebSocket with its own bounded send queue and writer task.
+
+    enqueue() never awaits, so producers fanning out to many sockets are never
+    stalled by a slow client; only this connection's writer task waits on the network.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user_id: str,
+        max_queue: int = 256,
+        policy: str = SlowConsumerPolicy.DROP_OLDEST,
+        send_timeout: float = 10.0,
+        batch_window: float = 0.0,
+        on_close: Optional[Callable[["ClientConnection"], None]] = None
+    ):
+        self.id = str(uuid.uuid4())
+        self.websocket = websocket
+        self.user_id = user_id
+        self.max_queue = max_queue
+        self.policy = policy if policy in SlowConsumerPolicy.ALL else SlowConsumerPolicy.DROP_OLDEST
+        self.send_timeout = send_timeout
+        # > 0: wait this long after the first queued frame and send everything queued as one batch frame
+        self.batch_window = batch_window
+        self.on_close = on_close
+        self.connected_at = datetime.utcnow()
+        self.opened = time.monotonic()
+        self.last_activity = self.opened  # last frame received from the client
+        self.closed = False
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.topics: Set[str] = set()  # empty means the socket wants every event for its user
+        self.codec = FrameCodec()
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._ready = asyncio.Event()
+        self._writer_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start the writer task; call once the socket has been accepted"""
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer())
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._queue)
+
+    def touch(self):
+        """Record that the client is alive (any inbound frame counts)"""
+        self.last_activity = time.monotonic()
+
+    def idle_for(self, now: Optional[float] = None) -> float:
+        return (now or time.monotonic()) - self.last_activity
+
+    def age(self, now: Optional[float] = None) -> float:
+        return (now or time.monotonic()) - self.opened
+
+    def enqueue(self, message: Dict[str, Any]) -> bool:
+        """Queue a frame for this socket. Returns False if the socket is closed or was dropped."""
+        if self.closed:
+            return False
+
+        if len(self._queue) >= self.max_queue:
+            if self.policy == SlowConsumerPolicy.DISCONNECT:
+                logging.warning(f"WebSocket {self.id} for user {self.user_id} is too slow, disconnecting")
+                self.abort()
+                asyncio.create_task(self._close_socket(code=1013))
+                return False
+
+            replaced = False
+            key = coalesce_key(message) if self.policy == SlowConsumerPolicy.COALESCE else None
+            if key is not None:
+                for i in range(len(self._queue) - 1, -1, -1):
+                    if coalesce_key(self._queue[i]) == key:
+                        del self._queue[i]
+                        replaced = True
+                        break
+            if not replaced:
+                self._queue.popleft()
+            self.dropped_count += 1
+
+        self._queue.append(message)
+        self._ready.set()
+        return True
+
+    async def _writer(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._ready.clear()
+                    await self._ready.wait()
+                count = 1
+                if self.batch_window > 0:
+                    await asyncio.sleep(self.batch_window)
+                    count = len(self._queue)
+                if count > 1:
+                    message = {"type": "batch", "events": list(self._queue)}
+                    self._queue.clear()
+                else:
+                    message = self._queue.popleft()
+                payload = self.codec.encode(message)
+                if isinstance(payload, bytes):
+                    send = self.websocket.send_bytes(payload)
+                else:
+                    send = self.websocket.send_text(payload)
+                await asyncio.wait_for(send, timeout=self.send_timeout)
+                self.sent_count += count
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error sending message to {self.user_id} ({self.id}): {e}")
+            await self.close()
+
+    def abort(self):
+        """Stop the writer and drop anything queued without touching the socket"""
+        self.closed = True
+        self._queue.clear()
+        if self._writer_task and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+
+    async def close(self, code: int = 1000):
+        """Stop the writer, close the socket and unregister from the manager"""
+        if self.closed:
+            return
+        self.abort()
+        await self._close_socket(code)
+
+    async def _close_socket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+        if self.on_close:
+            self.on_close(self)
+
+
+class ConnectionTaskPool:
+    """Background work for one socket so its receive loop keeps reading pings and frames.
+
+    At most max_concurrency jobs run at once; jobs that share a key (the device_id)
+    run one after another in arrival order, so replies for a device stay ordered.
+    """
+
+    def __init__(self, max_concurrency: int = 2, max_pending: int = 32):
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tails: Dict[str, asyncio.Task] = {}  # key -> most recently submitted task
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, key: str, job: Callable[[], Awaitable[Any]]) -> bool:
+        """Schedule job() behind earlier jobs with the same key. Returns False when the pool is full."""
+        if len(self._tasks) >= self.max_pending:
+            return False
+        task = asyncio.create_task(self._run(self._tails.get(key), job))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._finished(key, t))
+        return True
+
+    async def _run(self, previous: Optional[asyncio.Task], job: Callable[[], Awaitable[Any]]):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            await job()
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f"WebSocket background job for {key} failed: {task.exception()}")
+
+    async def drain(self, timeout: float) -> int:
+        """Let queued and running jobs finish for up to timeout seconds, then cancel the rest.
+        Returns how many had to be cancelled."""
+        tasks = list(self._tasks)
+        if tasks and timeout > 0:
+            await asyncio.wait(tasks, timeout=timeout)
+        unfinished = self.pending
+        await self.cancel()
+        return unfinished
+
+    async def cancel(self):
+        """Cancel everything still queued or running and wait for it to unwind"""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class EventBuffer:
+    """Bounded per-user ring buffer of recent sequenced events, for replay after a reconnect.
+
+    A user's buffer can only vouch for events after its floor: the seq of the last
+    event it dropped, or, for a fresh buffer, when this worker started seeing events
+    (or last evicted a whole user to stay under max_users).
+    """
+
+    def __init__(self, started_seq: int, max_events_per_user: int = 256, max_users: int = 10000):
+        self.max_events_per_user = max_events_per_user
+        self.max_users = max_users
+        self._base_floor = started_seq
+        self._events: "OrderedDict[str, Deque[Dict[str, Any]]]" = OrderedDict()
+        self._floors: Dict[str, int] = {}
+
+    def append(self, user_id: str, message: Dict[str, Any]):
+        events = self._events.get(user_id)
+        if events is None:
+            if len(self._events) >= self.max_users:
+                evicted_user, evicted = self._events.popitem(last=False)
+                self._floors.pop(evicted_user, None)
+                if evicted:
+                    self._base_floor = max(self._base_floor, evicted[-1].get("seq", 0))
+            events = self._events[user_id] = deque(maxlen=self.max_events_per_user)
+            self._floors[user_id] = self._base_floor
+        else:
+            self._events.move_to_end(user_id)
+        if len(events) == events.maxlen:
+            self._floors[user_id] = events[0].get("seq", self._floors[user_id])
+        events.append(message)
+
+    def since(self, user_id: str, last_seq: int) -> Optional[List[Dict[str, Any]]]:
+        """Events with seq > last_seq, or None if part of that gap is no longer buffered"""
+        floor = self._floors.get(user_id, self._base_floor)
+        if last_seq < floor:
+            return None
+        return [m for m in self._events.get(user_id, ()) if m.get("seq", 0) > last_seq]
+
+
+def build_topics(devices: Optional[List[str]] = None, missions: Optional[List[str]] = None,
+                 event_types: Optional[List[str]] = None) -> List[str]:
+    """Topic names for a subscribe/unsubscribe frame"""
+    return (
+        [f"device:{d}" for d in devices or []]
+        + [f"mission:{m}" for m in missions or []]
+        + [f"type:{t}" for t in event_types or []]
+    )
+
+
+def event_topics(message: Dict[str, Any]) -> List[str]:
+    """Topics an event belongs to: its device, its mission (by name or id) and its type"""
+    topics = []
+    if message.get("device_id"):
+        topics.append(f"device:{message['device_id']}")
+    for key in ("mission_name", "mission_id"):
+        if message.get(key):
+            topics.append(f"mission:{message[key]}")
+    if message.get("type"):
+        topics.append(f"type:{message['type']}")
+    return topics
+
+
+class TopicIndex:
+    """Inverted index from (user, topic) to the sockets subscribed to it.
+
+    Sockets with no subscriptions get all of their user's events, so older clients
+    keep working. Matching an event costs O(topics of the event + matching sockets).
+    """
+
+    def __init__(self):
+        self._subscribers: Dict[str, Dict[str, Set[ClientConnection]]] = {}  # user_id -> topic -> sockets
+        self._unfiltered: Dict[str, Set[ClientConnection]] = {}  # user_id -> sockets without subscriptions
+
+    def add(self, connection: ClientConnection):
+        self._unfiltered.setdefault(connection.user_id, set()).add(connection)
+
+    def remove(self, connection: ClientConnection):
+        self.unsubscribe(connection, list(connection.topics))
+        self._discard(self._unfiltered, connection.user_id, connection)
+
+    def subscribe(self, connection: ClientConnection, topics: List[str]):
+        if not topics:
+            return
+        self._discard(self._unfiltered, connection.user_id, connection)
+        by_topic = self._subscribers.setdefault(connection.user_id, {})
+        for topic in topics:
+            by_topic.setdefault(topic, set()).add(connection)
+            connection.topics.add(topic)
+
+    def unsubscribe(self, connection: ClientConnection, topics: List[str]):
+        by_topic = self._subscribers.get(connection.user_id, {})
+        for topic in topics:
+            connection.topics.discard(topic)
+            self._discard(by_topic, topic, connection)
+        if not by_topic:
+            self._subscribers.pop(connection.user_id, None)
+        if not connection.topics and not connection.closed:
+            self._unfiltered.setdefault(connection.user_id, set()).add(connection)
+
+    def match(self, user_id: str, message: Dict[str, Any]) -> Set[ClientConnection]:
+        targets = set(self._unfiltered.get(user_id, ()))
+        by_topic = self._subscribers.get(user_id)
+        if by_topic:
+            for topic in event_topics(message):
+                targets.update(by_topic.get(topic, ()))
+        return targets
+
+    @staticmethod
+    def wants(connection: ClientConnection, message: Dict[str, Any]) -> bool:
+        return not connection.topics or any(t in connection.topics for t in event_topics(message))
+
+    @staticmethod
+    def _discard(mapping: Dict[str, Set[ClientConnection]], key: str, connection: ClientConnection):
+        members = mapping.get(key)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del mapping[key]
+
+
+class BufferedInserter:
+    """Collects documents for a Mongo collection and writes them with one insert_many per window.
+
+    With a window of 0 every add() is a plain insert_one, as before.
+    """
+
+    def __init__(self, collection: Callable[[], Any], window: float = 0.0, max_batch: int = 500):
+        self._collection = collection  # called at flush time so tests can swap the database
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: List[Dict[str, Any]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.inserted = 0
+
+    async def add(self, document: Dict[str, Any]):
+        if self.window <= 0:
+            await self._collection().insert_one(document)
+            self.inserted += 1
+            return
+        self._pending.append(document)
+        if len(self._pending) >= self.max_batch:
+            await self.flush()
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        documents, self._pending = self._pending, []
+        try:
+            await self._collection().insert_many(documents, ordered=False)
+            self.flushes += 1
+            self.inserted += len(documents)
+        except Exception as e:
+            logging.error(f"Batched insert of {len(documents)} documents failed: {e}")
+
+
+# Upper bounds (seconds) of the buckets used for connection age / idle histograms
+HISTOGRAM_BUCKETS = [(60, "<1m"), (300, "1-5m"), (900, "5-15m"), (3600, "15-60m"), (21600, "1-6h")]
+
+
+def histogram(values: List[float]) -> Dict[str, int]:
+    counts = {label: 0 for _, label in HISTOGRAM_BUCKETS}
+    counts[">6h"] = 0
+    for value in values:
+        for bound, label in HISTOGRAM_BUCKETS:
+            if value < bound:
+                counts[label] += 1
+                break
+        else:
+            counts[">6h"] += 1
+    return counts
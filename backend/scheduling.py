@@ -0,0 +1,224 @@
+"""
+Priority lanes (HIGH / MEDIUM / LOW) for push delivery and vision analysis
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from admission import AdmissionRejected
+
+LANES = ["HIGH", "MEDIUM", "LOW"]
+
+# Spellings accepted for alert_level / priority, on top of the lane names themselves
+_LANE_ALIASES = {
+    "URGENT": "HIGH", "CRITICAL": "HIGH", "ALERT": "HIGH", "דחוף": "HIGH",
+    "NORMAL": "MEDIUM", "DEFAULT": "MEDIUM", "בינוני": "MEDIUM",
+    "ROUTINE": "LOW", "INFO": "LOW", "נמוך": "LOW",
+}
+
+
+def normalize_lane(value: Any, default: str = "MEDIUM") -> str:
+    """Map an alert_level / priority value onto a lane name"""
+    if value is None:
+        return default
+    name = str(value).strip().upper()
+    if name in LANES:
+        return name
+    return _LANE_ALIASES.get(name, default)
+
+
+def lane_from_data(data: Optional[Dict[str, Any]], explicit: Optional[str] = None) -> str:
+    """Lane for an event: an explicit alert_level wins, then data.alert_level / data.priority,
+    then data.notify_immediately (as set in the AI query notification settings)"""
+    data = data or {}
+    if explicit:
+        return normalize_lane(explicit)
+    for key in ("alert_level", "priority"):
+        if data.get(key):
+            return normalize_lane(data[key])
+    if data.get("notify_immediately"):
+        return "HIGH"
+    return "MEDIUM"
+
+
+def parse_lane_rates(value: Optional[str]) -> Dict[str, float]:
+    """"HIGH=0,MEDIUM=20,LOW=5" -> per-second rates; 0 or a missing lane means unlimited"""
+    rates = {}
+    for part in (value or "").split(","):
+        if "=" not in part:
+            continue
+        lane, rate = part.split("=", 1)
+        rates[normalize_lane(lane)] = float(rate)
+    return rates
+
+
+class Lane:
+    """One priority level: its waiters, an optional token-bucket rate limit and wait-time stats"""
+
+    def __init__(self, name: str, rate: float = 0.0, burst: Optional[float] = None):
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.waiters: Deque[Tuple[asyncio.Future, float]] = deque()
+        self.admitted = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=500)
+
+    def _refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def ready(self, now: float) -> bool:
+        self._refill(now)
+        return self.rate <= 0 or self.tokens >= 1
+
+    def next_token_in(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.rate <= 0 else max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def discard(self, future: asyncio.Future):
+        """Forget a waiter that gave up, so it no longer counts towards the queue"""
+        for i, (waiter, _) in enumerate(self.waiters):
+            if waiter is future:
+                del self.waiters[i]
+                return
+
+    def drain_estimate(self) -> float:
+        """Rough seconds until the current waiters are through, for a Retry-After hint"""
+        return (len(self.waiters) + 1) / self.rate if self.rate > 0 else 1.0
+
+    def record_wait(self, seconds: float):
+        self.admitted += 1
+        self.total_wait += seconds
+        self.max_wait = max(self.max_wait, seconds)
+        self.recent_waits.append(seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        recent = sorted(self.recent_waits)
+
+        def pct(p: float) -> Optional[float]:
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))] * 1000, 2) if recent else None
+
+        return {
+            "rate_per_sec": self.rate or None,
+            "queued": len(self.waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait / self.admitted * 1000, 2) if self.admitted else None,
+            "p95_wait_ms": pct(0.95),
+            "max_wait_ms": round(self.max_wait * 1000, 2)
+        }
+
+
+class PriorityScheduler:
+    """Admits work by priority: a free slot always goes to the highest lane that has both a
+    waiter and a rate token, so HIGH work jumps ahead of queued routine work and routine
+    lanes can't exceed their rate however much of it there is.
+
+    max_queue (waiters per lane) and max_wait (seconds) bound the wait: past either,
+    slot() raises AdmissionRejected (answered with 429 and Retry-After) instead of
+    holding the caller until its HTTP client gives up. 0 / None leaves the wait
+    unbounded, which suits work that already waits in a durable queue (the push outbox).
+    """
+
+    def __init__(self, name: str, concurrency: int = 4, rates: Optional[Dict[str, float]] = None,
+                 max_queue: int = 0, max_wait: Optional[float] = None):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        rates = rates or {}
+        self.lanes: Dict[str, Lane] = {lane: Lane(lane, rates.get(lane, 0.0)) for lane in LANES}
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def ready_lanes(self) -> List[str]:
+        """Lanes that could be admitted right now, highest first"""
+        now = time.monotonic()
+        return [name for name, lane in self.lanes.items() if lane.ready(now)]
+
+    def next_token_in(self, lanes: Optional[List[str]] = None) -> float:
+        now = time.monotonic()
+        return min(self.lanes[name].next_token_in(now) for name in (lanes or LANES))
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.active < self.concurrency:
+            for lane in self.lanes.values():
+                # Skip waiters that gave up while queued
+                while lane.waiters and lane.waiters[0][0].done():
+                    lane.waiters.popleft()
+                if lane.waiters and lane.ready(now):
+                    future, queued_at = lane.waiters.popleft()
+                    lane.take()
+                    lane.record_wait(now - queued_at)
+                    self.active += 1
+                    future.set_result(None)
+                    break
+            else:
+                break
+        if self.active < self.concurrency and self._timer is None:
+            # Waiters held back only by rate limits: come back when the next token is due
+            limited = [name for name, lane in self.lanes.items() if lane.waiters]
+            if limited:
+                delay = self.next_token_in(limited)
+                self._timer = asyncio.get_running_loop().call_later(max(delay, 0.001), self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, lane: str, waited: float = 0.0):
+        """Hold one unit of concurrency in the given lane. `waited` adds time the work
+        already spent queued elsewhere (e.g. in the push outbox) to the lane's wait stats."""
+        lane_state = self.lanes[normalize_lane(lane)]
+        if self.max_queue and len(lane_state.waiters) >= self.max_queue:
+            lane_state.rejected += 1
+            raise AdmissionRejected(f"{self.name}_{lane_state.name}_queue_full", lane_state.drain_estimate())
+        future = asyncio.get_running_loop().create_future()
+        lane_state.waiters.append((future, time.monotonic() - waited))
+        self._dispatch()
+        try:
+            await asyncio.wait([future], timeout=self.max_wait)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                future.cancel()
+                lane_state.discard(future)
+            raise
+        if not future.done():
+            future.cancel()
+            lane_state.discard(future)
+            lane_state.rejected += 1
+            raise AdmissionRejected(f"{self.name}_{lane_state.name}_timeout", lane_state.drain_estimate())
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "concurrency": self.concurrency,
+            "active": self.active,
+            "max_queue": self.max_queue or None,
+            "max_wait_seconds": self.max_wait,
+            "lanes": {name: lane.stats() for name, lane in self.lanes.items()}
+        }
+
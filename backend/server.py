@@ -1,4 +1,4 @@
-from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File, Form, Depends
+from fastapi import FastAPI, APIRouter, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File, Form, Depends, Query
 from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse, StreamingResponse
@@ -6,17 +6,17 @@ from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import time
 import logging
 import json
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any, Tuple
+from typing import AsyncIterator, List, Dict, Optional, Any, Tuple
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import asyncio
 import aiofiles
 import shutil
-from pywebpush import webpush, WebPushException
 from emergentintegrations.llm.chat import LlmChat, UserMessage, FileContentWithMimeType, ImageContent
 import requests
 import base64
@@ -24,6 +24,16 @@ from io import BytesIO
 import jwt
 import bcrypt
 import pyotp
+from realtime import BufferedInserter, ClientConnection, ConnectionTaskPool, EventBuffer, FrameCodec, SlowConsumerPolicy, TopicIndex, build_topics, histogram
+from pubsub import Broker, create_broker, now_seq
+from llm_clients import LlmSessionPool, OpenAiLlmChat, StreamingLlmChat, StubLlmChat, stream_reply
+from chat_context import ChatContextBuilder, build_summary_prompt
+from chat_jobs import ChatJobQueue
+from admission import AdmissionController, AdmissionRejected, AdmittedLlmChat
+from llm_cache import CachedLlmChat, LlmResponseCache
+from intents import ChatIntents, IntentMatcher
+from push_delivery import AlertCoalescer, PushDispatcher, PushOutbox
+from scheduling import PriorityScheduler, lane_from_data, parse_lane_rates
 
 
 ROOT_DIR = Path(__file__).parent
@@ -55,31 +65,235 @@ app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # WebSocket connection manager
+WS_SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '256'))
+WS_SLOW_CONSUMER_POLICY = os.environ.get('WS_SLOW_CONSUMER_POLICY', SlowConsumerPolicy.DROP_OLDEST)
+WS_SEND_TIMEOUT = float(os.environ.get('WS_SEND_TIMEOUT', '10'))
+# Bursts: merge frames for a socket sent within this window into one "batch" frame (0 = off)
+WS_BATCH_WINDOW_MS = float(os.environ.get('WS_BATCH_WINDOW_MS', '0'))
+# Bursts: write device notification rows with one insert_many per window (0 = insert each row)
+NOTIFICATION_BATCH_WINDOW_MS = float(os.environ.get('NOTIFICATION_BATCH_WINDOW_MS', '0'))
+# MessagePack frames larger than this many bytes are deflated
+WS_COMPRESS_THRESHOLD = int(os.environ.get('WS_COMPRESS_THRESHOLD', '1024'))
+# Heartbeats: sweep every WS_SWEEP_INTERVAL s, ping sockets silent for WS_PING_INTERVAL s, evict after WS_IDLE_TIMEOUT s
+WS_SWEEP_INTERVAL = float(os.environ.get('WS_SWEEP_INTERVAL', '15'))
+WS_PING_INTERVAL = float(os.environ.get('WS_PING_INTERVAL', '25'))
+WS_IDLE_TIMEOUT = float(os.environ.get('WS_IDLE_TIMEOUT', '75'))
+# Chat frames are answered in the background: concurrent AI calls per socket, and queued frames before rejecting
+WS_CHAT_CONCURRENCY = int(os.environ.get('WS_CHAT_CONCURRENCY', '2'))
+WS_CHAT_MAX_PENDING = int(os.environ.get('WS_CHAT_MAX_PENDING', '32'))
+# Seconds replies already under way may take to finish (and be stored) after their socket disconnects
+WS_CHAT_DRAIN_TIMEOUT = float(os.environ.get('WS_CHAT_DRAIN_TIMEOUT', '60'))
+# Pub/sub backend that carries events between workers: memory (single worker), local (Unix socket hub), redis
+WS_BROKER = os.environ.get('WS_BROKER', 'memory')
+WS_BROKER_URL = os.environ.get('WS_BROKER_URL')
+# Reconnect replay: recent events kept per user, users kept per worker, rows read from Mongo when the buffer can't cover the gap
+WS_REPLAY_BUFFER_SIZE = int(os.environ.get('WS_REPLAY_BUFFER_SIZE', '256'))
+WS_REPLAY_MAX_USERS = int(os.environ.get('WS_REPLAY_MAX_USERS', '10000'))
+WS_REPLAY_DB_LIMIT = int(os.environ.get('WS_REPLAY_DB_LIMIT', '200'))
+
+def seq_to_datetime(seq: int) -> datetime:
+    """Sequence numbers are UTC epoch milliseconds, like the naive utcnow() timestamps we store"""
+    return datetime.utcfromtimestamp(seq / 1000)
+
+def datetime_to_seq(value: datetime) -> int:
+    return int(value.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: Dict[str, WebSocket] = {}
-        self.user_devices: Dict[str, List[str]] = {}  # user_id -> device_ids
-    
-    async def connect(self, websocket: WebSocket, user_id: str):
+    def __init__(self, broker: Optional[Broker] = None):
+        # user_id -> connection_id -> connection; a user may have many tabs/phones open
+        self.active_connections: Dict[str, Dict[str, ClientConnection]] = {}
+        # Which sockets want which devices/missions/event types
+        self.topics = TopicIndex()
+        self.broker = broker or create_broker('memory')
+        self.broker.bind(self.deliver_local)
+        self.events = EventBuffer(now_seq(), WS_REPLAY_BUFFER_SIZE, WS_REPLAY_MAX_USERS)
+        # Device notification/chat rows from bursts are flushed together
+        self.notification_writer = BufferedInserter(lambda: db.notifications, NOTIFICATION_BATCH_WINDOW_MS / 1000)
+        self.device_message_writer = BufferedInserter(lambda: db.chat_messages, NOTIFICATION_BATCH_WINDOW_MS / 1000)
+        self.evicted_idle = 0
+        self._sweeper: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        await self.broker.start()
+        if self._sweeper is None:
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+    
+    async def stop(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            self._sweeper = None
+        await self.notification_writer.flush()
+        await self.device_message_writer.flush()
+        await self.broker.stop()
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections.values()):
+                await connection.close(code=1001)
+    
+    async def connect(self, websocket: WebSocket, user_id: str) -> ClientConnection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logging.info(f"User {user_id} connected via WebSocket")
-    
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-        logging.info(f"User {user_id} disconnected from WebSocket")
+        connection = ClientConnection(
+            websocket,
+            user_id,
+            max_queue=WS_SEND_QUEUE_SIZE,
+            policy=WS_SLOW_CONSUMER_POLICY,
+            send_timeout=WS_SEND_TIMEOUT,
+            batch_window=WS_BATCH_WINDOW_MS / 1000,
+            on_close=self.disconnect
+        )
+        # Clients on slow links can ask for MessagePack up front: /ws/{user_id}?encoding=msgpack
+        self.negotiate_encoding(connection, websocket.query_params.get('encoding'), websocket.query_params.get('compress'))
+        self.active_connections.setdefault(user_id, {})[connection.id] = connection
+        self.topics.add(connection)
+        connection.start()
+        logging.info(f"User {user_id} connected via WebSocket ({connection.id})")
+        return connection
+    
+    def disconnect(self, connection: ClientConnection):
+        connection.abort()
+        self.topics.remove(connection)
+        connections = self.active_connections.get(connection.user_id)
+        if connections and connections.pop(connection.id, None):
+            if not connections:
+                del self.active_connections[connection.user_id]
+            logging.info(f"User {connection.user_id} disconnected from WebSocket ({connection.id})")
     
     async def send_personal_message(self, message: dict, user_id: str):
-        if user_id in self.active_connections:
+        """Publish a message to the user's sockets on every worker.
+        Returns True if a local socket took it, or the event was handed to a distributed broker."""
+        return await self.broker.publish(user_id, message)
+    
+    def deliver_local(self, user_id: str, message: dict) -> bool:
+        """Queue a message on the user's sockets on this worker that subscribed to it; never waits
+        on the network. Every worker sees every event, so each keeps the replay buffer for all users."""
+        if 'seq' in message:
+            self.events.append(user_id, message)
+        delivered = False
+        for connection in self.topics.match(user_id, message):
+            if connection.enqueue(message):
+                delivered = True
+        return delivered
+    
+    async def replay(self, connection: ClientConnection, last_seq: int):
+        """Resend what the user missed after last_seq, from the ring buffer or, if the gap
+        is older than the buffer, from notifications/chat_messages. Live events may also
+        arrive while replaying, so clients should drop frames whose seq they already have."""
+        events = self.events.since(connection.user_id, last_seq)
+        source = "buffer"
+        truncated = False
+        if events is None:
+            source = "database"
+            events, truncated = await self._load_missed_events(connection.user_id, last_seq)
+        events = [event for event in events if self.topics.wants(connection, event)]
+        for event in events:
+            connection.enqueue(event)
+        connection.enqueue({
+            'type': 'resume_complete',
+            'source': source,
+            'replayed': len(events),
+            'truncated': truncated,
+            'last_seq': events[-1]['seq'] if events else last_seq
+        })
+    
+    async def _load_missed_events(self, user_id: str, last_seq: int) -> Tuple[List[dict], bool]:
+        since = seq_to_datetime(last_seq)
+        query = {"user_id": user_id, "timestamp": {"$gt": since}}
+        notifications, messages = await asyncio.gather(
+            db.notifications.find(query).sort("timestamp", 1).limit(WS_REPLAY_DB_LIMIT).to_list(WS_REPLAY_DB_LIMIT),
+            db.chat_messages.find(query).sort("timestamp", 1).limit(WS_REPLAY_DB_LIMIT).to_list(WS_REPLAY_DB_LIMIT)
+        )
+        events = []
+        for notif in notifications:
+            events.append({
+                'type': notif.get('type', 'message'),
+                'device_id': notif.get('device_id'),
+                'content': notif.get('content', ''),
+                'media_url': notif.get('media_url'),
+                'notification_id': notif.get('id'),
+                'timestamp': notif['timestamp'].isoformat(),
+                'seq': datetime_to_seq(notif['timestamp']),
+                'replayed': True
+            })
+        for msg in messages:
+            events.append({
+                'type': 'ai_response' if msg.get('sender') == 'ai' else 'chat_message',
+                'device_id': msg.get('device_id'),
+                'message': msg.get('message'),
+                'message_id': msg.get('id'),
+                'sender': msg.get('sender'),
+                'timestamp': msg['timestamp'].isoformat(),
+                'seq': datetime_to_seq(msg['timestamp']),
+                'replayed': True
+            })
+        events.sort(key=lambda e: e['seq'])
+        truncated = len(notifications) >= WS_REPLAY_DB_LIMIT or len(messages) >= WS_REPLAY_DB_LIMIT
+        return events[:WS_REPLAY_DB_LIMIT], truncated
+    
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(WS_SWEEP_INTERVAL)
             try:
-                await self.active_connections[user_id].send_text(json.dumps(message))
-                return True
+                await self.sweep()
             except Exception as e:
-                logging.error(f"Error sending message to {user_id}: {e}")
-                self.disconnect(user_id)
-                return False
-        return False
+                logging.error(f"WebSocket sweep failed: {e}")
+    
+    async def sweep(self):
+        """Ping quiet sockets and evict the ones that stayed silent past WS_IDLE_TIMEOUT, so dead
+        TCP connections stop holding memory and fan-out slots before a send happens to fail"""
+        now = time.monotonic()
+        for connections in list(self.active_connections.values()):
+            for connection in list(connections.values()):
+                idle = connection.idle_for(now)
+                if idle > WS_IDLE_TIMEOUT:
+                    logging.info(f"Evicting idle WebSocket {connection.id} for user {connection.user_id} ({idle:.0f}s silent)")
+                    self.evicted_idle += 1
+                    await connection.close(code=1001)
+                elif idle > WS_PING_INTERVAL:
+                    connection.enqueue({'type': 'ping', 'timestamp': datetime.utcnow().isoformat()})
+    
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        connections = [c for by_id in self.active_connections.values() for c in by_id.values()]
+        encodings: Dict[str, int] = {}
+        for connection in connections:
+            encodings[connection.codec.encoding] = encodings.get(connection.codec.encoding, 0) + 1
+        return {
+            "connections": len(connections),
+            "users": len(self.active_connections),
+            "subscribed_connections": sum(1 for c in connections if c.topics),
+            "encodings": encodings,
+            "queued_frames": sum(c.queue_size for c in connections),
+            "sent_frames": sum(c.sent_count for c in connections),
+            "dropped_frames": sum(c.dropped_count for c in connections),
+            "evicted_idle": self.evicted_idle,
+            "age_histogram": histogram([c.age(now) for c in connections]),
+            "idle_histogram": histogram([c.idle_for(now) for c in connections]),
+            "broker": type(self.broker).__name__
+        }
+    
+    def negotiate_encoding(self, connection: ClientConnection, encoding: Optional[str], compress: Any = None):
+        """Pick the socket's frame encoding; JSON unless the client asks for msgpack"""
+        if not encoding:
+            return
+        if isinstance(compress, str):
+            compress = compress.lower() not in ('0', 'false', 'no')
+        connection.codec = FrameCodec(
+            encoding.lower(),
+            compress=True if compress is None else bool(compress),
+            compress_threshold=WS_COMPRESS_THRESHOLD
+        )
+    
+    def update_subscriptions(self, connection: ClientConnection, message_data: dict):
+        """Apply a subscribe/unsubscribe frame: lists of devices, missions and event_types"""
+        topics = build_topics(
+            message_data.get('devices'),
+            message_data.get('missions'),
+            message_data.get('event_types')
+        )
+        if message_data.get('type') == 'subscribe':
+            self.topics.subscribe(connection, topics)
+        else:
+            self.topics.unsubscribe(connection, topics)
+        connection.enqueue({'type': 'subscriptions', 'topics': sorted(connection.topics)})
     
     async def broadcast_to_user_devices(self, message: dict, user_id: str):
         """Send notification to user from their devices"""
@@ -94,9 +308,10 @@ class ConnectionManager:
                 media_url=message.get('media_url'),
                 timestamp=datetime.utcnow()
             )
-            await db.notifications.insert_one(notification.dict())
+            await self.notification_writer.add(notification.dict())
+        return success
 
-manager = ConnectionManager()
+manager = ConnectionManager(create_broker(WS_BROKER, WS_BROKER_URL))
 
 # AI Chat personalities based on device type
 AI_PERSONALITIES = {
@@ -118,39 +333,117 @@ AI_PERSONALITIES = {
     }
 }
 
-async def get_ai_chat_instance(device_type: str, session_id: str, has_images: bool = False, user_id: str = None, device_id: str = None):
-    """Get AI chat instance for device type, with vision support if images are present"""
+# "stub" swaps every chat for an offline client that streams a canned reply (tests, benchmarks)
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'openai')
+
+# LLM reply cache: LLM_CACHE_SIZE entries in memory (0 disables); LLM_CACHE_MONGO=true adds a shared db.llm_cache tier
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', '1000'))
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', '3600'))
+LLM_CACHE_MONGO = os.environ.get('LLM_CACHE_MONGO', 'false').lower() == 'true'
+llm_cache = LlmResponseCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, (lambda: db.llm_cache) if LLM_CACHE_MONGO else None)
+
+# LLM admission control: every model call takes a global and a per-user slot. Rates are calls per
+# second (0 = unlimited); calls wait at most LLM_MAX_WAIT seconds before being refused with 429.
+LLM_GLOBAL_CONCURRENCY = int(os.environ.get('LLM_GLOBAL_CONCURRENCY', '32'))
+LLM_GLOBAL_RATE = float(os.environ.get('LLM_GLOBAL_RATE', '0'))
+LLM_USER_CONCURRENCY = int(os.environ.get('LLM_USER_CONCURRENCY', '4'))
+LLM_USER_RATE = float(os.environ.get('LLM_USER_RATE', '2'))
+LLM_USER_BURST = float(os.environ.get('LLM_USER_BURST', '10'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '200'))
+LLM_MAX_USER_QUEUE = int(os.environ.get('LLM_MAX_USER_QUEUE', '20'))
+LLM_MAX_WAIT = float(os.environ.get('LLM_MAX_WAIT', '10'))
+llm_admission = AdmissionController(
+    global_concurrency=LLM_GLOBAL_CONCURRENCY,
+    global_rate=LLM_GLOBAL_RATE,
+    user_concurrency=LLM_USER_CONCURRENCY,
+    user_rate=LLM_USER_RATE,
+    user_burst=LLM_USER_BURST,
+    max_queue=LLM_MAX_QUEUE,
+    max_user_queue=LLM_MAX_USER_QUEUE,
+    max_wait=LLM_MAX_WAIT
+)
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"success": False, "error": str(exc), "reason": exc.reason, "retry_after": exc.retry_after_header},
+        headers={"Retry-After": exc.retry_after_header}
+    )
+
+# Chat command detection; corrective feedback must score PROMPT_FIX_MIN_CONFIDENCE (0-1) before the LLM prompt fix runs
+PROMPT_FIX_MIN_CONFIDENCE = float(os.environ.get('PROMPT_FIX_MIN_CONFIDENCE', '0.7'))
+intent_matcher = IntentMatcher(prompt_fix_confidence=PROMPT_FIX_MIN_CONFIDENCE)
+
+# Ready LLM clients reused per chat session (0 disables); cached chat_settings expire after LLM_SETTINGS_TTL seconds
+LLM_SESSION_POOL_SIZE = int(os.environ.get('LLM_SESSION_POOL_SIZE', '1000'))
+LLM_SETTINGS_TTL = float(os.environ.get('LLM_SETTINGS_TTL', '30'))
+chat_sessions = LlmSessionPool(max_clients=LLM_SESSION_POOL_SIZE, settings_ttl=LLM_SETTINGS_TTL)
+
+# Seconds between keep-alive comments on /api/chat/send/stream while no event is ready
+SSE_KEEPALIVE_INTERVAL = float(os.environ.get('SSE_KEEPALIVE_INTERVAL', '15'))
+
+async def get_ai_chat_instance(device_type: str, session_id: str, has_images: bool = False, user_id: str = None, device_id: str = None, streaming: bool = False,
+                               cache: bool = False, cache_bypass: bool = False, cache_context: str = "",
+                               admit_as: Optional[str] = None, vision_lane: Optional[str] = None):
+    """Get AI chat instance for device type, with vision support if images are present.
+    With streaming=True the client also offers stream_message() for token-by-token replies.
+    With cache=True send_message answers repeated prompts (and images) to the device from llm_cache;
+    cache_context is the conversation context prefixed to the prompt, which the cache key leaves out.
+    Custom settings (and stateless clients) come from the chat_sessions pool when already loaded.
+    Model calls (not cache hits) go through llm_admission as admit_as (default user_id); with
+    vision_lane they also wait for a vision_scheduler slot in that lane, after the per-user
+    limits and before the global concurrency limit."""
     
     # Try to get custom settings first
+    owner = (user_id, device_id) if user_id and device_id else None
     custom_settings = None
-    if user_id and device_id:
-        custom_settings = await db.chat_settings.find_one({
+    if owner:
+        custom_settings = await chat_sessions.settings(owner, lambda: db.chat_settings.find_one({
             "user_id": user_id,
             "device_id": device_id
-        })
+        }))
     
     if custom_settings:
         # Use custom settings
         system_message = custom_settings["system_message"]
         model = custom_settings["model"]
-        print(f"DEBUG: Using custom chat settings - Role: {custom_settings['role_name']}")
     else:
         # Use default personality
         personality = AI_PERSONALITIES.get(device_type, AI_PERSONALITIES["default"])
         system_message = personality["system_message"]
         model = personality["model"]
-        print(f"DEBUG: Using default personality for {device_type}")
     
     # Use vision model if images are present - updated to use current model
     if has_images:
         model = "gpt-4o"
-        print(f"DEBUG: Switching to vision model: {model}")
     
-    chat = LlmChat(
-        api_key=os.environ.get('OPENAI_API_KEY'),
-        session_id=session_id,
-        system_message=system_message
-    ).with_model("openai", model)
+    if LLM_PROVIDER == 'stub':
+        chat_class = StubLlmChat
+    elif streaming:
+        chat_class = StreamingLlmChat
+    else:
+        chat_class = OpenAiLlmChat
+    
+    def new_chat():
+        logging.debug(f"New {chat_class.__name__} for {session_id} - model {model}, "
+                      f"{'role ' + custom_settings['role_name'] if custom_settings else 'default ' + device_type + ' personality'}")
+        return chat_class(
+            api_key=os.environ.get('OPENAI_API_KEY'),
+            session_id=session_id,
+            system_message=system_message
+        ).with_model("openai", model)
+    
+    # These clients send only the system message and the prompt (the history the caller needs is
+    # already in it, from chat_context), so one pooled instance serves every call of the session
+    chat = chat_sessions.client(LlmSessionPool.key(session_id, chat_class, model, system_message), new_chat, owner,
+                                reuse=LlmSessionPool.reusable(chat_class))
+    chat = AdmittedLlmChat(chat, llm_admission, admit_as or user_id,
+                           scheduler=vision_scheduler if vision_lane else None, lane=vision_lane)
+    
+    if cache:
+        chat = CachedLlmChat(chat, llm_cache, model, system_message, bypass=cache_bypass,
+                             scope=device_id or "", context=cache_context)
     
     return chat
 
@@ -232,47 +525,39 @@ async def create_vision_message(message: str, file_contents_for_ai: List[Dict],
     print(f"DEBUG: Created vision message with {len(file_attachments)} image attachments")
     return enhanced_message, file_attachments
 
-async def store_chat_history(user_id: str, device_id: str, messages: List[Dict[str, Any]]):
-    """Store or update chat history in MongoDB"""
+# Only the most recent CHAT_HISTORY_MAX entries are kept in a device's history document
+CHAT_HISTORY_MAX = int(os.environ.get('CHAT_HISTORY_MAX', '500'))
+
+async def append_chat_history(user_id: str, device_id: str, entries: List[Dict[str, Any]]):
+    """Append messages to the device's chat history.
+    
+    A single atomic $push/$slice upsert: no read-modify-write, so concurrent messages
+    can't overwrite each other, and the document stays bounded however long the chat runs.
+    """
     try:
-        # Find existing chat history
-        existing = await db.chat_histories.find_one({
-            "user_id": user_id,
-            "device_id": device_id
-        })
-        
-        if existing:
-            # Update existing history
-            await db.chat_histories.update_one(
-                {"user_id": user_id, "device_id": device_id},
-                {
-                    "$set": {
-                        "history": messages,
-                        "updated_at": datetime.utcnow()
-                    }
-                }
-            )
-        else:
-            # Create new chat history
-            chat_history = ChatHistory(
-                user_id=user_id,
-                device_id=device_id,
-                history=messages
-            )
-            await db.chat_histories.insert_one(chat_history.dict())
-            
+        now = datetime.utcnow()
+        await db.chat_histories.update_one(
+            {"user_id": user_id, "device_id": device_id},
+            {
+                "$push": {"history": {"$each": entries, "$slice": -CHAT_HISTORY_MAX}},
+                "$set": {"updated_at": now},
+                "$setOnInsert": {"id": str(uuid.uuid4()), "ai_personality": None, "created_at": now}
+            },
+            upsert=True
+        )
         logging.info(f"Stored chat history for user {user_id}, device {device_id}")
         
     except Exception as e:
         logging.error(f"Failed to store chat history: {e}")
 
-async def get_chat_history(user_id: str, device_id: str) -> List[Dict[str, Any]]:
-    """Get chat history from MongoDB"""
+async def get_chat_history(user_id: str, device_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Get chat history from MongoDB, optionally only the last `limit` entries"""
     try:
+        projection = {"_id": 0, "history": {"$slice": -limit} if limit else 1}
         history_doc = await db.chat_histories.find_one({
             "user_id": user_id,
             "device_id": device_id
-        })
+        }, projection)
         
         if history_doc:
             return history_doc.get("history", [])
@@ -282,6 +567,44 @@ async def get_chat_history(user_id: str, device_id: str) -> List[Dict[str, Any]]
         logging.error(f"Failed to get chat history: {e}")
         return []
 
+# Prompt context per device chat: a rolling summary plus the newest turns that fit CHAT_CONTEXT_TOKENS
+CHAT_CONTEXT_TOKENS = int(os.environ.get('CHAT_CONTEXT_TOKENS', '1500'))
+CHAT_SUMMARY_TOKENS = int(os.environ.get('CHAT_SUMMARY_TOKENS', '300'))
+CHAT_CONTEXT_RECENT_TURNS = int(os.environ.get('CHAT_CONTEXT_RECENT_TURNS', '12'))
+CHAT_SUMMARY_BATCH = int(os.environ.get('CHAT_SUMMARY_BATCH', '10'))
+
+async def summarize_chat_turns(previous_summary: str, turns: List[Dict[str, Any]], max_tokens: int) -> str:
+    """Fold new turns into a device's rolling summary"""
+    chat_class = StubLlmChat if LLM_PROVIDER == 'stub' else LlmChat
+    summary_chat = AdmittedLlmChat(chat_class(
+        api_key=os.environ.get('OPENAI_API_KEY'),
+        session_id=f"summary_{uuid.uuid4()}",
+        system_message="You maintain short, factual summaries of conversations."
+    ).with_model("openai", "gpt-4o-mini"), llm_admission)
+    summary = await summary_chat.send_message(UserMessage(text=build_summary_prompt(previous_summary, turns, max_tokens)))
+    return (summary or "").strip()
+
+chat_context = ChatContextBuilder(
+    lambda: db.chat_summaries,
+    get_chat_history,
+    summarize_chat_turns,
+    budget_tokens=CHAT_CONTEXT_TOKENS,
+    summary_tokens=CHAT_SUMMARY_TOKENS,
+    keep_recent=CHAT_CONTEXT_RECENT_TURNS,
+    summary_batch=CHAT_SUMMARY_BATCH
+)
+
+# /api/chat/send?async=true: AI replies run on CHAT_JOB_WORKERS background tasks, at most CHAT_JOB_MAX_PENDING queued
+CHAT_JOB_WORKERS = int(os.environ.get('CHAT_JOB_WORKERS', '8'))
+CHAT_JOB_MAX_PENDING = int(os.environ.get('CHAT_JOB_MAX_PENDING', '200'))
+CHAT_JOB_RETENTION_HOURS = float(os.environ.get('CHAT_JOB_RETENTION_HOURS', '24'))
+chat_jobs = ChatJobQueue(
+    lambda: db.chat_jobs,
+    workers=CHAT_JOB_WORKERS,
+    max_pending=CHAT_JOB_MAX_PENDING,
+    retention_hours=CHAT_JOB_RETENTION_HOURS
+)
+
 # Define Models
 class Device(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -340,8 +663,8 @@ class PushSubscriptionCreate(BaseModel):
     endpoint: str
     keys: Dict[str, str]
 
-class PushNotificationRequest(BaseModel):
-    user_id: str
+class PushNotificationTemplate(BaseModel):
+    """Push content and metadata, independent of the recipient"""
     device_id: str  # Now required (camera ID)
     title: str
     body: str
@@ -362,6 +685,15 @@ class PushNotificationRequest(BaseModel):
     user_email: Optional[str] = None  # User email
     image_url: Optional[str] = None  # Image URL (alias for image)
     rtmp_code: Optional[str] = None  # RTMP stream code/URL
+    # Delivery lane HIGH / MEDIUM / LOW; falls back to data.alert_level, data.priority or data.notify_immediately
+    alert_level: Optional[str] = None
+
+class PushNotificationRequest(PushNotificationTemplate):
+    user_id: str
+
+class PushBatchRequest(PushNotificationTemplate):
+    user_ids: Optional[List[str]] = None  # Explicit recipients
+    # With no user_ids, mission_name selects every user who has a mission of that name
 
 class ChatMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -400,6 +732,7 @@ class ChatMessageCreate(BaseModel):
     image_url: Optional[str] = None
     video_url: Optional[str] = None
     sound_id: Optional[str] = None
+    no_cache: Optional[bool] = False  # Skip the LLM response cache for this message
 
 class ChatSettings(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -448,6 +781,8 @@ class DirectImageChatCreate(BaseModel):
     body: Optional[str] = None
     image_url_single: Optional[str] = None  # alias in case clients send this
     sound_id: Optional[str] = None
+    alert_level: Optional[str] = None  # HIGH / MEDIUM / LOW vision and push lane (default MEDIUM)
+    no_cache: Optional[bool] = False  # Skip the LLM response cache for this image
 
 class CameraPrompt(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -471,6 +806,7 @@ class CameraPromptFixCommand(BaseModel):
     device_id: str
     message: str
     referenced_messages: Optional[List[str]] = None
+    no_cache: Optional[bool] = False  # Skip the LLM response cache
 
 class RoleChangeCommand(BaseModel):
     user_id: str
@@ -556,99 +892,175 @@ class StatusCheckCreate(BaseModel):
     client_name: str
 
 # WebSocket endpoint
+async def handle_ws_chat(connection: ClientConnection, user_id: str, message_data: dict):
+    """Store a chat frame from the socket and reply with the AI response.
+    With "stream": true the reply goes out as ai_response_delta frames, then a final ai_response."""
+    device_id = message_data['device_id']
+    user_message = message_data['message']
+    stream = bool(message_data.get('stream'))
+    
+    # Store user message
+    chat_msg = ChatMessage(
+        user_id=user_id,
+        device_id=device_id,
+        message=user_message,
+        sender='user'
+    )
+    await db.chat_messages.insert_one(chat_msg.dict())
+    
+    # Send user message confirmation
+    connection.enqueue({
+        'type': 'message_sent',
+        'message_id': chat_msg.id,
+        'device_id': device_id
+    })
+    
+    # Generate AI response
+    try:
+        device = await db.devices.find_one({"id": device_id})
+        if device:
+            device_type = device.get("type", "default")
+            session_id = f"{user_id}_{device_id}"
+            
+            ai_chat = await get_ai_chat_instance(device_type, session_id, streaming=stream, admit_as=user_id)
+            conversation_context = await chat_context.build(user_id, device_id)
+            if conversation_context:
+                user_msg = UserMessage(text=f"{conversation_context}\n\nCurrent message: {user_message}")
+            else:
+                user_msg = UserMessage(text=user_message)
+            if stream:
+                parts = []
+                async for delta in stream_reply(ai_chat, user_msg):
+                    connection.enqueue({
+                        'type': 'ai_response_delta',
+                        'device_id': device_id,
+                        'reply_to': chat_msg.id,
+                        'index': len(parts),
+                        'delta': delta
+                    })
+                    parts.append(delta)
+                ai_response = "".join(parts)
+            else:
+                ai_response = await ai_chat.send_message(user_msg)
+            
+            # Store AI response
+            ai_chat_msg = ChatMessage(
+                user_id=user_id,
+                device_id=device_id,
+                message=ai_response,
+                sender="ai",
+                ai_response=True
+            )
+            await db.chat_messages.insert_one(ai_chat_msg.dict())
+            
+            # Send AI response to all of the user's sockets, sequenced so a reconnecting client
+            # can replay it; when streamed this carries the stored id and full text
+            await manager.send_personal_message({
+                'type': 'ai_response',
+                'device_id': device_id,
+                'message': ai_response,
+                'message_id': ai_chat_msg.id,
+                'reply_to': chat_msg.id,
+                'streamed': stream,
+                'timestamp': ai_chat_msg.timestamp.isoformat()
+            }, user_id)
+            
+            # Update chat history
+            await append_chat_history(user_id, device_id, [
+                {
+                    "id": chat_msg.id,
+                    "message": user_message,
+                    "sender": "user",
+                    "timestamp": chat_msg.timestamp.isoformat(),
+                    "ai_response": False
+                },
+                {
+                    "id": ai_chat_msg.id,
+                    "message": ai_response,
+                    "sender": "ai",
+                    "timestamp": ai_chat_msg.timestamp.isoformat(), 
+                    "ai_response": True
+                }
+            ])
+            chat_context.schedule_refresh(user_id, device_id)
+            
+    except Exception as ai_error:
+        logging.error(f"WebSocket AI response error: {ai_error}")
+        connection.enqueue({
+            'type': 'ai_error',
+            'device_id': device_id,
+            'error': str(ai_error)
+        })
+
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: str):
-    await manager.connect(websocket, user_id)
+    connection = await manager.connect(websocket, user_id)
+    ws_tasks = ConnectionTaskPool(max_concurrency=WS_CHAT_CONCURRENCY, max_pending=WS_CHAT_MAX_PENDING)
     try:
         while True:
-            # Keep connection alive and listen for messages
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            # Keep connection alive and listen for messages (JSON text or msgpack binary frames)
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
+                raise WebSocketDisconnect(frame.get('code', 1000))
+            message_data = FrameCodec.decode(frame['text'] if frame.get('text') is not None else frame['bytes'])
+            connection.touch()
             
             # Handle different message types
             if message_data.get('type') == 'ping':
-                await websocket.send_text(json.dumps({'type': 'pong'}))
+                connection.enqueue({'type': 'pong'})
+            elif message_data.get('type') == 'pong':
+                # Reply to a server heartbeat; touch() above already recorded it
+                pass
+            elif message_data.get('type') == 'hello':
+                # Negotiate the frame encoding; the reply is already in the chosen encoding
+                manager.negotiate_encoding(connection, message_data.get('encoding'), message_data.get('compress'))
+                connection.enqueue({'type': 'hello', **connection.codec.describe()})
+            elif message_data.get('type') == 'resume':
+                # Client reconnected; replay events stamped after the last seq it saw
+                try:
+                    last_seq = int(message_data.get('last_seq') or 0)
+                except (TypeError, ValueError):
+                    connection.enqueue({'type': 'error', 'error': 'resume needs a numeric last_seq'})
+                    continue
+                await manager.replay(connection, last_seq)
+            elif message_data.get('type') in ('subscribe', 'unsubscribe'):
+                # Narrow this socket to some devices / missions / event types; no subscriptions = everything
+                manager.update_subscriptions(connection, message_data)
             elif message_data.get('type') == 'chat':
-                # Handle chat message from user to device with AI response
-                device_id = message_data['device_id']
-                user_message = message_data['message']
-                
-                # Store user message
-                chat_msg = ChatMessage(
-                    user_id=user_id,
-                    device_id=device_id,
-                    message=user_message,
-                    sender='user'
+                # Handle chat message from user to device with AI response, off the receive loop;
+                # frames for the same device are answered in order
+                device_id = message_data.get('device_id')
+                if not device_id or not isinstance(message_data.get('message'), str):
+                    connection.enqueue({
+                        'type': 'ai_error',
+                        'device_id': device_id,
+                        'error': 'chat frames need a device_id and a message'
+                    })
+                    continue
+                accepted = ws_tasks.submit(
+                    device_id,
+                    lambda message_data=message_data: handle_ws_chat(connection, user_id, message_data)
                 )
-                await db.chat_messages.insert_one(chat_msg.dict())
-                
-                # Send user message confirmation
-                await websocket.send_text(json.dumps({
-                    'type': 'message_sent',
-                    'message_id': chat_msg.id,
-                    'device_id': device_id
-                }))
-                
-                # Generate AI response
-                try:
-                    device = await db.devices.find_one({"id": device_id})
-                    if device:
-                        device_type = device.get("type", "default")
-                        session_id = f"{user_id}_{device_id}"
-                        
-                        ai_chat = await get_ai_chat_instance(device_type, session_id)
-                        user_msg = UserMessage(text=user_message)
-                        ai_response = await ai_chat.send_message(user_msg)
-                        
-                        # Store AI response
-                        ai_chat_msg = ChatMessage(
-                            user_id=user_id,
-                            device_id=device_id,
-                            message=ai_response,
-                            sender="ai",
-                            ai_response=True
-                        )
-                        await db.chat_messages.insert_one(ai_chat_msg.dict())
-                        
-                        # Send AI response via WebSocket
-                        await websocket.send_text(json.dumps({
-                            'type': 'ai_response',
-                            'device_id': device_id,
-                            'message': ai_response,
-                            'message_id': ai_chat_msg.id,
-                            'timestamp': ai_chat_msg.timestamp.isoformat()
-                        }))
-                        
-                        # Update chat history
-                        history = await get_chat_history(user_id, device_id)
-                        history.extend([
-                            {
-                                "id": chat_msg.id,
-                                "message": user_message,
-                                "sender": "user",
-                                "timestamp": chat_msg.timestamp.isoformat(),
-                                "ai_response": False
-                            },
-                            {
-                                "id": ai_chat_msg.id,
-                                "message": ai_response,
-                                "sender": "ai",
-                                "timestamp": ai_chat_msg.timestamp.isoformat(), 
-                                "ai_response": True
-                            }
-                        ])
-                        await store_chat_history(user_id, device_id, history)
-                        
-                except Exception as ai_error:
-                    logging.error(f"WebSocket AI response error: {ai_error}")
-                    await websocket.send_text(json.dumps({
+                if not accepted:
+                    connection.enqueue({
                         'type': 'ai_error',
                         'device_id': device_id,
-                        'error': str(ai_error)
-                    }))
+                        'error': 'Too many chat messages in progress, please retry'
+                    })
                 
     except WebSocketDisconnect:
-        manager.disconnect(user_id)
+        pass
+    finally:
+        manager.disconnect(connection)
+        # Replies already under way are still stored (and reach the user's other sockets)
+        cancelled = await ws_tasks.drain(WS_CHAT_DRAIN_TIMEOUT)
+        if cancelled:
+            logging.warning(f"Cancelled {cancelled} WebSocket chat replies for {user_id} after {WS_CHAT_DRAIN_TIMEOUT}s")
+
+@api_router.get("/ws/stats")
+async def get_websocket_stats():
+    """Live WebSocket connections on this worker: counts, queues and age/idle histograms"""
+    return manager.stats()
 
 # Device Management Endpoints
 @api_router.post("/devices", response_model=Device)
@@ -1142,20 +1554,42 @@ async def unsubscribe_from_push(user_id: str, endpoint: Optional[str] = None):
         "deleted_count": result.deleted_count
     }
 
-@api_router.post("/push/send")
-async def send_push_notification(notification: PushNotificationRequest):
-    """Send push notification to user's subscribed devices"""
-    
-    # Get user's push subscriptions
-    subscriptions = await db.push_subscriptions.find({"user_id": notification.user_id}).to_list(100)
-    
-    if not subscriptions:
-        return {"success": False, "message": "No push subscriptions found for user"}
-    
-    sent_count = 0
-    failed_count = 0
-    
-    # Prepare notification payload
+# Web Push is sent from a thread pool; PUSH_MAX_WORKERS bounds concurrent push service requests
+PUSH_MAX_WORKERS = int(os.environ.get('PUSH_MAX_WORKERS', '16'))
+PUSH_TIMEOUT = float(os.environ.get('PUSH_TIMEOUT', '10'))
+push_dispatcher = PushDispatcher(max_workers=PUSH_MAX_WORKERS, timeout=PUSH_TIMEOUT)
+# Pushes are queued in db.push_outbox and delivered by background workers with exponential backoff
+PUSH_OUTBOX_WORKERS = int(os.environ.get('PUSH_OUTBOX_WORKERS', '8'))
+PUSH_MAX_ATTEMPTS = int(os.environ.get('PUSH_MAX_ATTEMPTS', '8'))
+PUSH_RETRY_BASE_DELAY = float(os.environ.get('PUSH_RETRY_BASE_DELAY', '5'))
+
+def get_vapid_config() -> Tuple[Optional[str], Dict[str, Any]]:
+    """VAPID private key and claims for the outbox workers, read at send time"""
+    return os.environ.get('VAPID_PRIVATE_KEY'), {"sub": os.environ.get('VAPID_EMAIL', 'mailto:admin@device-chat.com')}
+
+async def prune_push_subscription(job: Dict[str, Any]):
+    """The push service reported the subscription gone (404/410)"""
+    await db.push_subscriptions.delete_one({"id": job["subscription_id"]})
+    logging.info(f"Removed invalid subscription: {job['subscription_id']}")
+
+# Priority lanes: HIGH alerts are claimed first; per-second rate limits keep routine lanes in check (0 = unlimited).
+# The lane wait is left unbounded here: deliveries already wait durably in the outbox, nobody is blocked on them.
+PUSH_LANE_RATES = os.environ.get('PUSH_LANE_RATES', 'HIGH=0,MEDIUM=50,LOW=10')
+push_scheduler = PriorityScheduler("push", concurrency=PUSH_OUTBOX_WORKERS, rates=parse_lane_rates(PUSH_LANE_RATES))
+
+push_outbox = PushOutbox(
+    lambda: db.push_outbox,
+    push_dispatcher,
+    get_vapid_config,
+    on_gone=prune_push_subscription,
+    scheduler=push_scheduler,
+    workers=PUSH_OUTBOX_WORKERS,
+    max_attempts=PUSH_MAX_ATTEMPTS,
+    base_delay=PUSH_RETRY_BASE_DELAY
+)
+
+def build_push_payload(notification: PushNotificationTemplate) -> Dict[str, Any]:
+    """Web Push payload for the service worker"""
     payload = {
         "title": notification.title,
         "body": notification.body,
@@ -1195,84 +1629,179 @@ async def send_push_notification(notification: PushNotificationRequest):
             payload["data"]["rtmp_code"] = notification.rtmp_code
     except Exception as _:
         pass
+    return payload
+
+def build_notification_record(notification: PushNotificationTemplate, user_id: str) -> Notification:
+    """History record stored for every push sent to a user"""
+    return Notification(
+        user_id=user_id,
+        device_id=notification.device_id,
+        type='push',
+        content=f"{notification.title}: {notification.body}",
+        media_url=notification.video_url or notification.image,
+        read=False,
+        timestamp=datetime.utcnow(),
+        # Extended metadata
+        camera_id=notification.camera_id or notification.device_id,
+        camera_name=notification.camera_name,
+        mission_id=notification.mission_id,
+        mission_name=notification.mission_name,
+        user_email=notification.user_email,
+        video_url=notification.video_url,
+        image_url=notification.image_url or notification.image,
+        rtmp_code=notification.rtmp_code
+    )
+
+@api_router.post("/push/send")
+async def send_push_notification(notification: PushNotificationRequest):
+    """Send push notification to user's subscribed devices"""
     
-    # VAPID keys from environment variables
-    vapid_private_key = os.environ.get('VAPID_PRIVATE_KEY')
+    # Get user's push subscriptions
+    subscriptions = await db.push_subscriptions.find({"user_id": notification.user_id}).to_list(100)
+    
+    if not subscriptions:
+        return {"success": False, "message": "No push subscriptions found for user"}
+    
+    payload = build_push_payload(notification)
+    
+    # VAPID keys from environment variables (the outbox workers sign with the same config)
+    vapid_private_key = get_vapid_config()[0]
     vapid_public_key = os.environ.get('VAPID_PUBLIC_KEY')
-    vapid_email = os.environ.get('VAPID_EMAIL', 'mailto:admin@device-chat.com')
     
     if not vapid_private_key or not vapid_public_key:
         logging.warning("VAPID keys not configured properly")
         return {
             "success": False,
             "message": "Push notifications not configured. Please set VAPID keys in environment variables.",
-            "sent_count": 0,
-            "failed_count": len(subscriptions),
+            "error": "vapid_not_configured",
+            "queued_count": 0,
+            "job_ids": [],
             "total_subscriptions": len(subscriptions)
         }
     
-    # Send to all subscriptions
-    for subscription in subscriptions:
-        try:
-            webpush(
-                subscription_info={
-                    "endpoint": subscription["endpoint"],
-                    "keys": subscription["keys"]
-                },
-                data=json.dumps(payload),
-                vapid_private_key=vapid_private_key,
-                vapid_claims={
-                    "sub": vapid_email
-                }
-            )
-            sent_count += 1
-            
-        except WebPushException as e:
-            logging.error(f"Failed to send push notification: {e}")
-            failed_count += 1
-            
-            # Remove invalid subscriptions
-            if e.response and e.response.status_code == 410:
-                await db.push_subscriptions.delete_one({"id": subscription["id"]})
-                logging.info(f"Removed invalid subscription: {subscription['id']}")
-                
-        except Exception as e:
-            logging.error(f"Unexpected error sending push notification: {e}")
-            failed_count += 1
+    # Queue one delivery per subscription; the outbox workers send, retry and prune
+    job_ids = await push_outbox.enqueue(
+        subscriptions,
+        json.dumps(payload),
+        device_id=notification.device_id,
+        lane=lane_from_data(notification.data, notification.alert_level)
+    )
     
     # Store notification in database for history (regardless of push success)
     try:
-        notification_record = Notification(
-            user_id=notification.user_id,
-            device_id=notification.device_id,
-            type='push',
-            content=f"{notification.title}: {notification.body}",
-            media_url=notification.video_url or notification.image,
-            read=False,
-            timestamp=datetime.utcnow(),
-            # Extended metadata
-            camera_id=notification.camera_id or notification.device_id,
-            camera_name=notification.camera_name,
-            mission_id=notification.mission_id,
-            mission_name=notification.mission_name,
-            user_email=notification.user_email,
-            video_url=notification.video_url,
-            image_url=notification.image_url or notification.image,
-            rtmp_code=notification.rtmp_code
-        )
-        await db.notifications.insert_one(notification_record.dict())
+        await db.notifications.insert_one(build_notification_record(notification, notification.user_id).dict())
         logging.info(f"Stored notification in database for user {notification.user_id}, device {notification.device_id}")
     except Exception as e:
         logging.error(f"Failed to store notification in database: {e}")
     
     return {
-        "success": sent_count > 0,
-        "message": f"Sent {sent_count} notifications, {failed_count} failed",
-        "sent_count": sent_count,
-        "failed_count": failed_count,
+        "success": len(job_ids) > 0,
+        "message": f"Queued {len(job_ids)} notifications for delivery",
+        "queued_count": len(job_ids),
+        "job_ids": job_ids,
         "total_subscriptions": len(subscriptions)
     }
 
+@api_router.post("/push/send-batch")
+async def send_push_notification_batch(batch: PushBatchRequest):
+    """Send one push to many users: the listed user_ids, or everyone with a mission named mission_name"""
+    user_ids = list(dict.fromkeys(batch.user_ids or []))
+    if not user_ids and batch.mission_name:
+        user_ids = await db.missions.distinct("user_id", {"mission_name": batch.mission_name})
+    if not user_ids:
+        raise HTTPException(status_code=400, detail="Provide user_ids or a mission_name that has members")
+    
+    vapid_private_key = os.environ.get('VAPID_PRIVATE_KEY')
+    vapid_public_key = os.environ.get('VAPID_PUBLIC_KEY')
+    if not vapid_private_key or not vapid_public_key:
+        logging.warning("VAPID keys not configured properly")
+        return {
+            "success": False,
+            "message": "Push notifications not configured. Please set VAPID keys in environment variables.",
+            "recipients": len(user_ids),
+            "queued_count": 0
+        }
+    
+    # One lookup for every recipient's subscriptions, one payload for all of them
+    subscriptions = await db.push_subscriptions.find({"user_id": {"$in": user_ids}}).to_list(None)
+    # Stored subscriptions without an endpoint or keys can never be delivered; drop them now
+    invalid = [sub for sub in subscriptions if not sub.get("endpoint") or not sub.get("keys")]
+    if invalid:
+        await db.push_subscriptions.delete_many({"id": {"$in": [sub.get("id") for sub in invalid]}})
+        logging.info(f"Removed {len(invalid)} invalid push subscriptions")
+        subscriptions = [sub for sub in subscriptions if sub.get("endpoint") and sub.get("keys")]
+    subscribed_users = list(dict.fromkeys(sub["user_id"] for sub in subscriptions))
+    job_ids = await push_outbox.enqueue(
+        subscriptions,
+        json.dumps(build_push_payload(batch)),
+        device_id=batch.device_id,
+        lane=lane_from_data(batch.data, batch.alert_level)
+    )
+    
+    # Per-recipient outcome, in the order the user_ids were given
+    results = {user_id: {"user_id": user_id, "queued_count": 0, "job_ids": [], "pruned_subscriptions": 0}
+               for user_id in user_ids}
+    for sub, job_id in zip(subscriptions, job_ids):
+        results[sub["user_id"]]["queued_count"] += 1
+        results[sub["user_id"]]["job_ids"].append(job_id)
+    for sub in invalid:
+        results[sub["user_id"]]["pruned_subscriptions"] += 1
+    
+    if subscribed_users:
+        try:
+            await db.notifications.insert_many(
+                [build_notification_record(batch, user_id).dict() for user_id in subscribed_users],
+                ordered=False
+            )
+        except Exception as e:
+            logging.error(f"Failed to store batch notifications in database: {e}")
+    
+    return {
+        "success": len(job_ids) > 0,
+        "message": f"Queued {len(job_ids)} notifications for {len(subscribed_users)} of {len(user_ids)} users",
+        "recipients": len(user_ids),
+        "users_without_subscriptions": [u for u in user_ids if u not in set(subscribed_users)],
+        "queued_count": len(job_ids),
+        "total_subscriptions": len(subscriptions),
+        "pruned_subscriptions": len(invalid),
+        "results": list(results.values())
+    }
+
+def summarize_coalesced_alerts(alert: PushNotificationRequest, count: int) -> PushNotificationRequest:
+    """One push standing in for the alerts suppressed during a coalescing window"""
+    events = "event" if count == 1 else "events"
+    data = {**(alert.data or {}), "coalesced_count": count}
+    return alert.copy(update={"body": f"{count} more {events}. Latest: {alert.body}", "data": data})
+
+# Significant-activity pushes per (user, device) are limited to one per window; the rest are merged
+PUSH_COALESCE_WINDOW = float(os.environ.get('PUSH_COALESCE_WINDOW', '60'))
+alert_coalescer = AlertCoalescer(send_push_notification, summarize_coalesced_alerts, window=PUSH_COALESCE_WINDOW)
+
+@api_router.get("/push/outbox/stats")
+async def get_push_outbox_stats():
+    """Push outbox backlog and delivery counters for this worker"""
+    return {**await push_outbox.stats(), "coalescer": alert_coalescer.stats()}
+
+@api_router.get("/llm/sessions/stats")
+async def get_llm_session_stats():
+    """LLM client pool size, hit rate and settings cache counters for this worker"""
+    return chat_sessions.stats()
+
+@api_router.get("/llm/admission/stats")
+async def get_llm_admission_stats():
+    """LLM admission control: active and queued calls, queue wait times and rejections by reason"""
+    return llm_admission.stats()
+
+@api_router.get("/llm/cache/stats")
+async def get_llm_cache_stats():
+    """LLM response cache size and hit/miss counters for this worker"""
+    return llm_cache.stats()
+
+@api_router.get("/scheduler/stats")
+async def get_scheduler_stats():
+    """Queue depth and wait times per priority lane for push delivery and vision analysis"""
+    return {"push": push_scheduler.stats(), "vision": vision_scheduler.stats()}
+
 @api_router.get("/push/subscriptions/{user_id}")
 async def get_user_push_subscriptions(user_id: str):
     """Get all push subscriptions for a user"""
@@ -1280,9 +1809,11 @@ async def get_user_push_subscriptions(user_id: str):
     return [PushSubscription(**sub) for sub in subscriptions]
 
 # Chat Endpoints
-@api_router.post("/chat/send")
-async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
-    """Send a chat message with optional file attachments, media URLs, and message references"""
+async def chat_send_events(user_id: str, message_data: ChatMessageCreate, stream: bool = False) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """Process a chat message with optional file attachments, media URLs, and message references.
+    Yields (event, data) as it goes: "message" once the user message is stored, "delta" for each
+    chunk of the AI reply when stream=True, "push" with the notification outcome, and last
+    "result" with the /chat/send response."""
     
     try:
         # Extract data from the model
@@ -1310,10 +1841,55 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
         file_attachments = []
         file_contents_for_ai = []
         
+        # Everything the message needs from the DB in one concurrent step: a single device load,
+        # one $in query each for attachments and referenced messages, command parsing and the prompt context
+        async def load_file_records() -> Dict[str, Dict[str, Any]]:
+            if not file_ids:
+                return {}
+            records = await db.file_uploads.find({"id": {"$in": file_ids}}).to_list(None)
+            return {record["id"]: record for record in records}
+        
+        async def load_referenced_messages() -> Dict[str, Dict[str, Any]]:
+            if not referenced_messages:
+                return {}
+            docs = await db.chat_messages.find({"id": {"$in": referenced_messages}}).to_list(None)
+            return {doc["id"]: doc for doc in docs}
+        
+        # One precompiled scan decides which command handlers (if any) need to run
+        intents = intent_matcher.classify(message)
+        if not intents.camera_prompt and not intents.settings_command:
+            # This message will need the model: refuse now, before storing anything, if it can't get a slot
+            llm_admission.check(user_id)
+        
+        async def no_command(result: Dict[str, Any]) -> Dict[str, Any]:
+            return result
+        
+        (
+            device,
+            file_records,
+            referenced_docs,
+            camera_prompt_result,
+            role_change_result,
+            conversation_context
+        ) = await asyncio.gather(
+            db.devices.find_one({"id": device_id}),
+            load_file_records(),
+            load_referenced_messages(),
+            parse_camera_prompt_text(user_id, device_id, message, intents) if intents.camera_prompt
+            else no_command({"success": True, "settings_updated": False}),
+            apply_settings_command(RoleChangeCommand(
+                user_id=user_id,
+                device_id=device_id,
+                message=message
+            ), intents) if intents.has_settings_intent
+            else no_command({"success": False, "detected": "none", "settings_updated": False}),
+            chat_context.build(user_id, device_id)
+        )
+        
         if file_ids:
             print(f"DEBUG: Processing {len(file_ids)} file IDs: {file_ids}")
             for file_id in file_ids:
-                file_record = await db.file_uploads.find_one({"id": file_id})
+                file_record = file_records.get(file_id)
                 if file_record:
                     print(f"DEBUG: Found file record for {file_id}: {file_record['original_filename']}")
                     file_info = {
@@ -1390,9 +1966,8 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                 first_image = u
             if not first_video and is_video_url_fn(u):
                 first_video = u
-        # Load device settings for defaults
-        device_for_defaults = await db.devices.find_one({"id": device_id})
-        dev_settings = (device_for_defaults or {}).get('settings', {}) if device_for_defaults else {}
+        # Device settings for defaults
+        dev_settings = (device or {}).get('settings', {}) if device else {}
 
         req_camera_id = (message_data.camera_id if hasattr(message_data, 'camera_id') else None) or device_id
         req_mission_id = (message_data.mission_id if hasattr(message_data, 'mission_id') else None) or None
@@ -1417,14 +1992,6 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
         
         print(f"DEBUG: Final has_images value: {has_images}")
         
-        # Check for camera prompt and role/instruction change commands before processing
-        camera_prompt_result = await parse_camera_prompt_text(user_id, device_id, message)
-        role_change_result = await parse_role_change_command(RoleChangeCommand(
-            user_id=user_id,
-            device_id=device_id,
-            message=message
-        ))
-        
         # Store user message
         user_chat_msg = ChatMessage(
             user_id=user_id,
@@ -1444,6 +2011,7 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
             sound_id=req_sound_id
         )
         await db.chat_messages.insert_one(user_chat_msg.dict())
+        yield "message", {"message_id": user_chat_msg.id, "device_id": device_id}
         
         # If camera prompt update was detected (preferred per user), return confirmation and skip AI
         if camera_prompt_result.get("success") and camera_prompt_result.get("settings_updated"):
@@ -1456,7 +2024,7 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
             )
             await db.chat_messages.insert_one(confirmation_msg.dict())
             
-            return {
+            yield "result", {
                 "success": True,
                 "message_id": user_chat_msg.id,
                 "camera_prompt_changed": True,
@@ -1467,6 +2035,7 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                     "new_instructions": camera_prompt_result.get("instructions")
                 }
             }
+            return
 
         # If role change was detected, return confirmation and skip AI processing
         if role_change_result["success"] and role_change_result["settings_updated"]:
@@ -1479,7 +2048,7 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
             )
             await db.chat_messages.insert_one(confirmation_msg.dict())
             
-            return {
+            yield "result", {
                 "success": True,
                 "message_id": user_chat_msg.id,
                 "role_changed": True,
@@ -1491,23 +2060,21 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                     "new_instructions": role_change_result.get("new_instructions")
                 }
             }
+            return
         
-        # Get device info for AI personality
-        device = await db.devices.find_one({"id": device_id})
+        # Device info for AI personality
         if not device:
-            return {"success": False, "error": "Device not found"}
+            yield "result", {"success": False, "error": "Device not found"}
+            return
         
         device_type = device.get("type", "default")
         session_id = f"{user_id}_{device_id}"
         
-        # Get chat history for context
-        history = await get_chat_history(user_id, device_id)
-        
         # Prepare context for AI if there are referenced messages
         context_messages = []
         if referenced_messages:
             for ref_msg_id in referenced_messages:
-                ref_msg = await db.chat_messages.find_one({"id": ref_msg_id})
+                ref_msg = referenced_docs.get(ref_msg_id)
                 if ref_msg:
                     context_messages.append({
                         "id": ref_msg["id"],
@@ -1517,9 +2084,17 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                         "file_attachments": ref_msg.get("file_attachments", [])
                     })
         
+        # Conversation so far, held to a fixed token budget. It goes in front of the prompt and
+        # changes every turn, so the response cache keys on what follows it.
+        context_prefix = ""
+        if conversation_context:
+            context_prefix = f"{conversation_context}\n\n" + ("" if context_messages else "Current message: ")
+        
         # Generate AI response with context
         try:
-            ai_chat = await get_ai_chat_instance(device_type, session_id, has_images, user_id, device_id)
+            ai_chat = await get_ai_chat_instance(device_type, session_id, has_images, user_id, device_id, streaming=stream,
+                                                 cache=True, cache_bypass=bool(message_data.no_cache),
+                                                 cache_context=context_prefix)
             
             # Build enhanced prompt with context
             enhanced_message = message
@@ -1535,6 +2110,8 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                             context_text += f"  🔗 {url}\n"
                 enhanced_message = f"{context_text}\nCurrent message: {message}"
             
+            enhanced_message = context_prefix + enhanced_message
+            
             # Create the user message with proper vision support
             if has_images:
                 print("DEBUG: Using vision model with images detected")
@@ -1586,7 +2163,14 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                 user_message = UserMessage(text=text_content)
             
             print(f"DEBUG: Sending message to AI with has_images={has_images}")
-            ai_response = await ai_chat.send_message(user_message)
+            if stream:
+                parts = []
+                async for delta in stream_reply(ai_chat, user_message):
+                    yield "delta", {"index": len(parts), "delta": delta}
+                    parts.append(delta)
+                ai_response = "".join(parts)
+            else:
+                ai_response = await ai_chat.send_message(user_message)
             
             # Build AI metadata
             ai_title = 'AI Analysis'
@@ -1614,6 +2198,7 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
 
 
             # Send push for significant AI response when images were involved
+            push_status = "none"
             try:
                 if has_images:
                     low = (ai_response or '').lower()
@@ -1651,12 +2236,16 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                             },
                             require_interaction=True
                         )
-                        await send_push_notification(push_req)
+                        push_status = "sent" if await alert_coalescer.submit(push_req) else "coalesced"
+                    else:
+                        push_status = "not_significant"
             except Exception as e:
+                push_status = "failed"
                 logging.warning(f"Failed to send push for chat AI response: {e}")
+            yield "push", {"status": push_status}
             
             # Update chat history with both messages
-            history.extend([
+            await append_chat_history(user_id, device_id, [
                 {
                     "id": user_chat_msg.id,
                     "message": message,
@@ -1672,21 +2261,18 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                     "timestamp": ai_chat_msg.timestamp.isoformat()
                 }
             ])
+            chat_context.schedule_refresh(user_id, device_id)
             
-            # Store updated history
-            await store_chat_history(user_id, device_id, history)
+            # Send AI response via WebSocket; the socket may live on another worker
+            await manager.send_personal_message({
+                "type": "ai_response",
+                "device_id": device_id,
+                "message": ai_response,
+                "message_id": ai_chat_msg.id,
+                "timestamp": ai_chat_msg.timestamp.isoformat()
+            }, user_id)
             
-            # Send AI response via WebSocket if connected
-            if user_id in manager.active_connections:
-                await manager.send_personal_message({
-                    "type": "ai_response",
-                    "device_id": device_id,
-                    "message": ai_response,
-                    "message_id": ai_chat_msg.id,
-                    "timestamp": ai_chat_msg.timestamp.isoformat()
-                }, user_id)
-            
-            return {
+            yield "result", {
                 "success": True, 
                 "message_id": user_chat_msg.id,
                 "ai_response": {
@@ -1694,10 +2280,26 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                     "message_id": ai_chat_msg.id
                 }
             }
+            return
             
+        except AdmissionRejected as rejected:
+            # The user message is already stored and delivered, so this is no longer a 429:
+            # answering one would make clients that honour Retry-After store it a second time
+            logging.warning(f"AI response for {user_id}/{device_id} not admitted: {rejected}")
+            yield "result", {
+                "success": True,
+                "message_id": user_chat_msg.id,
+                "ai_response": {
+                    "message": "I'm handling too many requests right now, please ask again in a moment.",
+                    "error": True,
+                    "reason": rejected.reason,
+                    "retry_after": rejected.retry_after_header
+                }
+            }
+            return
         except Exception as ai_error:
             logging.error(f"AI response failed: {ai_error}")
-            return {
+            yield "result", {
                 "success": True, 
                 "message_id": user_chat_msg.id,
                 "ai_response": {
@@ -1705,11 +2307,151 @@ async def send_chat_message(user_id: str, message_data: ChatMessageCreate):
                     "error": True
                 }
             }
+            return
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logging.error(f"Failed to send chat message: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.post("/chat/send")
+async def send_chat_message(user_id: str, message_data: ChatMessageCreate, async_mode: bool = Query(False, alias="async")):
+    """Send a chat message with optional file attachments, media URLs, and message references.
+    With ?async=true the user message is stored and the AI reply is left to a background
+    worker: the response is 202 with a job id, and the result arrives over the WebSocket
+    (ai_response and chat_job frames) and from GET /chat/jobs/{job_id}."""
+    if async_mode:
+        return await enqueue_chat_job(user_id, message_data)
+    async for event, data in chat_send_events(user_id, message_data):
+        if event == "result":
+            return data
+
+async def enqueue_chat_job(user_id: str, message_data: ChatMessageCreate):
+    if not chat_jobs.reserve():
+        raise HTTPException(status_code=503, detail="Chat job queue is full, try again shortly", headers={"Retry-After": "5"})
+    
+    # Run up to the point the user message is stored; the worker resumes from there
+    events = chat_send_events(user_id, message_data).__aiter__()
+    try:
+        event, data = await events.__anext__()
+    except BaseException:
+        chat_jobs.release()
+        raise
+    if event == "result":
+        chat_jobs.release()
+        return data
+    
+    job_id = str(uuid.uuid4())
+    device_id = message_data.device_id
+    
+    async def run():
+        try:
+            result = None
+            async for event, data in events:
+                if event == "result":
+                    result = data
+        except Exception as e:
+            await manager.send_personal_message({
+                "type": "chat_job",
+                "job_id": job_id,
+                "device_id": device_id,
+                "status": "failed",
+                "error": getattr(e, "detail", None) or str(e)
+            }, user_id)
+            raise
+        await manager.send_personal_message({
+            "type": "chat_job",
+            "job_id": job_id,
+            "device_id": device_id,
+            "status": "done",
+            "result": result
+        }, user_id)
+        return result
+    
+    try:
+        await chat_jobs.submit(job_id, run, user_id=user_id, device_id=device_id, message_id=data["message_id"])
+    except Exception as e:
+        await events.aclose()
+        logging.error(f"Failed to queue chat job: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    
+    return JSONResponse(status_code=202, content={
+        "success": True,
+        "job_id": job_id,
+        "status": "queued",
+        "message_id": data["message_id"],
+        "status_url": f"/api/chat/jobs/{job_id}"
+    })
+
+@api_router.get("/chat/jobs/stats")
+async def get_chat_job_stats():
+    """Async chat job queue depth, wait times and worker utilization for this worker"""
+    return chat_jobs.stats()
+
+@api_router.get("/chat/jobs/{job_id}")
+async def get_chat_job(job_id: str):
+    """Status of an async chat job; once done, result holds the usual /chat/send response"""
+    job = await chat_jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Chat job not found")
+    return job
+
+def sse_event(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@api_router.post("/chat/send/stream")
+async def send_chat_message_stream(user_id: str, message_data: ChatMessageCreate):
+    """Server-Sent Events variant of /chat/send (same body). Emits "message" with the stored user
+    message id right away, "delta" events with the AI reply as it is generated, then "done" with
+    the /chat/send response plus push_status ("error" if the message could not be processed).
+    Comment lines every SSE_KEEPALIVE_INTERVAL seconds keep proxies from timing out while a
+    vision model is still thinking."""
+    
+    # Run up to the stored user message before answering, so a refused or failed request
+    # still gets a proper status code (429 / 500) instead of an error event
+    iterator = chat_send_events(user_id, message_data, stream=True).__aiter__()
+    first = await iterator.__anext__()
+    
+    async def events():
+        pending = asyncio.get_running_loop().create_future()
+        pending.set_result(first)
+        push_status = "none"
+        try:
+            while True:
+                done, _ = await asyncio.wait({pending}, timeout=SSE_KEEPALIVE_INTERVAL)
+                if not done:
+                    yield ": keep-alive\n\n"
+                    continue
+                try:
+                    event, data = pending.result()
+                except StopAsyncIteration:
+                    break
+                except HTTPException as e:
+                    yield sse_event("error", {"success": False, "error": e.detail})
+                    break
+                except AdmissionRejected as e:
+                    yield sse_event("error", {"success": False, "error": str(e), "retry_after": e.retry_after_header})
+                    break
+                if event == "push":
+                    push_status = data["status"]
+                elif event == "result":
+                    yield sse_event("done", {**data, "push_status": push_status})
+                else:
+                    yield sse_event(event, data)
+                pending = asyncio.ensure_future(iterator.__anext__())
+        finally:
+            # Client went away mid-reply: stop generating
+            if not pending.done():
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+            await iterator.aclose()
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
 @api_router.get("/chat/{user_id}/{device_id}", response_model=List[ChatMessage])
 async def get_chat_messages(user_id: str, device_id: str, limit: int = 50):
     messages = await db.chat_messages.find({
@@ -1751,6 +2493,7 @@ async def clear_chat_history(user_id: str, device_id: str):
             "user_id": user_id,
             "device_id": device_id
         })
+        await chat_context.clear(user_id, device_id)
         
         # Delete from chat_messages collection
         result = await db.chat_messages.delete_many({
@@ -1827,10 +2570,18 @@ async def simulate_device_notification(
             media_url=media_url,
             sender='device'
         )
-        await db.chat_messages.insert_one(chat_msg.dict())
+        await manager.device_message_writer.add(chat_msg.dict())
     
     return {"success": success, "message": "Notification sent" if success else "User not connected"}
 
+# Vision calls for camera images are admitted by priority lane, so HIGH events skip the routine backlog
+VISION_CONCURRENCY = int(os.environ.get('VISION_CONCURRENCY', '4'))
+VISION_LANE_RATES = os.environ.get('VISION_LANE_RATES', 'HIGH=0,MEDIUM=5,LOW=1')
+VISION_MAX_QUEUE = int(os.environ.get('VISION_MAX_QUEUE', '50'))
+VISION_MAX_WAIT = float(os.environ.get('VISION_MAX_WAIT', '15'))
+vision_scheduler = PriorityScheduler("vision", concurrency=VISION_CONCURRENCY, rates=parse_lane_rates(VISION_LANE_RATES),
+                                     max_queue=VISION_MAX_QUEUE, max_wait=VISION_MAX_WAIT)
+
 # Direct Image Chat API
 @api_router.post("/chat/image-direct")
 async def send_image_directly_to_chat(user_id: str, image_chat: DirectImageChatCreate):
@@ -1838,6 +2589,7 @@ async def send_image_directly_to_chat(user_id: str, image_chat: DirectImageChatC
     Supports base64 image_data, single image_url, or multiple media_urls (image URLs).
     AI decides whether to display in chat based on camera prompt and content."""
     
+    llm_admission.check(user_id)
     try:
         device_id = image_chat.device_id
         
@@ -1857,7 +2609,12 @@ async def send_image_directly_to_chat(user_id: str, image_chat: DirectImageChatC
         session_id = f"{user_id}_{device_id}_direct"
         
         # Use vision model for image analysis
-        ai_chat = await get_ai_chat_instance(device_type, session_id, has_images=True, user_id=user_id, device_id=device_id)
+        # Admission (per-user rate and concurrency) is settled before a vision lane slot is taken,
+        # so one user's rate wait never holds a slot other users' HIGH images need, and the global
+        # admission slot is only taken once the lane lets the call through
+        lane = lane_from_data(None, image_chat.alert_level)
+        ai_chat = await get_ai_chat_instance(device_type, session_id, has_images=True, user_id=user_id, device_id=device_id,
+                                             cache=True, cache_bypass=bool(image_chat.no_cache), vision_lane=lane)
         
         # Create enhanced prompt with camera instructions
         base_message = image_chat.question or "Analyze this image from the camera."
@@ -2042,9 +2799,10 @@ If this shows something noteworthy, provide detailed analysis.
                           "message_id": ai_chat_msg.id,
                           "video_url": image_chat.video_url if image_chat.video_url else (image_chat.media_urls[0] if (image_chat.media_urls and any(image_chat.media_urls[0].lower().endswith(ext) for ext in [".mp4", ".mov", ".webm", ".mkv"])) else None)
                       },
-                      require_interaction=True
+                      require_interaction=True,
+                      alert_level=lane
                   )
-                  await send_push_notification(push_req)
+                  await alert_coalescer.submit(push_req)
                 except Exception as e:
                   logging.warning(f"Failed to send push notification for displayed_in_chat: {e}")
             
@@ -2056,10 +2814,14 @@ If this shows something noteworthy, provide detailed analysis.
                 "analysis_type": "significant" if display_in_chat else "routine"
             }
             
+        except AdmissionRejected:
+            raise
         except Exception as e:
             print(f"ERROR: Vision analysis failed: {e}")
             return {"success": False, "error": f"Vision analysis failed: {str(e)}"}
             
+    except AdmissionRejected:
+        raise
     except Exception as e:
         print(f"ERROR: Direct image chat failed: {e}")
         return {"success": False, "error": str(e)}
@@ -2350,38 +3112,15 @@ async def global_chat_history(user_id: str, limit: int = 100):
         it.pop("_id", None)
     return {"success": True, "messages": list(reversed(items))}
 
-async def parse_camera_prompt_text(user_id: str, device_id: str, message: str) -> Dict[str, Any]:
+async def parse_camera_prompt_text(user_id: str, device_id: str, message: str, intents: Optional[ChatIntents] = None) -> Dict[str, Any]:
     """Detect natural language instructions to update camera prompt from a chat message.
     Returns a dict with keys: success, settings_updated, instructions, prompt_text, confirmation_message
     """
-    import re
-
-    text = (message or '').strip()
-    lowered = text.lower()
-
-    if not text:
+    if not (message or '').strip():
         return {"success": False, "settings_updated": False}
 
-    patterns = [
-        r"monitor for\s+(.+)$",
-        r"update camera prompt to\s+(.+)$",
-        r"update prompt to\s+(.+)$",
-        r"please monitor\s+(.+)$",
-        r"look for\s+(.+)$",
-        r"watch for\s+(.+)$",
-    ]
-
-    instructions = None
-    for p in patterns:
-        m = re.search(p, lowered)
-        if m:
-            instructions = m.group(1).strip()
-            break
-
-    if not instructions:
-        # Fallback: if intent words exist, use the whole message as instructions
-        if any(kw in lowered for kw in ["prompt", "monitor", "watch for", "look for"]):
-            instructions = text
+    intents = intents or intent_matcher.classify(message)
+    instructions = intents.camera_prompt
 
     if not instructions:
         return {"success": True, "settings_updated": False}
@@ -2455,11 +3194,18 @@ async def camera_prompt_fix_from_feedback(command: CameraPromptFixCommand) -> Di
         
         # Use AI to analyze the feedback and update instructions
         session_id = f"prompt_fix_{user_id}_{device_id}"
-        ai_chat = LlmChat(
-            api_key=os.environ.get('OPENAI_API_KEY'),
-            session_id=session_id,
-            system_message="You are an AI assistant that helps refine camera monitoring instructions based on user feedback."
-        ).with_model("openai", "gpt-4o-mini")
+        system_message = "You are an AI assistant that helps refine camera monitoring instructions based on user feedback."
+        ai_chat = CachedLlmChat(
+            AdmittedLlmChat(LlmChat(
+                api_key=os.environ.get('OPENAI_API_KEY'),
+                session_id=session_id,
+                system_message=system_message
+            ).with_model("openai", "gpt-4o-mini"), llm_admission, user_id),
+            llm_cache,
+            "gpt-4o-mini",
+            system_message,
+            bypass=bool(command.no_cache)
+        )
         
         analysis_prompt = f"""
 Current camera monitoring instructions: {current_prompt['instructions']}
@@ -2585,6 +3331,9 @@ async def update_chat_settings(user_id: str, device_id: str, settings_update: Ch
         await db.chat_settings.insert_one(new_settings.dict())
         updated_settings = new_settings.dict()
     
+    # Role / instruction commands land here too; pooled clients still carry the old system message
+    chat_sessions.invalidate((user_id, device_id))
+    
     return {
         "success": True,
         "message": "Chat settings updated successfully",
@@ -2599,13 +3348,16 @@ async def update_chat_settings(user_id: str, device_id: str, settings_update: Ch
 @api_router.post("/chat/settings/parse-command")
 async def parse_role_change_command(command: RoleChangeCommand):
     """Parse natural language commands to change AI role/instructions"""
+    return await apply_settings_command(command, intent_matcher.classify(command.message))
+
+async def apply_settings_command(command: RoleChangeCommand, intents: ChatIntents) -> Dict[str, Any]:
+    """Carry out the prompt fix / role / instruction / reset command found in a message"""
     
-    message = command.message.lower()
     user_id = command.user_id
     device_id = command.device_id
 
-    # If user is giving corrective feedback about analysis, route to prompt-fix flow
-    if any(k in message for k in ["wrong", "mistake", "incorrect", "should have", "shouldn't", "misclassified", "false positive", "false alarm", "it was"]) and len(message.split()) > 3:
+    # If user is confidently giving corrective feedback about analysis, route to prompt-fix flow
+    if intents.prompt_fix:
         # Try to use the last AI message as context automatically
         last_ai = await db.chat_messages.find({"user_id": user_id, "device_id": device_id, "sender": "ai"}).sort("timestamp", -1).limit(1).to_list(1)
         last_ai_id = last_ai[0]["id"] if last_ai else None
@@ -2621,101 +3373,68 @@ async def parse_role_change_command(command: RoleChangeCommand):
                 "new_instructions": fix_result.get("instructions")
             }
 
-    # Patterns for role changes
-    role_patterns = [
-        r"change your role to (.+)",
-        r"act as (.+)",
-        r"you are now (.+)",
-        r"become (.+)",
-        r"your new role is (.+)",
-        r"switch to (.+) mode",
-        r"be a (.+)"
-    ]
-    
-    # Patterns for instruction changes
-    instruction_patterns = [
-        r"change your instructions to (.+)",
-        r"your new instructions are (.+)",
-        r"follow these instructions: (.+)",
-        r"new instructions: (.+)",
-        r"update your instructions to (.+)"
-    ]
-    
-    import re
+    settings_command = intents.settings_command
     
     # Check for role changes
-    for pattern in role_patterns:
-        match = re.search(pattern, message)
-        if match:
-            new_role = match.group(1).strip()
-            
-            # Create appropriate system message for the role
-            system_message = f"You are {new_role}. Be helpful and respond according to this role in all your interactions."
-            
-            # Update settings
-            await update_chat_settings(user_id, device_id, ChatSettingsUpdate(
-                role_name=new_role.title(),
-                system_message=system_message
-            ))
-            
-            return {
-                "success": True,
-                "detected": "role_change",
-                "new_role": new_role.title(),
-                "confirmation_message": f"I have changed my role to {new_role}. How can I help you in this new capacity?",
-                "settings_updated": True
-            }
+    if settings_command and settings_command.kind == "role_change":
+        new_role = settings_command.argument
+        
+        # Create appropriate system message for the role
+        system_message = f"You are {new_role}. Be helpful and respond according to this role in all your interactions."
+        
+        # Update settings
+        await update_chat_settings(user_id, device_id, ChatSettingsUpdate(
+            role_name=new_role.title(),
+            system_message=system_message
+        ))
+        
+        return {
+            "success": True,
+            "detected": "role_change",
+            "new_role": new_role.title(),
+            "confirmation_message": f"I have changed my role to {new_role}. How can I help you in this new capacity?",
+            "settings_updated": True
+        }
     
     # Check for instruction changes
-    for pattern in instruction_patterns:
-        match = re.search(pattern, message)
-        if match:
-            new_instructions = match.group(1).strip()
-            
-            # Update settings
-            await update_chat_settings(user_id, device_id, ChatSettingsUpdate(
-                instructions=new_instructions,
-                system_message=f"You are an AI assistant. Follow these specific instructions: {new_instructions}"
-            ))
-            
-            return {
-                "success": True,
-                "detected": "instruction_change", 
-                "new_instructions": new_instructions,
-                "confirmation_message": f"I have updated my instructions. I will now: {new_instructions}",
-                "settings_updated": True
-            }
+    if settings_command and settings_command.kind == "instruction_change":
+        new_instructions = settings_command.argument
+        
+        # Update settings
+        await update_chat_settings(user_id, device_id, ChatSettingsUpdate(
+            instructions=new_instructions,
+            system_message=f"You are an AI assistant. Follow these specific instructions: {new_instructions}"
+        ))
+        
+        return {
+            "success": True,
+            "detected": "instruction_change", 
+            "new_instructions": new_instructions,
+            "confirmation_message": f"I have updated my instructions. I will now: {new_instructions}",
+            "settings_updated": True
+        }
     
     # Check for reset commands
-    reset_patterns = [
-        r"reset your role",
-        r"go back to default",
-        r"reset to original",
-        r"default mode",
-        r"reset instructions"
-    ]
-    
-    for pattern in reset_patterns:
-        if re.search(pattern, message):
-            # Get device type for default settings
-            device = await db.devices.find_one({"id": device_id})
-            device_type = device.get("type", "default") if device else "default"
-            default_personality = AI_PERSONALITIES.get(device_type, AI_PERSONALITIES["default"])
-            
-            # Reset to default
-            await update_chat_settings(user_id, device_id, ChatSettingsUpdate(
-                role_name=f"{device_type.title()} Assistant",
-                system_message=default_personality["system_message"],
-                instructions=None,
-                model=default_personality["model"]
-            ))
-            
-            return {
-                "success": True,
-                "detected": "reset",
-                "confirmation_message": f"I have reset to my default {device_type} assistant role.",
-                "settings_updated": True
-            }
+    if settings_command and settings_command.kind == "reset":
+        # Get device type for default settings
+        device = await db.devices.find_one({"id": device_id})
+        device_type = device.get("type", "default") if device else "default"
+        default_personality = AI_PERSONALITIES.get(device_type, AI_PERSONALITIES["default"])
+        
+        # Reset to default
+        await update_chat_settings(user_id, device_id, ChatSettingsUpdate(
+            role_name=f"{device_type.title()} Assistant",
+            system_message=default_personality["system_message"],
+            instructions=None,
+            model=default_personality["model"]
+        ))
+        
+        return {
+            "success": True,
+            "detected": "reset",
+            "confirmation_message": f"I have reset to my default {device_type} assistant role.",
+            "settings_updated": True
+        }
     
     return {
         "success": False,
@@ -2904,6 +3623,7 @@ async def get_status_checks():
 # ====================================
 
 from ai_chat_agent import ai_chat_agent
+ai_chat_agent.admission = llm_admission
 
 @api_router.post("/ai-chat/message")
 async def send_ai_chat_message(
@@ -2979,6 +3699,8 @@ async def send_ai_chat_message(
         
         return result
         
+    except AdmissionRejected:
+        raise
     except Exception as e:
         logging.error(f"AI Chat error: {e}")
         return {
@@ -3249,6 +3971,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_realtime():
+    # Indexes for the reconnect replay fallback query
+    try:
+        await db.notifications.create_index([("user_id", 1), ("timestamp", 1)])
+        await db.chat_messages.create_index([("user_id", 1), ("timestamp", 1)])
+    except Exception as e:
+        logging.warning(f"Failed to create replay indexes: {e}")
+    try:
+        # One history document per device, so concurrent upserts can't create duplicates
+        await db.chat_histories.create_index([("user_id", 1), ("device_id", 1)], unique=True)
+        await db.chat_summaries.create_index([("user_id", 1), ("device_id", 1)], unique=True)
+    except Exception as e:
+        logging.warning(f"Failed to create chat history index: {e}")
+    await manager.start()
+
+@app.on_event("startup")
+async def start_llm_cache():
+    try:
+        await llm_cache.ensure_indexes()
+    except Exception as e:
+        logging.warning(f"Failed to create LLM cache indexes: {e}")
+
+@app.on_event("startup")
+async def start_chat_jobs():
+    try:
+        await chat_jobs.ensure_indexes()
+    except Exception as e:
+        logging.warning(f"Failed to create chat job indexes: {e}")
+    chat_jobs.start()
+
+@app.on_event("startup")
+async def start_push_outbox():
+    try:
+        await push_outbox.ensure_indexes()
+    except Exception as e:
+        logging.warning(f"Failed to create push outbox indexes: {e}")
+    push_outbox.start()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await chat_jobs.stop()
+    await manager.stop()
+    alert_coalescer.close()
+    await chat_context.stop()
+    await push_outbox.stop()
+    push_dispatcher.shutdown()
     client.close()
\ No newline at end of file
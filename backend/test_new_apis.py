@@ -74,8 +74,8 @@ def test_push_notification_api():
         response = requests.post(f"{API}/push/send", json=notification_data)
         if response.status_code == 200:
             result = response.json()
-            print(f"✅ Push notification sent: {result['message']}")
-            print(f"   Sent: {result['sent_count']}, Failed: {result['failed_count']}")
+            print(f"✅ Push notification queued: {result['message']}")
+            print(f"   Queued: {result.get('queued_count', 0)}, Job IDs: {result.get('job_ids', [])}")
         else:
             print(f"❌ Send push notification failed: {response.status_code} - {response.text}")
     except Exception as e:
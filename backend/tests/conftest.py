@@ -0,0 +1,35 @@
+"""
+Unit tests for the backend's standalone modules. The backend imports its modules
+flat (from realtime import ...), so its directory goes on the path here.
+
+Tests that need server.py itself take the ``server`` fixture, which runs it against
+an in-memory mongomock database and the stub LLM. They are skipped unless the
+backend requirements and mongomock-motor are installed.
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    pytest.importorskip("emergentintegrations")
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+    os.environ.setdefault("DB_NAME", "test")
+    os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+    import server as module
+    from llm_cache import LlmResponseCache
+    from llm_clients import LlmSessionPool
+
+    monkeypatch.setattr(module, "db", mongomock_motor.AsyncMongoMockClient()["test"])
+    monkeypatch.setattr(module, "LLM_PROVIDER", "stub")
+    monkeypatch.setenv("LLM_STUB_CHUNK_DELAY", "0")
+    # Pooled clients and cached replies would otherwise carry over from earlier tests
+    monkeypatch.setattr(module, "chat_sessions", LlmSessionPool())
+    monkeypatch.setattr(module, "llm_cache", LlmResponseCache())
+    return module
@@ -0,0 +1,230 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, AdmittedLlmChat, TokenBucket
+from scheduling import PriorityScheduler
+
+
+def test_token_bucket_burst_then_rate():
+    bucket = TokenBucket(rate=2.0, burst=2)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0.0
+    bucket.reserve(now)
+    bucket.reserve(now)
+    assert bucket.wait_time(now) == pytest.approx(0.5)
+    assert bucket.wait_time(now + 0.5) == 0.0
+
+
+def test_token_bucket_reservations_queue_up():
+    bucket = TokenBucket(rate=1.0, burst=1)
+    now = bucket.updated
+    bucket.reserve(now)
+    bucket.reserve(now)  # in debt: the caller waits for this one
+    assert bucket.wait_time(now) == pytest.approx(2.0)
+
+
+def test_unlimited_bucket():
+    bucket = TokenBucket(rate=0.0)
+    for _ in range(100):
+        bucket.reserve(0.0)
+    assert bucket.wait_time(0.0) == 0.0
+    assert bucket.full(0.0)
+
+
+def test_retry_after_header_rounds_up():
+    assert AdmissionRejected("user_rate", 0.2).retry_after_header == "1"
+    assert AdmissionRejected("user_rate", 2.1).retry_after_header == "3"
+
+
+async def hold(controller, user_id, release):
+    async with controller.slot(user_id):
+        await release.wait()
+
+
+def test_user_rate_rejected_when_wait_exceeds_deadline():
+    async def run():
+        controller = AdmissionController(user_rate=1.0, user_burst=1, max_wait=0.5)
+        async with controller.slot("u"):
+            pass
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.check("u")
+        return controller, rejected.value
+
+    controller, rejected = asyncio.run(run())
+    assert rejected.reason == "user_rate"
+    assert 0.5 < rejected.retry_after <= 1.0
+    assert controller.stats()["rejected"] == {"user_rate": 1}
+
+
+def test_other_users_are_not_limited_by_a_busy_one():
+    async def run():
+        controller = AdmissionController(user_rate=1.0, user_burst=1, max_wait=0.5)
+        async with controller.slot("busy"):
+            pass
+        controller.check("other")
+        async with controller.slot("other"):
+            pass
+        return controller
+
+    assert asyncio.run(run()).admitted == 2
+
+
+def test_user_concurrency_timeout():
+    async def run():
+        controller = AdmissionController(user_concurrency=1, max_wait=0.05)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "u", release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.slot("u"):
+                pass
+        release.set()
+        await holder
+        return controller, rejected.value
+
+    controller, rejected = asyncio.run(run())
+    assert rejected.reason == "user_timeout"
+    assert controller.stats()["active"] == 0 and controller.stats()["queued"] == 0
+
+
+def test_global_concurrency_timeout():
+    async def run():
+        controller = AdmissionController(global_concurrency=1, max_wait=0.05)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "a", release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.slot("b"):
+                pass
+        release.set()
+        await holder
+        return rejected.value
+
+    assert asyncio.run(run()).reason == "global_timeout"
+
+
+def test_queue_bounds():
+    async def run():
+        controller = AdmissionController(user_concurrency=1, max_queue=10, max_user_queue=1, max_wait=5)
+        release = asyncio.Event()
+        tasks = [asyncio.create_task(hold(controller, "u", release)) for _ in range(2)]
+        await asyncio.sleep(0)
+        reasons = []
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.check("u")
+        reasons.append(rejected.value.reason)
+
+        controller.max_queue = 1
+        with pytest.raises(AdmissionRejected) as rejected:
+            controller.check("someone-else")
+        reasons.append(rejected.value.reason)
+        release.set()
+        await asyncio.gather(*tasks)
+        return reasons
+
+    assert asyncio.run(run()) == ["user_queue_full", "queue_full"]
+
+
+def test_check_takes_nothing():
+    async def run():
+        controller = AdmissionController(user_rate=1.0, user_burst=1)
+        for _ in range(5):
+            controller.check("u")
+        async with controller.slot("u"):
+            pass
+        return controller
+
+    assert asyncio.run(run()).admitted == 1
+
+
+def test_admitted_chat_runs_inside_a_slot():
+    class Chat:
+        def __init__(self, controller):
+            self.controller = controller
+            self.model = "m"
+
+        async def send_message(self, user_message):
+            return f"active={self.controller.active}"
+
+    async def run():
+        controller = AdmissionController()
+        chat = AdmittedLlmChat(Chat(controller), controller, "u")
+        return await chat.send_message("hi"), chat.model, controller.active
+
+    assert asyncio.run(run()) == ("active=1", "m", 0)
+
+
+def test_timed_out_call_gives_its_rate_tokens_back():
+    async def run():
+        controller = AdmissionController(global_concurrency=1, global_rate=0.1, global_burst=5,
+                                         user_rate=0.1, user_burst=5, max_wait=0.05)
+        release = asyncio.Event()
+        holder = asyncio.create_task(hold(controller, "a", release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected):
+            async with controller.slot("b"):
+                pass
+        release.set()
+        await holder
+        return controller
+
+    controller = asyncio.run(run())
+    # 5 - 1 (a) - 1 (b) + 1 (b's refund), plus a trickle of refill
+    assert 4 <= controller._bucket.tokens < 4.1
+    assert controller._users["b"].bucket.tokens >= 5 - 0.001
+
+
+def test_waiting_for_a_lane_holds_no_global_slot():
+    class Chat:
+        async def send_message(self, user_message):
+            return user_message
+
+    async def run():
+        controller = AdmissionController(global_concurrency=1, max_wait=5)
+        scheduler = PriorityScheduler("vision", concurrency=1)
+        lane_busy = asyncio.Event()
+
+        async def occupy_lane():
+            async with scheduler.slot("LOW"):
+                await lane_busy.wait()
+
+        occupier = asyncio.create_task(occupy_lane())
+        await asyncio.sleep(0)
+        laned = asyncio.create_task(AdmittedLlmChat(Chat(), controller, "a", scheduler, "LOW").send_message("image"))
+        await asyncio.sleep(0.01)
+        # The lane is full, but another user's plain call still gets the only global slot
+        plain = await asyncio.wait_for(AdmittedLlmChat(Chat(), controller, "b").send_message("text"), 1)
+        waiting = not laned.done()
+        lane_busy.set()
+        await occupier
+        return plain, waiting, await laned, controller.active
+
+    assert asyncio.run(run()) == ("text", True, "image", 0)
+
+
+def test_lane_rejection_releases_the_user_slot_and_tokens():
+    async def run():
+        controller = AdmissionController(user_concurrency=1, user_rate=0.1, user_burst=2, max_wait=5)
+        scheduler = PriorityScheduler("vision", concurrency=1, max_queue=1)
+        lane_busy = asyncio.Event()
+
+        async def occupy_lane():
+            async with scheduler.slot("LOW"):
+                await lane_busy.wait()
+
+        occupiers = [asyncio.create_task(occupy_lane()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionRejected) as rejected:
+            async with controller.slot("u", scheduler.slot("LOW")):
+                pass
+        async with controller.slot("u"):
+            pass
+        lane_busy.set()
+        await asyncio.gather(*occupiers)
+        return controller, rejected.value
+
+    controller, rejected = asyncio.run(run())
+    assert rejected.reason == "vision_LOW_queue_full"
+    assert controller.admitted == 1 and controller.stats()["queued"] == 0
+    assert controller._users["u"].bucket.tokens >= 1 - 0.001
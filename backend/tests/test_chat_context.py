@@ -0,0 +1,138 @@
+import asyncio
+
+from chat_context import ChatContextBuilder, count_tokens, truncate_to_tokens
+
+
+class FakeSummaries:
+    """Just enough of a Mongo collection for one summary document per device"""
+
+    def __init__(self):
+        self.documents = {}
+
+    async def find_one(self, query, projection=None):
+        document = self.documents.get((query["user_id"], query["device_id"]))
+        return dict(document) if document else None
+
+    async def update_one(self, query, update, upsert=False):
+        key = (query["user_id"], query["device_id"])
+        document = self.documents.setdefault(key, {"user_id": key[0], "device_id": key[1], **update["$setOnInsert"]})
+        document.update(update["$set"])
+        for field, amount in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + amount
+
+
+def turn(index):
+    sender = "user" if index % 2 == 0 else "ai"
+    return {"sender": sender, "message": f"turn {index} " + "word " * 20, "timestamp": f"2024-01-01T00:{index:02d}:00"}
+
+
+def make_builder(history, budget_tokens=200, keep_recent=4, summary_batch=5):
+    summaries = FakeSummaries()
+    calls = []
+
+    async def load_history(user_id, device_id, limit):
+        return history[-limit:]
+
+    async def summarizer(previous, turns, max_tokens):
+        calls.append((previous, [entry["message"].split()[1] for entry in turns]))
+        return f"{previous} summary of {len(turns)} turns".strip()
+
+    builder = ChatContextBuilder(lambda: summaries, load_history, summarizer, budget_tokens=budget_tokens,
+                                 summary_tokens=50, keep_recent=keep_recent, summary_batch=summary_batch)
+    return builder, summaries, calls
+
+
+def test_context_keeps_the_newest_turns_that_fit_the_budget():
+    history = [turn(i) for i in range(30)]
+    builder, _, _ = make_builder(history, budget_tokens=200)
+
+    context = asyncio.run(builder.build("u", "cam"))
+    assert count_tokens(context) <= 200 + 10
+    assert "turn 29 " in context
+    assert "turn 0 " not in context
+    # Oldest first, as a transcript reads
+    order = [int(line.split()[2]) for line in context.splitlines()[1:]]
+    assert order == sorted(order) and order[-1] == 29
+
+
+def test_a_single_huge_turn_is_truncated_not_dropped():
+    history = [{"sender": "user", "message": "x " * 5000, "timestamp": "2024-01-01T00:00:00"}]
+    builder, _, _ = make_builder(history, budget_tokens=400)
+
+    context = asyncio.run(builder.build("u", "cam"))
+    assert context.endswith("…")
+    assert count_tokens(context) <= 400 // 4 + 20
+
+
+def test_refresh_folds_older_turns_into_the_summary():
+    history = [turn(i) for i in range(12)]
+    builder, summaries, calls = make_builder(history, budget_tokens=2000, keep_recent=4, summary_batch=5)
+
+    async def run():
+        builder.schedule_refresh("u", "cam")
+        await asyncio.gather(*builder._tasks)
+        return await builder.build("u", "cam")
+
+    context = asyncio.run(run())
+    assert calls == [("", [str(i) for i in range(8)])]
+    assert summaries.documents[("u", "cam")]["summarized_until"] == history[7]["timestamp"]
+    assert summaries.documents[("u", "cam")]["summarized_turns"] == 8
+    # Summarized turns are replaced by the summary; the newest ones stay verbatim
+    assert context.startswith("Summary of the earlier conversation:\nsummary of 8 turns")
+    assert "turn 7 " not in context and "turn 8 " in context
+
+
+def test_refresh_waits_for_a_full_batch_then_extends_the_summary():
+    history = [turn(i) for i in range(12)]
+    builder, summaries, calls = make_builder(history, keep_recent=4, summary_batch=5)
+
+    async def refresh():
+        builder.schedule_refresh("u", "cam")
+        await asyncio.gather(*builder._tasks)
+
+    asyncio.run(refresh())
+    history.extend(turn(i) for i in range(12, 15))
+    asyncio.run(refresh())
+    assert len(calls) == 1  # only 3 new turns left the recent window
+    history.extend(turn(i) for i in range(15, 17))
+    asyncio.run(refresh())
+    assert calls[1] == ("summary of 8 turns", [str(i) for i in range(8, 13)])
+    assert summaries.documents[("u", "cam")]["summarized_turns"] == 13
+
+
+def test_failed_refresh_is_counted_and_can_be_retried():
+    history = [turn(i) for i in range(12)]
+    builder, _, _ = make_builder(history)
+
+    async def failing(previous, turns, max_tokens):
+        raise RuntimeError("model unavailable")
+
+    builder.summarizer = failing
+
+    async def refresh():
+        builder.schedule_refresh("u", "cam")
+        await asyncio.gather(*builder._tasks)
+
+    asyncio.run(refresh())
+    assert builder.refresh_failures == 1 and not builder._refreshing
+
+
+def test_truncate_to_tokens_leaves_short_text_alone():
+    assert truncate_to_tokens("short", 10) == "short"
+
+
+def test_server_context_is_summarized_with_the_configured_llm(server, monkeypatch):
+    monkeypatch.setattr(server.chat_context, "keep_recent", 2)
+    monkeypatch.setattr(server.chat_context, "summary_batch", 2)
+
+    async def run():
+        await server.append_chat_history("u", "cam", [turn(i) for i in range(6)])
+        server.chat_context.schedule_refresh("u", "cam")
+        await asyncio.gather(*server.chat_context._tasks)
+        return await server.chat_context.get_summary("u", "cam"), await server.chat_context.build("u", "cam")
+
+    summary_doc, context = asyncio.run(run())
+    assert summary_doc["summary"] and summary_doc["summarized_turns"] == 4
+    assert summary_doc["summary"][:20] in context
+    recent = context.split("Recent conversation:\n")[1]
+    assert [line.split()[2] for line in recent.splitlines()] == ["4", "5"]
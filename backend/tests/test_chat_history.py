@@ -0,0 +1,43 @@
+import asyncio
+
+
+def turn(index, sender="user"):
+    return {"sender": sender, "message": f"message {index}", "timestamp": f"2024-01-01T00:00:{index:02d}"}
+
+
+def test_concurrent_appends_keep_every_turn(server):
+    async def run():
+        await asyncio.gather(*(
+            server.append_chat_history("u", "cam", [turn(i), turn(i, "ai")]) for i in range(10)
+        ))
+        return await server.get_chat_history("u", "cam"), await server.db.chat_histories.count_documents({})
+
+    history, documents = asyncio.run(run())
+    assert documents == 1
+    assert len(history) == 20
+    # Each request's user/AI pair stays together
+    assert all(history[i]["message"] == history[i + 1]["message"] for i in range(0, 20, 2))
+
+
+def test_history_is_capped_at_the_newest_entries(server, monkeypatch):
+    monkeypatch.setattr(server, "CHAT_HISTORY_MAX", 5)
+
+    async def run():
+        for i in range(4):
+            await server.append_chat_history("u", "cam", [turn(2 * i), turn(2 * i + 1, "ai")])
+        return await server.get_chat_history("u", "cam"), await server.get_chat_history("u", "cam", limit=2)
+
+    history, last_two = asyncio.run(run())
+    assert [entry["message"] for entry in history] == [f"message {i}" for i in range(3, 8)]
+    assert [entry["message"] for entry in last_two] == ["message 6", "message 7"]
+
+
+def test_history_is_per_device(server):
+    async def run():
+        await server.append_chat_history("u", "cam", [turn(0)])
+        await server.append_chat_history("u", "door", [turn(1)])
+        return await server.get_chat_history("u", "cam"), await server.get_chat_history("u", "nothing")
+
+    cam, nothing = asyncio.run(run())
+    assert [entry["message"] for entry in cam] == ["message 0"]
+    assert nothing == []
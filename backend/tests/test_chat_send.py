@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+
+def add_device(server, device_id="cam", device_type="camera"):
+    asyncio.run(server.db.devices.insert_one({"id": device_id, "user_id": "u", "name": "Gate camera", "type": device_type}))
+
+
+def send(server, message, device_id="cam", **fields):
+    """Run chat_send_events to the end and return its events as {event: data}"""
+    async def run():
+        events = {}
+        async for event, data in server.chat_send_events("u", server.ChatMessageCreate(
+                device_id=device_id, message=message, **fields)):
+            events[event] = data
+        return events
+
+    return asyncio.run(run())
+
+
+def stored_senders(server, device_id="cam"):
+    messages = asyncio.run(server.db.chat_messages.find({"device_id": device_id}).sort("timestamp", 1).to_list(None))
+    return [message["sender"] for message in messages]
+
+
+def test_plain_message_gets_an_ai_reply(server):
+    add_device(server)
+    events = send(server, "anything at the gate?")
+
+    assert events["result"]["success"]
+    assert events["result"]["ai_response"]["message"]
+    assert events["push"] == {"status": "none"}
+    assert stored_senders(server) == ["user", "ai"]
+    history = asyncio.run(server.get_chat_history("u", "cam"))
+    assert [entry["sender"] for entry in history] == ["user", "ai"]
+
+
+def test_role_change_is_applied_without_calling_the_model(server, monkeypatch):
+    add_device(server)
+
+    async def no_model(*args, **kwargs):
+        raise AssertionError("settings commands must not reach the LLM")
+
+    monkeypatch.setattr(server, "get_ai_chat_instance", no_model)
+    events = send(server, "change your role to a night guard")
+
+    result = events["result"]
+    assert result["role_changed"] and result["ai_response"]["detected"] == "role_change"
+    settings = asyncio.run(server.db.chat_settings.find_one({"user_id": "u", "device_id": "cam"}))
+    assert settings["role_name"] == "A Night Guard"
+    assert stored_senders(server) == ["user", "ai"]
+
+
+def test_settings_command_and_context_load_run_concurrently(server, monkeypatch):
+    add_device(server)
+    apply_settings_command = server.apply_settings_command
+
+    async def slow_context(user_id, device_id):
+        await asyncio.sleep(0.2)
+        return ""
+
+    async def slow_settings(command, intents):
+        await asyncio.sleep(0.2)
+        return await apply_settings_command(command, intents)
+
+    monkeypatch.setattr(server.chat_context, "build", slow_context)
+    monkeypatch.setattr(server, "apply_settings_command", slow_settings)
+
+    started = time.monotonic()
+    events = send(server, "change your role to a night guard")
+    elapsed = time.monotonic() - started
+
+    assert events["result"]["role_changed"]
+    assert elapsed < 0.35
+
+
+def test_unknown_device_is_reported_after_the_message_is_stored(server):
+    events = send(server, "hello?", device_id="missing")
+    assert events["result"] == {"success": False, "error": "Device not found"}
+    assert stored_senders(server, "missing") == ["user"]
+
+
+def test_message_is_refused_before_storing_when_the_model_is_saturated(server, monkeypatch):
+    add_device(server)
+
+    def saturated(user_id):
+        raise server.AdmissionRejected("global_queue_full", retry_after=1.0)
+
+    monkeypatch.setattr(server.llm_admission, "check", saturated)
+    with pytest.raises(server.AdmissionRejected):
+        send(server, "anything at the gate?")
+    assert stored_senders(server) == []
+
+
+def test_repeated_chat_send_is_answered_from_the_cache(server):
+    add_device(server)
+
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            replies = []
+            for _ in range(2):
+                response = await client.post("/api/chat/send", params={"user_id": "u"},
+                                             json={"device_id": "cam", "message": "is the gate closed?"})
+                replies.append(response.json()["ai_response"]["message"])
+            return replies
+
+    hits = server.llm_cache.memory_hits
+    first, second = asyncio.run(run())
+    # The second prompt carries the first exchange as context, yet hits the cache
+    assert asyncio.run(server.chat_context.build("u", "cam"))
+    assert second == first
+    assert server.llm_cache.memory_hits == hits + 1
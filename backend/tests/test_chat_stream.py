@@ -0,0 +1,60 @@
+import asyncio
+
+
+def add_device(server):
+    asyncio.run(server.db.devices.insert_one({"id": "cam", "user_id": "u", "name": "Gate camera", "type": "camera"}))
+
+
+async def open_stream(server, message="anything at the gate?"):
+    response = await server.send_chat_message_stream("u", server.ChatMessageCreate(device_id="cam", message=message))
+    return response.body_iterator
+
+
+def event_names(chunks):
+    return [chunk.split("\n", 1)[0].replace("event: ", "") for chunk in chunks]
+
+
+def test_stream_sends_message_deltas_and_done(server):
+    add_device(server)
+
+    async def run():
+        return [chunk async for chunk in await open_stream(server)]
+
+    chunks = asyncio.run(run())
+    names = event_names(chunks)
+    assert names[0] == "message" and names[-1] == "done"
+    assert set(names[1:-1]) == {"delta"}
+    assert '"push_status": "none"' in chunks[-1]
+
+
+def test_stream_sends_keep_alives_while_the_model_is_slow(server, monkeypatch):
+    add_device(server)
+    monkeypatch.setattr(server, "SSE_KEEPALIVE_INTERVAL", 0.02)
+    monkeypatch.setenv("LLM_STUB_CHUNK_DELAY", "0.1")
+
+    async def run():
+        return [chunk async for chunk in await open_stream(server)]
+
+    chunks = asyncio.run(run())
+    assert ": keep-alive\n\n" in chunks
+    assert event_names([c for c in chunks if not c.startswith(":")])[-1] == "done"
+
+
+def test_disconnecting_stops_the_reply(server, monkeypatch):
+    add_device(server)
+    monkeypatch.setenv("LLM_STUB_CHUNK_DELAY", "0.05")
+
+    async def run():
+        body = await open_stream(server)
+        received = [await body.__anext__(), await body.__anext__()]
+        # What Starlette does when the client goes away
+        await body.aclose()
+        # Longer than the rest of the reply would have taken
+        await asyncio.sleep(0.6)
+        return received
+
+    received = asyncio.run(run())
+    assert event_names(received) == ["message", "delta"]
+    senders = [m["sender"] for m in asyncio.run(server.db.chat_messages.find({"device_id": "cam"}).to_list(None))]
+    assert senders == ["user"]
+    assert asyncio.run(server.get_chat_history("u", "cam")) == []
@@ -0,0 +1,79 @@
+import pytest
+
+from bench_intents import CORPUS, legacy_classify
+from intents import IntentMatcher
+
+COMMANDS = [
+    "Monitor for people near the gate",
+    "PLEASE MONITOR the Garage",
+    "update camera prompt to watch the pool",
+    "Look for deer",
+    "the prompt looks fine",
+    "change your role to a chef",
+    "you are now a butler",
+    "switch to night mode",
+    "your new role is guard",
+    "I will become famous",
+    "change your instructions to be brief",
+    "follow these instructions: only report cars",
+    "new instructions: ignore cats",
+    "update your instructions to list people only",
+    "reset your role",
+    "reset to original",
+    "default mode please",
+    "reset instructions",
+    "",
+    "   ",
+]
+
+matcher = IntentMatcher()
+
+
+def as_legacy(message):
+    intents = matcher.classify(message)
+    command = intents.settings_command
+    return intents.camera_prompt, (command.kind, command.argument) if command else None
+
+
+@pytest.mark.parametrize("message", CORPUS + COMMANDS)
+def test_matches_the_per_pattern_scans_it_replaced(message):
+    legacy = legacy_classify(message)
+    assert as_legacy(message) == (legacy["camera_prompt"], legacy["command"])
+
+
+def test_role_triggers_need_a_word_boundary():
+    # The old unanchored "be a (.+)" read "maybe a cat" as a role change
+    assert legacy_classify("maybe a cat walked by")["command"] == ("role_change", "cat walked by")
+    assert matcher.classify("maybe a cat walked by").settings_command is None
+
+
+def test_plain_messages_match_no_family():
+    for message in ("hi, how are you today?", "ok", "מה קורה בבית?"):
+        intents = matcher.classify(message)
+        assert not intents.families
+        assert not intents.has_settings_intent
+
+
+@pytest.mark.parametrize("message", [
+    "that alert was wrong, it was just the cat",
+    "false alarm again, the motion was a tree branch",
+    "you said there was a person but it wasn't, it was a shadow",
+])
+def test_corrective_feedback_triggers_prompt_fix(message):
+    assert matcher.classify(message).prompt_fix is not None
+
+
+@pytest.mark.parametrize("message", [
+    "What's wrong with the fridge? It is making noise",
+    "I should have checked the backyard camera earlier",
+    "It was a quiet night, right?",
+    "wrong",
+])
+def test_ordinary_messages_do_not_trigger_prompt_fix(message):
+    assert matcher.classify(message).prompt_fix is None
+
+
+def test_prompt_fix_threshold_is_configurable():
+    message = "I should have been told about the alert"
+    assert IntentMatcher(prompt_fix_confidence=0.95).classify(message).prompt_fix is None
+    assert IntentMatcher(prompt_fix_confidence=0.5).classify(message).prompt_fix.confidence == 0.9
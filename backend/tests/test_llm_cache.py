@@ -0,0 +1,133 @@
+import asyncio
+
+from llm_cache import CachedLlmChat, LlmResponseCache
+
+
+class Image:
+    def __init__(self, image_base64):
+        self.image_base64 = image_base64
+
+
+class Message:
+    def __init__(self, text, file_contents=None):
+        self.text = text
+        self.file_contents = file_contents
+
+
+class CountingChat:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    async def send_message(self, user_message):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return f"reply {self.calls}"
+
+
+def test_key_normalizes_whitespace_and_separates_inputs():
+    key = LlmResponseCache.key
+    assert key("m", "sys", "is  anyone\nhome ") == key("m", "sys", "is anyone home")
+    assert key("m", "sys", "hi") != key("other", "sys", "hi")
+    assert key("m", "sys", "hi") != key("m", "other", "hi")
+    assert key("m", "sys", "hi", [Image("aGVsbG8=")]) == key("m", "sys", "hi", [Image("aGVsbG8=")])
+    assert key("m", "sys", "hi", [Image("aGVsbG8=")]) != key("m", "sys", "hi", [Image("d29ybGQ=")])
+
+
+def test_repeats_are_answered_from_cache():
+    cache = LlmResponseCache()
+    chat = CountingChat()
+    cached = CachedLlmChat(chat, cache, "m", "sys")
+
+    async def run():
+        return [await cached.send_message(Message("hello")) for _ in range(3)]
+
+    assert asyncio.run(run()) == ["reply 1"] * 3
+    assert chat.calls == 1
+    assert cache.stats()["memory_hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_bypass_always_calls_the_model():
+    cache = LlmResponseCache()
+    chat = CountingChat()
+    cached = CachedLlmChat(chat, cache, "m", "sys", bypass=True)
+
+    async def run():
+        await cached.send_message(Message("hello"))
+        await cached.send_message(Message("hello"))
+
+    asyncio.run(run())
+    assert chat.calls == 2
+    assert cache.bypassed == 2
+
+
+def test_concurrent_identical_requests_share_one_call():
+    cache = LlmResponseCache()
+    chat = CountingChat(delay=0.02)
+    cached = CachedLlmChat(chat, cache, "m", "sys")
+
+    async def run():
+        return await asyncio.gather(*(cached.send_message(Message("hello")) for _ in range(5)))
+
+    assert asyncio.run(run()) == ["reply 1"] * 5
+    assert chat.calls == 1
+
+
+def test_lru_evicts_oldest_entry():
+    cache = LlmResponseCache(max_entries=2)
+
+    async def run():
+        for key in ("a", "b", "c"):
+            await cache.set(key, key.upper())
+        return await cache.get("a"), await cache.get("c")
+
+    assert asyncio.run(run()) == (None, "C")
+    assert cache.evictions == 1
+
+
+def test_entries_expire_after_ttl():
+    cache = LlmResponseCache(ttl=0.01)
+
+    async def run():
+        await cache.set("a", "A")
+        await asyncio.sleep(0.02)
+        return await cache.get("a")
+
+    assert asyncio.run(run()) is None
+
+
+def test_failed_calls_are_not_cached():
+    cache = LlmResponseCache()
+    attempts = []
+
+    async def failing():
+        attempts.append(1)
+        raise RuntimeError("provider down")
+
+    async def run():
+        for _ in range(2):
+            try:
+                await cache.get_or_call("k", failing)
+            except RuntimeError:
+                pass
+
+    asyncio.run(run())
+    assert len(attempts) == 2
+
+
+def test_rolling_context_is_left_out_of_the_key():
+    cache = LlmResponseCache()
+    chat = CountingChat()
+
+    async def run():
+        first = CachedLlmChat(chat, cache, "m", "sys", scope="cam", context="Recent conversation:\n[user]: hi")
+        second = CachedLlmChat(chat, cache, "m", "sys", scope="cam", context="Recent conversation:\n[user]: hi\n[ai]: hello")
+        other_device = CachedLlmChat(chat, cache, "m", "sys", scope="door", context="")
+        return [
+            await first.send_message(Message("Recent conversation:\n[user]: hi\n\nCurrent message: status?")),
+            await second.send_message(Message("Recent conversation:\n[user]: hi\n[ai]: hello\n\nCurrent message: status?")),
+            await other_device.send_message(Message("Current message: status?")),
+        ]
+
+    assert asyncio.run(run()) == ["reply 1", "reply 1", "reply 2"]
+    assert chat.calls == 2
@@ -0,0 +1,152 @@
+import asyncio
+from types import SimpleNamespace
+
+import llm_clients
+from llm_clients import LlmSessionPool, OpenAiLlmChat, StreamingLlmChat, StubLlmChat, stream_reply
+
+
+class Message:
+    def __init__(self, text):
+        self.text = text
+
+
+class BlockingChat:
+    """A client without stream_message, like emergentintegrations' LlmChat"""
+
+    async def send_message(self, user_message):
+        return f"reply to {user_message.text}"
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def test_stub_streams_reply_in_chunks():
+    chat = StubLlmChat(session_id="s", system_message="sys", chunk_delay=0).with_model("openai", "gpt-4o-mini")
+    chunks = asyncio.run(collect(chat.stream_message(Message("earlier turns\nis anyone at the door"))))
+    assert len(chunks) > 1
+    assert "".join(chunks) == "[gpt-4o-mini] You said: is anyone at the door"
+
+
+def test_stub_send_message_joins_the_stream():
+    chat = StubLlmChat(chunk_delay=0)
+    reply = asyncio.run(chat.send_message(Message("hello")))
+    assert reply == "".join(asyncio.run(collect(chat.stream_message(Message("hello")))))
+
+
+def test_stream_reply_prefers_streaming_clients():
+    chunks = asyncio.run(collect(stream_reply(StubLlmChat(chunk_delay=0), Message("hi there"))))
+    assert len(chunks) > 1
+
+
+def test_stream_reply_yields_blocking_reply_in_one_piece():
+    assert asyncio.run(collect(stream_reply(BlockingChat(), Message("hi")))) == ["reply to hi"]
+
+
+class StatefulChat:
+    """Keeps the conversation in the instance, as LlmChat does"""
+
+
+def pooled(pool, owner, client_class=StubLlmChat, system_message="sys"):
+    key = LlmSessionPool.key(str(owner), client_class, "m", system_message)
+    return pool.client(key, client_class, owner, reuse=LlmSessionPool.reusable(client_class))
+
+
+def test_session_pool_reuses_stateless_clients():
+    pool = LlmSessionPool()
+    assert pooled(pool, ("u", "d")) is pooled(pool, ("u", "d"))
+    assert pooled(pool, ("u", "d")) is not pooled(pool, ("u", "d"), system_message="other")
+    assert pool.stats()["hits"] == 2
+
+
+def test_session_pool_never_reuses_stateful_clients():
+    pool = LlmSessionPool()
+    assert pooled(pool, ("u", "d"), StatefulChat) is not pooled(pool, ("u", "d"), StatefulChat)
+    assert pool.stats()["size"] == 0
+    assert pool.stats()["unpooled"] == 2
+
+
+def test_session_pool_invalidate_drops_owner_clients_and_settings():
+    pool = LlmSessionPool()
+    loads = []
+
+    async def load():
+        loads.append(1)
+        return {"system_message": "sys"}
+
+    async def settings(owner):
+        return await pool.settings(owner, load)
+
+    first = pooled(pool, ("u", "d"))
+    other = pooled(pool, ("u", "other"))
+    asyncio.run(settings(("u", "d")))
+    asyncio.run(settings(("u", "d")))
+    assert len(loads) == 1
+
+    assert pool.invalidate(("u", "d")) == 1
+    assert pooled(pool, ("u", "d")) is not first
+    assert pooled(pool, ("u", "other")) is other
+    asyncio.run(settings(("u", "d")))
+    assert len(loads) == 2
+
+
+def test_session_pool_evicts_least_recently_used():
+    pool = LlmSessionPool(max_clients=2)
+    a = pooled(pool, "a", system_message="a")
+    pooled(pool, "b", system_message="b")
+    pooled(pool, "a", system_message="a")
+    pooled(pool, "c", system_message="c")
+    assert pool.stats()["evictions"] == 1
+    assert pooled(pool, "a", system_message="a") is a
+
+
+class FakeCompletions:
+    def __init__(self):
+        self.requests = []
+
+    async def create(self, **request):
+        self.requests.append(request)
+        reply = f"reply to {request['messages'][-1]['content']}"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=reply))])
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.completions = FakeCompletions()
+        self.chat = self
+
+
+def test_openai_chat_sends_only_the_system_message_and_prompt(monkeypatch):
+    client = FakeOpenAI()
+    monkeypatch.setattr(llm_clients, "_openai_client", client)
+    chat = OpenAiLlmChat(system_message="sys").with_model("openai", "gpt-5-nano")
+
+    async def run():
+        return await asyncio.gather(chat.send_message(Message("first")), chat.send_message(Message("second")))
+
+    assert asyncio.run(run()) == ["reply to first", "reply to second"]
+    # No history carried from one call to the next, so the instance can be pooled and shared
+    assert [request["messages"] for request in client.completions.requests] == [
+        [{"role": "system", "content": "sys"}, {"role": "user", "content": "first"}],
+        [{"role": "system", "content": "sys"}, {"role": "user", "content": "second"}],
+    ]
+    assert all("stream" not in request and request["model"] == "gpt-5-nano" for request in client.completions.requests)
+
+
+def test_session_pool_reuses_openai_clients():
+    pool = LlmSessionPool()
+    for client_class in (OpenAiLlmChat, StreamingLlmChat):
+        assert pooled(pool, ("u", "d"), client_class) is pooled(pool, ("u", "d"), client_class)
+    assert pool.stats()["unpooled"] == 0 and pool.stats()["size"] == 2
+
+
+def test_default_chat_path_is_pooled(server, monkeypatch):
+    monkeypatch.setattr(server, "LLM_PROVIDER", "openai")
+
+    async def run():
+        for _ in range(3):
+            await server.get_ai_chat_instance("camera", "u_cam", user_id="u", device_id="cam")
+
+    asyncio.run(run())
+    stats = server.chat_sessions.stats()
+    assert (stats["misses"], stats["hits"], stats["unpooled"]) == (1, 2, 0)
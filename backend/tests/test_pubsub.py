@@ -0,0 +1,220 @@
+import asyncio
+import json
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import pytest
+
+from pubsub import InMemoryBroker, LocalSocketBroker, RedisBroker, create_broker
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+class Inbox:
+    """Delivery handler that records (user_id, message) and lets a test wait for a count"""
+
+    def __init__(self):
+        self.events = []
+        self._changed = asyncio.Event()
+
+    def __call__(self, user_id, message):
+        self.events.append((user_id, message))
+        self._changed.set()
+        return True
+
+    async def wait_for(self, count, timeout=2.0):
+        async def wait():
+            while len(self.events) < count:
+                self._changed.clear()
+                await self._changed.wait()
+        await asyncio.wait_for(wait(), timeout)
+        return self.events
+
+    def contents(self):
+        return [message["content"] for _, message in self.events]
+
+
+async def local_broker(path, inbox):
+    broker = LocalSocketBroker(str(path), reconnect_delay=0.05)
+    broker.bind(inbox)
+    await broker.start()
+    return broker
+
+
+async def until(predicate, timeout=2.0):
+    async def wait():
+        while not predicate():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(wait(), timeout)
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    # Unix socket paths are limited to about 100 bytes; tmp_path can be long
+    path = Path("/tmp") / f"pubsub-test-{tmp_path.name}.sock"
+    yield path
+    for leftover in (path, Path(str(path) + ".lock")):
+        if leftover.exists():
+            leftover.unlink()
+
+
+def test_create_broker_kinds():
+    assert isinstance(create_broker("memory"), InMemoryBroker)
+    assert isinstance(create_broker(None), InMemoryBroker)
+    assert isinstance(create_broker("local", "/tmp/x.sock"), LocalSocketBroker)
+    assert isinstance(create_broker("redis", "redis://localhost:6379/0"), RedisBroker)
+
+
+def test_in_memory_broker_delivers_locally():
+    inbox = Inbox()
+    broker = InMemoryBroker()
+    broker.bind(inbox)
+    assert asyncio.run(broker.publish("u", {"content": "hi"}))
+    assert inbox.events[0][0] == "u" and "seq" in inbox.events[0][1]
+
+
+def test_in_memory_broker_without_handler_reports_no_delivery():
+    assert asyncio.run(InMemoryBroker().publish("u", {"content": "hi"})) is False
+
+
+def test_local_broker_elects_one_hub_and_fans_out(socket_path):
+    async def run():
+        inboxes = [Inbox(), Inbox(), Inbox()]
+        brokers = [await local_broker(socket_path, inbox) for inbox in inboxes]
+        await until(lambda: all(b.is_hub or b._writer for b in brokers))
+        hubs = [broker.is_hub for broker in brokers]
+        await brokers[2].publish("u", {"content": "from spoke"})
+        await brokers[0].publish("u", {"content": "from hub"})
+        for inbox in inboxes:
+            await inbox.wait_for(2)
+        for broker in brokers:
+            await broker.stop()
+        return hubs, inboxes
+
+    hubs, inboxes = asyncio.run(run())
+    assert hubs == [True, False, False]
+    for inbox in inboxes:
+        assert sorted(inbox.contents()) == ["from hub", "from spoke"]
+    # The hub stamps every event, so all workers see the same seq for it
+    seqs = {tuple(message["seq"] for _, message in sorted(inbox.events, key=lambda e: e[1]["content"]))
+            for inbox in inboxes}
+    assert len(seqs) == 1
+
+
+def test_local_broker_spoke_takes_over_when_hub_leaves(socket_path):
+    async def run():
+        hub_inbox, spoke_inbox, other_inbox = Inbox(), Inbox(), Inbox()
+        hub = await local_broker(socket_path, hub_inbox)
+        spoke = await local_broker(socket_path, spoke_inbox)
+        other = await local_broker(socket_path, other_inbox)
+        assert hub.is_hub and not spoke.is_hub and not other.is_hub
+        await until(lambda: spoke._writer and other._writer)
+
+        await hub.stop()
+        await until(lambda: spoke.is_hub or other.is_hub)
+        new_hub, survivor = (spoke, other) if spoke.is_hub else (other, spoke)
+        survivor_inbox = other_inbox if survivor is other else spoke_inbox
+        await until(lambda: survivor._writer is not None and new_hub._clients)
+
+        await survivor.publish("u", {"content": "after failover"})
+        await survivor_inbox.wait_for(1)
+        await new_hub.stop()
+        await survivor.stop()
+        return survivor_inbox
+
+    assert asyncio.run(run()).contents() == ["after failover"]
+
+
+def test_local_broker_fans_out_between_processes(socket_path):
+    # A second worker process joins as a spoke and prints what it receives
+    spoke_script = textwrap.dedent(f"""
+        import asyncio, json, sys
+        sys.path.insert(0, {str(BACKEND_DIR)!r})
+        from pubsub import LocalSocketBroker
+
+        async def main():
+            received = asyncio.Event()
+
+            def handler(user_id, message):
+                print(json.dumps({{"user_id": user_id, "message": message}}), flush=True)
+                received.set()
+                return True
+
+            broker = LocalSocketBroker({str(socket_path)!r})
+            broker.bind(handler)
+            await broker.start()
+            while broker._writer is None:
+                await asyncio.sleep(0.01)
+            print("ready", flush=True)
+            await asyncio.wait_for(received.wait(), 5)
+            await broker.stop()
+
+        asyncio.run(main())
+    """)
+
+    async def run():
+        hub = await local_broker(socket_path, Inbox())
+        assert hub.is_hub
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-c", spoke_script, stdout=asyncio.subprocess.PIPE)
+        assert (await asyncio.wait_for(process.stdout.readline(), 5)).strip() == b"ready"
+        await until(lambda: hub._clients)
+        await hub.publish("u", {"content": "cross-process"})
+        line = await asyncio.wait_for(process.stdout.readline(), 5)
+        await asyncio.wait_for(process.wait(), 5)
+        await hub.stop()
+        return json.loads(line)
+
+    received = asyncio.run(run())
+    assert received["user_id"] == "u"
+    assert received["message"]["content"] == "cross-process"
+    assert "seq" in received["message"]
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio for RedisBroker: the seq script and a loopback channel"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.seqs = {}
+        self.published = []
+
+    def register_script(self, script):
+        async def next_seq(keys, args):
+            # Same rule as NEXT_SEQ_SCRIPT: max(now, last + 1)
+            seq = max(int(args[0]), self.seqs.get(keys[0], 0) + 1)
+            self.seqs[keys[0]] = seq
+            return seq
+        return next_seq
+
+    async def publish(self, channel, data):
+        self.published.append(channel)
+        envelope = json.loads(data)
+        self.broker._deliver(envelope["u"], envelope["m"])
+
+
+def test_redis_broker_publishes_with_shared_seq():
+    inbox = Inbox()
+    broker = RedisBroker("redis://unused", channel="events")
+    broker.bind(inbox)
+    broker._redis = FakeRedis(broker)
+    broker._next_seq = broker._redis.register_script(RedisBroker.NEXT_SEQ_SCRIPT)
+
+    async def run():
+        for i in range(3):
+            assert await broker.publish("u", {"content": i})
+
+    asyncio.run(run())
+    seqs = [message["seq"] for _, message in inbox.events]
+    assert seqs == sorted(seqs) and len(set(seqs)) == 3
+    assert broker._redis.published == ["events"] * 3
+
+
+def test_redis_broker_falls_back_to_local_delivery():
+    inbox = Inbox()
+    broker = RedisBroker("redis://unused")
+    broker.bind(inbox)
+    assert asyncio.run(broker.publish("u", {"content": "not started"}))
+    assert inbox.contents() == ["not started"]
@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+from py_vapid import Vapid, b64urlencode
+from pywebpush import WebPushException
+
+import push_delivery
+
+
+class GoneResponse:
+    status_code = 410
+    headers = {}
+
+
+def post_batch(server, body):
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/api/push/send-batch", json=body)
+
+    return asyncio.run(run())
+
+
+def subscription(sub_id, user_id, endpoint="https://fcm.googleapis.com/send/", keys=True):
+    document = {"id": sub_id, "user_id": user_id}
+    if endpoint:
+        document["endpoint"] = endpoint + sub_id
+    if keys:
+        document["keys"] = {"p256dh": "k", "auth": "a"}
+    return document
+
+
+def configure_vapid(monkeypatch):
+    vapid = Vapid()
+    vapid.generate_keys()
+    private_key = b64urlencode(vapid.private_key.private_numbers().private_value.to_bytes(32, "big"))
+    monkeypatch.setenv("VAPID_PRIVATE_KEY", private_key)
+    monkeypatch.setenv("VAPID_PUBLIC_KEY", "public")
+
+
+def test_send_batch_reports_per_recipient_results_and_prunes_invalid_subscriptions(server, monkeypatch):
+    configure_vapid(monkeypatch)
+    asyncio.run(server.db.push_subscriptions.insert_many([
+        subscription("a-phone", "alice"),
+        subscription("a-laptop", "alice"),
+        subscription("b-broken", "bob", endpoint=None),
+        subscription("b-phone", "bob"),
+        subscription("c-nokeys", "carol", keys=False),
+    ]))
+
+    response = post_batch(server, {
+        "user_ids": ["alice", "bob", "carol", "dave"],
+        "device_id": "camera-01", "title": "Gate", "body": "Gate left open"
+    })
+
+    assert response.status_code == 200
+    result = response.json()
+    by_user = {item["user_id"]: item for item in result["results"]}
+    assert [item["user_id"] for item in result["results"]] == ["alice", "bob", "carol", "dave"]
+    assert [by_user[u]["queued_count"] for u in ("alice", "bob", "carol", "dave")] == [2, 1, 0, 0]
+    assert [by_user[u]["pruned_subscriptions"] for u in ("alice", "bob", "carol", "dave")] == [0, 1, 1, 0]
+    assert result["queued_count"] == 3 and result["pruned_subscriptions"] == 2
+    assert result["users_without_subscriptions"] == ["carol", "dave"]
+
+    remaining = asyncio.run(server.db.push_subscriptions.distinct("id"))
+    assert sorted(remaining) == ["a-laptop", "a-phone", "b-phone"]
+    jobs = asyncio.run(server.db.push_outbox.find({}).to_list(None))
+    assert sorted(job["id"] for job in jobs) == sorted(sum((item["job_ids"] for item in result["results"]), []))
+
+
+def test_subscriptions_the_push_service_reports_gone_are_pruned_on_delivery(server, monkeypatch):
+    configure_vapid(monkeypatch)
+    asyncio.run(server.db.push_subscriptions.insert_many([
+        subscription("a-phone", "alice"),
+        subscription("b-expired", "bob"),
+    ]))
+
+    def webpush(subscription_info, **kwargs):
+        if subscription_info["endpoint"].endswith("b-expired"):
+            raise WebPushException("Push failed", response=GoneResponse())
+
+    monkeypatch.setattr(push_delivery, "webpush", webpush)
+    response = post_batch(server, {
+        "user_ids": ["alice", "bob"], "device_id": "camera-01", "title": "Gate", "body": "Gate left open"
+    })
+    assert response.json()["queued_count"] == 2
+
+    async def deliver_all():
+        for job in await server.db.push_outbox.find({}).to_list(None):
+            await server.push_outbox._deliver(job)
+        return (
+            await server.db.push_subscriptions.distinct("id"),
+            {job["subscription_id"]: job["status"] for job in await server.db.push_outbox.find({}).to_list(None)}
+        )
+
+    remaining, statuses = asyncio.run(deliver_all())
+    assert remaining == ["a-phone"]
+    assert statuses == {"a-phone": "sent", "b-expired": "dead"}
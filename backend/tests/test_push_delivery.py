@@ -0,0 +1,323 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from email.utils import format_datetime, parsedate_to_datetime
+
+from py_vapid import Vapid, b64urlencode
+from pywebpush import WebPushException
+
+import push_delivery
+from push_delivery import AlertCoalescer, PushDispatcher, PushOutbox, PushResult, VapidHeaderCache, parse_retry_after
+
+
+class FakeCollection:
+    def __init__(self):
+        self.updates = []
+
+    async def update_one(self, query, update):
+        self.updates.append((query, update))
+
+
+class FakeDispatcher:
+    def __init__(self, result):
+        self.result = result
+
+    async def send(self, job, data, vapid_private_key, vapid_claims):
+        return self.result
+
+
+def make_outbox(result, max_attempts=3):
+    collection = FakeCollection()
+    gone = []
+
+    async def on_gone(job):
+        gone.append(job["id"])
+
+    outbox = PushOutbox(lambda: collection, FakeDispatcher(result), lambda: ("key", {"sub": "mailto:a@b.c"}),
+                        on_gone=on_gone, max_attempts=max_attempts, base_delay=5.0, max_delay=60.0)
+    return outbox, collection, gone
+
+
+def job(attempts=0):
+    return {"id": "job-1", "data": "{}", "attempts": attempts}
+
+
+def test_parse_retry_after_seconds():
+    assert parse_retry_after("120") == 120.0
+    assert parse_retry_after("-5") == 0.0
+
+
+def test_parse_retry_after_http_date():
+    retry_at = parsedate_to_datetime(format_datetime(datetime.utcnow() + timedelta(seconds=90)))
+    seconds = parse_retry_after(format_datetime(retry_at))
+    assert 80 <= seconds <= 90
+
+
+def test_parse_retry_after_missing_or_invalid():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("") is None
+    assert parse_retry_after("soon") is None
+
+
+def test_push_result_classification():
+    assert PushResult("s", False, 410).gone
+    assert PushResult("s", False, 404).gone
+    assert PushResult("s", False, 429).retryable
+    assert PushResult("s", False, 503).retryable
+    assert PushResult("s", False, None, error="timeout").retryable
+    assert not PushResult("s", False, 400).retryable
+
+
+def test_backoff_grows_and_is_capped():
+    outbox, _, _ = make_outbox(PushResult("s", True, 201))
+    assert 4.0 <= outbox.backoff(1) <= 6.0
+    assert 16.0 <= outbox.backoff(3) <= 24.0
+    assert outbox.backoff(20) <= 60.0 * 1.2
+
+
+def test_retry_after_overrides_backoff():
+    outbox, collection, _ = make_outbox(PushResult("s", False, 429, retry_after=30.0))
+    before = datetime.utcnow()
+    asyncio.run(outbox._deliver(job()))
+    fields = collection.updates[-1][1]["$set"]
+    assert fields["status"] == "pending"
+    assert fields["attempts"] == 1
+    assert timedelta(seconds=29) <= fields["next_attempt_at"] - before <= timedelta(seconds=31)
+    assert outbox.retried == 1
+
+
+def test_gives_up_after_max_attempts():
+    outbox, collection, _ = make_outbox(PushResult("s", False, 503), max_attempts=3)
+    asyncio.run(outbox._deliver(job(attempts=2)))
+    assert collection.updates[-1][1]["$set"]["status"] == "failed"
+    assert outbox.failed == 1
+
+
+def test_gone_subscription_is_pruned():
+    outbox, collection, gone = make_outbox(PushResult("s", False, 410))
+    asyncio.run(outbox._deliver(job()))
+    assert collection.updates[-1][1]["$set"]["status"] == "dead"
+    assert gone == ["job-1"]
+
+
+def test_missing_vapid_keeps_job_pending_without_an_attempt():
+    outbox, collection, _ = make_outbox(PushResult("s", True, 201))
+    outbox.vapid = lambda: (None, {})
+    asyncio.run(outbox._deliver(job()))
+    fields = collection.updates[-1][1]["$set"]
+    assert fields["status"] == "pending"
+    assert "attempts" not in fields
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class FakePushService:
+    """Stands in for pywebpush.webpush: blocks like a network round-trip, then fails the
+    endpoints listed in statuses with that HTTP status"""
+
+    def __init__(self, delay=0.0, statuses=None):
+        self.delay = delay
+        self.statuses = statuses or {}
+        self.calls = []
+        self.threads = set()
+        self._lock = threading.Lock()
+
+    def __call__(self, subscription_info, data, headers, timeout, requests_session):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls.append((subscription_info["endpoint"], headers, requests_session))
+            self.threads.add(threading.current_thread().name)
+        status_code = self.statuses.get(subscription_info["endpoint"])
+        if status_code:
+            raise WebPushException("Push failed", response=FakeResponse(status_code, {"Retry-After": "30"}))
+
+
+class FakeVapidHeaders:
+    hits = misses = 0
+
+    def get(self, private_key, claims, audience):
+        return {"Authorization": f"vapid for {audience}"}
+
+
+def subscription(index, origin="https://fcm.googleapis.com"):
+    return {"id": f"sub-{index}", "endpoint": f"{origin}/send/{index}", "keys": {"p256dh": "k", "auth": "a"}}
+
+
+def make_dispatcher(monkeypatch, service, max_workers=8):
+    monkeypatch.setattr(push_delivery, "webpush", service)
+    dispatcher = PushDispatcher(max_workers=max_workers)
+    dispatcher.vapid_headers = FakeVapidHeaders()
+    return dispatcher
+
+
+def test_dispatcher_sends_concurrently_and_keeps_input_order(monkeypatch):
+    service = FakePushService(delay=0.1)
+    dispatcher = make_dispatcher(monkeypatch, service)
+    subscriptions = [subscription(i) for i in range(8)]
+
+    started = time.monotonic()
+    results = asyncio.run(dispatcher.send_many(subscriptions, "{}", "key", {"sub": "mailto:a@b.c"}))
+    elapsed = time.monotonic() - started
+    dispatcher.shutdown()
+
+    # Eight 100ms pushes on eight threads take about one round-trip, not eight
+    assert elapsed < 0.5
+    assert len(service.threads) > 1
+    assert [r.subscription_id for r in results] == [s["id"] for s in subscriptions]
+    assert all(r.ok for r in results)
+
+
+def test_dispatcher_does_not_block_the_event_loop(monkeypatch):
+    dispatcher = make_dispatcher(monkeypatch, FakePushService(delay=0.2))
+    ticks = []
+
+    async def run():
+        async def ticker():
+            while True:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        await dispatcher.send(subscription(0), "{}", "key", {})
+        task.cancel()
+
+    asyncio.run(run())
+    dispatcher.shutdown()
+    assert len(ticks) >= 10
+
+
+def test_dispatcher_reports_push_service_failures(monkeypatch):
+    gone, throttled = subscription(1), subscription(2)
+    service = FakePushService(statuses={gone["endpoint"]: 410, throttled["endpoint"]: 429})
+    dispatcher = make_dispatcher(monkeypatch, service)
+
+    ok, gone_result, throttled_result = asyncio.run(
+        dispatcher.send_many([subscription(0), gone, throttled], "{}", "key", {}))
+    dispatcher.shutdown()
+
+    assert ok.ok
+    assert gone_result.gone and not gone_result.ok
+    assert throttled_result.retryable and throttled_result.retry_after == 30.0
+
+
+def generate_vapid_key():
+    vapid = Vapid()
+    vapid.generate_keys()
+    return vapid
+
+
+def raw_private_key(vapid):
+    """The base64url form web-push generate-vapid-keys prints, as used in VAPID_PRIVATE_KEY"""
+    return b64urlencode(vapid.private_key.private_numbers().private_value.to_bytes(32, "big"))
+
+
+def test_vapid_private_key_may_be_a_key_file(tmp_path):
+    vapid = generate_vapid_key()
+    key_file = tmp_path / "private_key.pem"
+    vapid.save_key(str(key_file))
+    raw_key = raw_private_key(vapid)
+
+    cache = VapidHeaderCache()
+    claims = {"sub": "mailto:a@b.c"}
+    from_file = cache.get(str(key_file), claims, "https://fcm.googleapis.com")
+    from_string = cache.get(raw_key, claims, "https://fcm.googleapis.com")
+    # Same key either way: the k= public key part of the header matches
+    assert from_file["Authorization"].split(",k=")[1] == from_string["Authorization"].split(",k=")[1]
+
+
+def test_dispatcher_reuses_one_session_per_origin(monkeypatch):
+    service = FakePushService()
+    dispatcher = make_dispatcher(monkeypatch, service)
+    subscriptions = [subscription(i) for i in range(3)] + [subscription(3, "https://updates.push.services.mozilla.com")]
+
+    asyncio.run(dispatcher.send_many(subscriptions, "{}", "key", {}))
+    asyncio.run(dispatcher.send_many(subscriptions[:1], "{}", "key", {}))
+    stats = dispatcher.stats()
+    dispatcher.shutdown()
+
+    sessions = {endpoint.rsplit("/send/", 1)[0]: set() for endpoint, _, _ in service.calls}
+    for endpoint, _, session in service.calls:
+        sessions[endpoint.rsplit("/send/", 1)[0]].add(id(session))
+    assert {origin: len(ids) for origin, ids in sessions.items()} == {
+        "https://fcm.googleapis.com": 1, "https://updates.push.services.mozilla.com": 1}
+    assert stats["origins"] == ["https://fcm.googleapis.com", "https://updates.push.services.mozilla.com"]
+    assert stats["session_misses"] == 2 and stats["session_hits"] == 3
+    # Headers are signed for the push service's own origin (the VAPID audience)
+    assert service.calls[-1][1] == {"Authorization": "vapid for https://fcm.googleapis.com"}
+
+
+def test_vapid_headers_are_signed_once_per_audience():
+    key = raw_private_key(generate_vapid_key())
+    cache = VapidHeaderCache()
+    claims = {"sub": "mailto:a@b.c"}
+
+    first = cache.get(key, claims, "https://fcm.googleapis.com")
+    assert cache.get(key, claims, "https://fcm.googleapis.com") == first
+    assert cache.get(key, claims, "https://updates.push.services.mozilla.com") != first
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_vapid_headers_are_re_signed_near_expiry(monkeypatch):
+    key = raw_private_key(generate_vapid_key())
+    cache = VapidHeaderCache(lifetime=3600, refresh_margin=600)
+    now = time.time()
+    monkeypatch.setattr(push_delivery.time, "time", lambda: now)
+    first = cache.get(key, {"sub": "mailto:a@b.c"}, "https://fcm.googleapis.com")
+
+    monkeypatch.setattr(push_delivery.time, "time", lambda: now + 3000 - 1)
+    assert cache.get(key, {"sub": "mailto:a@b.c"}, "https://fcm.googleapis.com") == first
+    monkeypatch.setattr(push_delivery.time, "time", lambda: now + 3000 + 1)
+    assert cache.get(key, {"sub": "mailto:a@b.c"}, "https://fcm.googleapis.com") != first
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+class Alert:
+    def __init__(self, device_id, body, user_id="u"):
+        self.user_id = user_id
+        self.device_id = device_id
+        self.body = body
+
+
+def make_coalescer(window=0.05, max_keys=100):
+    sent = []
+
+    async def send(alert):
+        sent.append(alert.body)
+
+    return AlertCoalescer(send, lambda latest, count: Alert(latest.device_id, f"{count} more, latest {latest.body}"),
+                          window=window, max_keys=max_keys), sent
+
+
+def test_coalescer_merges_alerts_inside_the_window():
+    coalescer, sent = make_coalescer()
+
+    async def run():
+        assert await coalescer.submit(Alert("cam", "motion 1"))
+        assert not await coalescer.submit(Alert("cam", "motion 2"))
+        assert not await coalescer.submit(Alert("cam", "motion 3"))
+        assert await coalescer.submit(Alert("door", "ring"))
+        await asyncio.sleep(0.08)
+        coalescer.close()
+
+    asyncio.run(run())
+    assert sent == ["motion 1", "ring", "2 more, latest motion 3"]
+    assert coalescer.stats()["suppressed"] == 2 and coalescer.summaries == 1
+
+
+def test_coalescer_flushes_an_evicted_window_instead_of_losing_it():
+    coalescer, sent = make_coalescer(window=60, max_keys=1)
+
+    async def run():
+        await coalescer.submit(Alert("cam", "motion 1"))
+        await coalescer.submit(Alert("cam", "motion 2"))
+        await coalescer.submit(Alert("door", "ring"))
+        coalescer.close()
+
+    asyncio.run(run())
+    assert sent == ["motion 1", "1 more, latest motion 2", "ring"]
+    assert coalescer.stats()["evicted"] == 1
@@ -0,0 +1,531 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from pubsub import InMemoryBroker
+from realtime import (
+    BufferedInserter, ClientConnection, ConnectionTaskPool, EventBuffer, FrameCodec, SlowConsumerPolicy, TopicIndex,
+    build_topics, coalesce_key
+)
+
+
+class FakeSocket:
+    def __init__(self, **query_params):
+        self.sent = []
+        self.closed_with = None
+        self.query_params = query_params
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, payload):
+        self.sent.append(payload)
+
+    async def send_bytes(self, payload):
+        self.sent.append(payload)
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+class StuckSocket(FakeSocket):
+    """A client that stopped reading: every send hangs until the writer gives up"""
+
+    async def send_text(self, payload):
+        await asyncio.Event().wait()
+
+    send_bytes = send_text
+
+
+def delta(index):
+    return {"type": "ai_response_delta", "device_id": "cam", "index": index, "delta": f"chunk{index}"}
+
+
+def test_coalesce_key_only_for_state_frames():
+    assert coalesce_key({"type": "ping"}) == ("ping", None, None)
+    assert coalesce_key({"type": "chat_job", "job_id": "j1"}) != coalesce_key({"type": "chat_job", "job_id": "j2"})
+    assert coalesce_key(delta(0)) is None
+    assert coalesce_key({"type": "ai_response", "device_id": "cam"}) is None
+    assert coalesce_key({"type": "message", "device_id": "cam"}) is None
+
+
+def test_drop_oldest_makes_room():
+    async def run():
+        connection = ClientConnection(FakeSocket(), "u", max_queue=2)
+        for i in range(3):
+            assert connection.enqueue(delta(i))
+        return connection
+
+    connection = asyncio.run(run())
+    assert [m["index"] for m in connection._queue] == [1, 2]
+    assert connection.dropped_count == 1
+
+
+def test_coalesce_replaces_superseded_state_frame():
+    async def run():
+        connection = ClientConnection(FakeSocket(), "u", max_queue=3, policy=SlowConsumerPolicy.COALESCE)
+        connection.enqueue({"type": "chat_job", "job_id": "j1", "status": "running"})
+        connection.enqueue(delta(0))
+        connection.enqueue(delta(1))
+        connection.enqueue({"type": "chat_job", "job_id": "j1", "status": "done"})
+        return connection
+
+    connection = asyncio.run(run())
+    assert [m.get("index", m.get("status")) for m in connection._queue] == [0, 1, "done"]
+
+
+def test_coalesce_never_replaces_deltas():
+    async def run():
+        connection = ClientConnection(FakeSocket(), "u", max_queue=2, policy=SlowConsumerPolicy.COALESCE)
+        for i in range(3):
+            connection.enqueue(delta(i))
+        return connection
+
+    connection = asyncio.run(run())
+    # The oldest frame goes, as with drop_oldest; the newest deltas are never replaced by each other
+    assert [m["index"] for m in connection._queue] == [1, 2]
+
+
+def test_disconnect_policy_closes_slow_socket():
+    async def run():
+        socket = FakeSocket()
+        closed = []
+        connection = ClientConnection(socket, "u", max_queue=1, policy=SlowConsumerPolicy.DISCONNECT,
+                                      on_close=closed.append)
+        assert connection.enqueue(delta(0))
+        assert not connection.enqueue(delta(1))
+        await asyncio.sleep(0)
+        return connection, socket, closed
+
+    connection, socket, closed = asyncio.run(run())
+    assert connection.closed
+    assert socket.closed_with == 1013
+    assert closed == [connection]
+
+
+def test_writer_sends_queued_frames_in_order():
+    async def run():
+        socket = FakeSocket()
+        connection = ClientConnection(socket, "u")
+        connection.start()
+        for i in range(3):
+            connection.enqueue(delta(i))
+        await asyncio.sleep(0.01)
+        connection.abort()
+        return socket, connection
+
+    socket, connection = asyncio.run(run())
+    assert [frame.count("chunk") for frame in socket.sent] == [1, 1, 1]
+    assert '"index": 2' in socket.sent[-1]
+    assert connection.sent_count == 3
+
+
+def test_stuck_socket_does_not_hold_up_other_writers():
+    async def run():
+        stuck, healthy = StuckSocket(), FakeSocket()
+        slow = ClientConnection(stuck, "u", send_timeout=0.05)
+        fast = ClientConnection(healthy, "u")
+        for connection in (slow, fast):
+            connection.start()
+        for i in range(3):
+            slow.enqueue(delta(i))
+            fast.enqueue(delta(i))
+        await asyncio.sleep(0.01)
+        delivered_early = len(healthy.sent)
+        await asyncio.sleep(0.1)
+        fast.abort()
+        return delivered_early, slow, stuck
+
+    delivered_early, slow, stuck = asyncio.run(run())
+    assert delivered_early == 3
+    # The stuck socket's own writer times out and closes it
+    assert slow.closed and stuck.closed_with == 1000
+    assert slow.sent_count == 0
+
+
+def test_task_pool_keeps_per_key_order_and_rejects_when_full():
+    order = []
+
+    async def reply(name, delay):
+        await asyncio.sleep(delay)
+        order.append(name)
+
+    async def run():
+        pool = ConnectionTaskPool(max_concurrency=2, max_pending=3)
+        assert pool.submit("cam", lambda: reply("cam-1", 0.03))
+        assert pool.submit("cam", lambda: reply("cam-2", 0))
+        assert pool.submit("door", lambda: reply("door-1", 0))
+        assert not pool.submit("door", lambda: reply("door-2", 0))
+        await pool.drain(timeout=1)
+
+    asyncio.run(run())
+    # door-1 is not stuck behind the slow cam reply; cam-2 waits for cam-1
+    assert order == ["door-1", "cam-1", "cam-2"]
+
+
+def test_manager_fans_out_to_every_socket_of_a_user(server):
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        phone, tab, other = FakeSocket(), FakeSocket(), FakeSocket()
+        for socket, user_id in ((phone, "u"), (tab, "u"), (other, "someone-else")):
+            await manager.connect(socket, user_id)
+        await manager.send_personal_message({"type": "message", "text": "hi"}, "u")
+        await asyncio.sleep(0.01)
+        await manager.stop()
+        return phone, tab, other
+
+    phone, tab, other = asyncio.run(run())
+    assert len(phone.sent) == len(tab.sent) == 1 and '"hi"' in phone.sent[0]
+    assert other.sent == []
+
+
+def test_manager_disconnects_only_the_overflowing_socket(server, monkeypatch):
+    monkeypatch.setattr(server, "WS_SEND_QUEUE_SIZE", 2)
+    monkeypatch.setattr(server, "WS_SLOW_CONSUMER_POLICY", SlowConsumerPolicy.DISCONNECT)
+    monkeypatch.setattr(server, "WS_BATCH_WINDOW_MS", 0)
+
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        stuck, healthy = StuckSocket(), FakeSocket()
+        slow = await manager.connect(stuck, "u")
+        await manager.connect(healthy, "u")
+        for i in range(5):
+            manager.deliver_local("u", delta(i))
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0.01)
+        remaining = list(manager.active_connections["u"].values())
+        await manager.stop()
+        return slow, stuck, healthy, remaining
+
+    slow, stuck, healthy, remaining = asyncio.run(run())
+    assert stuck.closed_with == 1013
+    assert slow not in remaining and len(remaining) == 1
+    assert len(healthy.sent) == 5
+
+
+def sequenced(seq):
+    return {"type": "message", "seq": seq}
+
+
+def test_event_buffer_replays_only_the_gap():
+    buffer = EventBuffer(started_seq=100, max_events_per_user=10)
+    for seq in (101, 102, 103):
+        buffer.append("u", sequenced(seq))
+    assert [m["seq"] for m in buffer.since("u", 101)] == [102, 103]
+    assert buffer.since("u", 103) == []
+
+
+def test_event_buffer_gives_up_once_the_gap_is_dropped():
+    buffer = EventBuffer(started_seq=100, max_events_per_user=2)
+    for seq in (101, 102, 103):
+        buffer.append("u", sequenced(seq))
+    # 101 fell out of the ring: only a client that saw it can be served from memory
+    assert buffer.since("u", 100) is None
+    assert [m["seq"] for m in buffer.since("u", 101)] == [102, 103]
+
+
+def test_event_buffer_cannot_vouch_for_events_before_it_started():
+    buffer = EventBuffer(started_seq=100)
+    assert buffer.since("new-user", 50) is None
+    assert buffer.since("new-user", 100) == []
+
+
+def test_event_buffer_evicting_a_user_raises_the_floor():
+    buffer = EventBuffer(started_seq=100, max_users=1)
+    buffer.append("a", sequenced(105))
+    buffer.append("b", sequenced(106))
+    assert buffer.since("a", 101) is None
+    assert buffer.since("c", 105) == []
+
+
+def test_manager_replays_the_gap_from_its_buffer(server):
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        live = ClientConnection(FakeSocket(), "u")
+        manager.topics.add(live)
+        for _ in range(3):
+            await manager.send_personal_message({"type": "message"}, "u")
+        seqs = [event["seq"] for event in live._queue]
+        # A second socket that saw only the first event resumes
+        connection = ClientConnection(FakeSocket(), "u")
+        await manager.replay(connection, seqs[0])
+        return seqs, list(connection._queue)
+
+    seqs, frames = asyncio.run(run())
+    assert [frame.get("seq") for frame in frames[:-1]] == seqs[1:]
+    assert frames[-1] == {"type": "resume_complete", "source": "buffer", "replayed": 2,
+                          "truncated": False, "last_seq": seqs[-1]}
+
+
+def test_manager_falls_back_to_the_database_for_an_old_gap(server):
+    last_seen = datetime.utcnow() - timedelta(hours=1)
+
+    async def run():
+        await server.db.notifications.insert_many([
+            {"id": "before", "user_id": "u", "device_id": "cam", "type": "motion", "timestamp": last_seen - timedelta(minutes=1)},
+            {"id": "missed", "user_id": "u", "device_id": "cam", "type": "motion", "timestamp": last_seen + timedelta(minutes=1)},
+            {"id": "other-user", "user_id": "v", "device_id": "cam", "type": "motion", "timestamp": last_seen + timedelta(minutes=1)},
+        ])
+        await server.db.chat_messages.insert_one(
+            {"id": "reply", "user_id": "u", "device_id": "cam", "sender": "ai", "message": "hi",
+             "timestamp": last_seen + timedelta(minutes=2)})
+        manager = server.ConnectionManager(InMemoryBroker())
+        connection = ClientConnection(FakeSocket(), "u")
+        await manager.replay(connection, server.datetime_to_seq(last_seen))
+        return list(connection._queue)
+
+    frames = asyncio.run(run())
+    assert [frame.get("notification_id", frame.get("message_id")) for frame in frames[:-1]] == ["missed", "reply"]
+    assert frames[1]["type"] == "ai_response" and frames[1]["replayed"]
+    assert frames[-1]["source"] == "database" and frames[-1]["replayed"] == 2
+
+
+def test_broker_stamps_increasing_seqs_per_user():
+    delivered = []
+    broker = InMemoryBroker()
+    broker.bind(lambda user_id, message: delivered.append((user_id, message["seq"])) or True)
+
+    async def run():
+        for _ in range(5):
+            await broker.publish("u", {"type": "message"})
+
+    asyncio.run(run())
+    seqs = [seq for _, seq in delivered]
+    assert seqs == sorted(seqs) and len(set(seqs)) == 5
+
+
+def test_task_pool_drain_lets_running_jobs_finish():
+    finished = []
+
+    async def reply(name, delay):
+        await asyncio.sleep(delay)
+        finished.append(name)
+
+    async def run():
+        pool = ConnectionTaskPool(max_concurrency=2)
+        pool.submit("cam", lambda: reply("quick", 0.01))
+        pool.submit("other", lambda: reply("slow", 5))
+        return await pool.drain(timeout=0.2)
+
+    assert asyncio.run(run()) == 1
+    assert finished == ["quick"]
+
+
+def test_topic_index_routes_events_to_subscribed_sockets_only():
+    index = TopicIndex()
+    everything, cam, alerts = (ClientConnection(FakeSocket(), "u") for _ in range(3))
+    for connection in (everything, cam, alerts):
+        index.add(connection)
+    index.subscribe(cam, build_topics(devices=["cam"]))
+    index.subscribe(alerts, build_topics(missions=["perimeter"], event_types=["alert"]))
+
+    assert index.match("u", {"type": "motion", "device_id": "cam"}) == {everything, cam}
+    assert index.match("u", {"type": "alert", "device_id": "door"}) == {everything, alerts}
+    assert index.match("u", {"type": "motion", "device_id": "door", "mission_name": "perimeter"}) == {everything, alerts}
+    assert index.match("someone-else", {"type": "alert"}) == set()
+
+
+def test_topic_index_unsubscribing_everything_restores_the_firehose():
+    index = TopicIndex()
+    connection = ClientConnection(FakeSocket(), "u")
+    index.add(connection)
+    index.subscribe(connection, ["device:cam"])
+    assert index.match("u", {"type": "motion", "device_id": "door"}) == set()
+
+    index.unsubscribe(connection, ["device:cam"])
+    assert index.match("u", {"type": "motion", "device_id": "door"}) == {connection}
+
+    index.remove(connection)
+    assert index.match("u", {"type": "motion", "device_id": "door"}) == set()
+
+
+def test_manager_sends_only_subscribed_devices(server):
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        connection = ClientConnection(FakeSocket(), "u")
+        manager.topics.add(connection)
+        manager.update_subscriptions(connection, {"type": "subscribe", "devices": ["cam"]})
+        for device_id in ("cam", "door", "cam"):
+            await manager.send_personal_message({"type": "motion", "device_id": device_id}, "u")
+        return list(connection._queue)
+
+    frames = asyncio.run(run())
+    assert frames[0] == {"type": "subscriptions", "topics": ["device:cam"]}
+    assert [frame["device_id"] for frame in frames[1:]] == ["cam", "cam"]
+
+
+def test_batch_window_sends_a_burst_as_one_frame():
+    async def run():
+        socket = FakeSocket()
+        connection = ClientConnection(socket, "u", batch_window=0.02)
+        connection.start()
+        for i in range(3):
+            connection.enqueue(delta(i))
+        await asyncio.sleep(0.01)
+        sent_inside_window = len(socket.sent)
+        await asyncio.sleep(0.03)
+        connection.enqueue(delta(3))
+        await asyncio.sleep(0.04)
+        connection.abort()
+        return sent_inside_window, socket, connection
+
+    sent_inside_window, socket, connection = asyncio.run(run())
+    assert sent_inside_window == 0
+    batch, single = (json.loads(frame) for frame in socket.sent)
+    assert batch["type"] == "batch" and [e["index"] for e in batch["events"]] == [0, 1, 2]
+    # A lone frame after the window is sent as itself, not wrapped in a batch
+    assert single["index"] == 3
+    assert connection.sent_count == 4
+
+
+class FakeCollection:
+    def __init__(self):
+        self.inserts = []
+
+    async def insert_one(self, document):
+        self.inserts.append([document])
+
+    async def insert_many(self, documents, ordered=True):
+        self.inserts.append(list(documents))
+
+
+def test_buffered_inserter_flushes_when_the_batch_is_full():
+    collection = FakeCollection()
+
+    async def run():
+        writer = BufferedInserter(lambda: collection, window=60, max_batch=3)
+        for i in range(4):
+            await writer.add({"i": i})
+        full_batches = [len(batch) for batch in collection.inserts]
+        await writer.flush()
+        return full_batches, writer
+
+    full_batches, writer = asyncio.run(run())
+    assert full_batches == [3]
+    assert [len(batch) for batch in collection.inserts] == [3, 1]
+    assert writer.flushes == 2 and writer.inserted == 4
+
+
+def test_buffered_inserter_flushes_after_the_window():
+    collection = FakeCollection()
+
+    async def run():
+        writer = BufferedInserter(lambda: collection, window=0.02)
+        for i in range(3):
+            await writer.add({"i": i})
+        before = len(collection.inserts)
+        await asyncio.sleep(0.05)
+        return before
+
+    assert asyncio.run(run()) == 0
+    assert collection.inserts == [[{"i": 0}, {"i": 1}, {"i": 2}]]
+
+
+def test_buffered_inserter_without_a_window_inserts_each_document():
+    collection = FakeCollection()
+
+    async def run():
+        writer = BufferedInserter(lambda: collection)
+        await writer.add({"i": 0})
+        await writer.add({"i": 1})
+
+    asyncio.run(run())
+    assert collection.inserts == [[{"i": 0}], [{"i": 1}]]
+
+
+def test_json_codec_sends_text_frames():
+    codec = FrameCodec()
+    frame = codec.encode(delta(0))
+    assert isinstance(frame, str)
+    assert FrameCodec.decode(frame) == delta(0)
+
+
+def test_msgpack_codec_round_trips_small_frames_uncompressed():
+    pytest.importorskip("msgpack")
+    codec = FrameCodec(FrameCodec.MSGPACK, compress_threshold=1024)
+    frame = codec.encode(delta(0))
+    assert frame[0] == FrameCodec.RAW
+    assert FrameCodec.decode(frame) == delta(0)
+
+
+def test_msgpack_codec_deflates_large_frames():
+    pytest.importorskip("msgpack")
+    message = {"type": "ai_response", "device_id": "cam", "response": "motion at the gate " * 200}
+    compressed = FrameCodec(FrameCodec.MSGPACK, compress_threshold=1024).encode(message)
+    plain = FrameCodec(FrameCodec.MSGPACK, compress=False).encode(message)
+    assert compressed[0] == FrameCodec.DEFLATE and plain[0] == FrameCodec.RAW
+    assert len(compressed) < len(plain) < len(json.dumps(message))
+    assert FrameCodec.decode(compressed) == FrameCodec.decode(plain) == message
+
+
+def test_msgpack_codec_stringifies_datetimes():
+    pytest.importorskip("msgpack")
+    stamp = datetime(2024, 1, 2, 3, 4, 5)
+    frame = FrameCodec(FrameCodec.MSGPACK).encode({"type": "message", "timestamp": stamp})
+    assert FrameCodec.decode(frame)["timestamp"] == str(stamp)
+
+
+def test_unknown_encoding_falls_back_to_json():
+    assert FrameCodec("protobuf").encoding == FrameCodec.JSON
+
+
+def test_manager_negotiates_msgpack_from_the_query_string(server):
+    pytest.importorskip("msgpack")
+
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        socket = FakeSocket(encoding="msgpack", compress="false")
+        connection = await manager.connect(socket, "u")
+        await manager.send_personal_message({"type": "message", "content": "x" * 4096}, "u")
+        await asyncio.sleep(0.01)
+        await manager.stop()
+        return connection, socket
+
+    connection, socket = asyncio.run(run())
+    assert connection.codec.describe()["compression"] is None
+    assert isinstance(socket.sent[0], bytes) and socket.sent[0][0] == FrameCodec.RAW
+    assert FrameCodec.decode(socket.sent[0])["content"] == "x" * 4096
+
+
+def test_sweeper_pings_quiet_sockets_and_evicts_silent_ones(server, monkeypatch):
+    monkeypatch.setattr(server, "WS_PING_INTERVAL", 30)
+    monkeypatch.setattr(server, "WS_IDLE_TIMEOUT", 90)
+
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        sockets = {name: FakeSocket() for name in ("active", "quiet", "silent")}
+        connections = {name: await manager.connect(socket, "u") for name, socket in sockets.items()}
+        connections["quiet"].last_activity -= 60
+        connections["silent"].last_activity -= 120
+        await manager.sweep()
+        await asyncio.sleep(0.01)
+        stats = manager.stats()
+        await manager.stop()
+        return sockets, connections, stats
+
+    sockets, connections, stats = asyncio.run(run())
+    assert sockets["active"].sent == []
+    assert [json.loads(frame)["type"] for frame in sockets["quiet"].sent] == ["ping"]
+    assert sockets["silent"].closed_with == 1001 and connections["silent"].closed
+    assert stats["connections"] == 2 and stats["evicted_idle"] == 1
+
+
+def test_sweeper_runs_in_the_background(server, monkeypatch):
+    monkeypatch.setattr(server, "WS_SWEEP_INTERVAL", 0.01)
+    monkeypatch.setattr(server, "WS_IDLE_TIMEOUT", 90)
+
+    async def run():
+        manager = server.ConnectionManager(InMemoryBroker())
+        await manager.start()
+        socket = FakeSocket()
+        connection = await manager.connect(socket, "u")
+        connection.last_activity -= 120
+        await asyncio.sleep(0.05)
+        evicted = manager.evicted_idle
+        await manager.stop()
+        return socket, evicted
+
+    socket, evicted = asyncio.run(run())
+    assert socket.closed_with == 1001 and evicted == 1
@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionRejected
+from scheduling import PriorityScheduler, lane_from_data, normalize_lane, parse_lane_rates
+
+
+def test_lane_names_and_aliases():
+    assert normalize_lane("high") == "HIGH"
+    assert normalize_lane("urgent") == "HIGH"
+    assert normalize_lane("routine") == "LOW"
+    assert normalize_lane("unknown") == "MEDIUM"
+    assert normalize_lane(None) == "MEDIUM"
+
+
+def test_lane_from_data():
+    assert lane_from_data({"alert_level": "LOW"}, explicit="HIGH") == "HIGH"
+    assert lane_from_data({"priority": "low"}) == "LOW"
+    assert lane_from_data({"notify_immediately": True}) == "HIGH"
+    assert lane_from_data(None) == "MEDIUM"
+
+
+def test_parse_lane_rates():
+    assert parse_lane_rates("HIGH=0, MEDIUM=20,low=5") == {"HIGH": 0.0, "MEDIUM": 20.0, "LOW": 5.0}
+    assert parse_lane_rates(None) == {}
+
+
+def test_high_lane_jumps_queued_routine_work():
+    order = []
+
+    async def job(scheduler, lane, name):
+        async with scheduler.slot(lane):
+            await asyncio.sleep(0.01)
+            order.append(name)
+
+    async def run():
+        scheduler = PriorityScheduler("test", concurrency=1)
+        tasks = [asyncio.create_task(job(scheduler, "LOW", f"low{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(job(scheduler, "HIGH", "high")))
+        await asyncio.gather(*tasks)
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert order[:2] == ["low0", "high"]
+    assert scheduler.active == 0
+
+
+def test_full_lane_is_rejected():
+    async def run():
+        scheduler = PriorityScheduler("vision", concurrency=1, max_queue=1)
+
+        async def job():
+            async with scheduler.slot("MEDIUM"):
+                pass
+
+        async with scheduler.slot("MEDIUM"):
+            waiter = asyncio.create_task(job())
+            await asyncio.sleep(0)
+            with pytest.raises(AdmissionRejected) as rejected:
+                await job()
+        await waiter
+        return scheduler, rejected.value
+
+    scheduler, rejected = asyncio.run(run())
+    assert rejected.reason == "vision_MEDIUM_queue_full"
+    assert scheduler.lanes["MEDIUM"].rejected == 1
+
+
+def test_wait_past_deadline_is_rejected_and_forgotten():
+    async def run():
+        scheduler = PriorityScheduler("vision", concurrency=1, max_wait=0.05)
+        async with scheduler.slot("LOW"):
+            with pytest.raises(AdmissionRejected) as rejected:
+                async with scheduler.slot("LOW"):
+                    pass
+        return scheduler, rejected.value
+
+    scheduler, rejected = asyncio.run(run())
+    assert rejected.reason == "vision_LOW_timeout"
+    assert scheduler.lanes["LOW"].stats()["queued"] == 0
+    assert scheduler.active == 0
+
+
+def test_rate_limited_lane_is_paced():
+    async def run():
+        scheduler = PriorityScheduler("test", concurrency=4, rates={"LOW": 20})
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        async def job():
+            async with scheduler.slot("LOW"):
+                pass
+
+        await asyncio.gather(*(job() for _ in range(22)))
+        return loop.time() - started
+
+    # A burst of 20 (one second's worth), then a token every 50ms
+    assert asyncio.run(run()) >= 0.09